@@ -1,14 +1,46 @@
 import configparser
-import importlib
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import pandas as pd
 from datetime import datetime, timedelta
+from lib.binning import bin_data
+from lib.lod_plot import LODLine, SpanPicker
+from lib.user_selection import save_selections, load_selections
+from lib.sync import estimate_delay, view_signal, shift_time
+from lib.auto_qc import auto_qc
+from lib.flag import flag_bins
+from lib.scheduler import build_graph, run_graph, n_workers
+from lib.shard import shard_days, trim, merge, run_shards
+from lib.checkpoint import CHECKPOINT_DIR, CheckpointStore, code_version, day_hashes, file_hashes, stage_keys, write_days
+from lib.htjs_model import HTJS_MODELS, resolve_path
+from lib.import_inlinino_base import SATURATION_THRESHOLD
+from lib.level_summary import EMPTY, summarize, format_bytes, memory_by_level
+from instruments import instrument_class
+
+# Levels saved by each stage, levels it reads and modules computing it, for the checkpoints (see lib.checkpoint)
+STAGE_CHECKPOINTS = {
+    'Split': (('raw',), ('data',), ('lib.split',)),
+    'AutoQC': (('qc', 'suspect', 'bad'), ('raw',), ('lib.auto_qc',)),
+    'Bin': (('bin',), ('qc',), ('lib.binning',)),  # raw when AutoQC did not run, see _bin_level
+    'Flag': (('flag',), ('bin',), ('lib.flag',)),
+    'calibrate': (('prod',), ('bin', 'qc'), ('lib.acs_processing', 'lib.cdom_interpolation', 'lib.acs_device',
+                                             'lib.htjs_model')),
+}
+# Levels of the instruments, and levels written by each stage (see _update_status)
+LEVELS = ('data', 'raw', 'qc', 'suspect', 'bad', 'bin', 'flag', 'prod')
+STAGE_LEVELS = {'ReadRaw': ('data',), 'RefreshRaw': ('data',), 'Sync': ('data',), 'QCRef': ('data',),
+                'Split': ('raw',), 'AutoQC': ('qc', 'suspect', 'bad'), 'Bin': ('bin',), 'Flag': ('flag',),
+                'calibrate': ('prod',)}
+# Keys of the levels written by Write for each product
+WRITE_PRODUCTS = {'part': ('p', 'tsw'), 'diss': ('g', 'fsw')}
 
 # Placeholder class for InLineAnalysis
 class InLineAnalysis:
     def __init__(self, config_path):
+        self.config_path = config_path
         self.cfg, self.instruments = self.load_config(config_path)
+        self.checkpoint_keys = {}  # Day keys of the levels of each instrument, see _resume
+        self.status = {}  # Summaries of the levels of each instrument, see _update_status
         
 
         
@@ -45,9 +77,12 @@ class InLineAnalysis:
             # Load general process settings from the [process] section
             if 'process' in config:
                 cfg['days2run'] = config.get('process', 'days2run')
-                cfg['instruments2run'] = config.get('process', 'instruments2run').split(',')
+                cfg['instruments2run'] = [x.strip() for x in config.get('process', 'instruments2run').split(',') if x.strip()]
                 cfg['write'] = config.getboolean('process', 'write')
-                cfg['parallel'] = config.getint('process', 'parallel')
+                cfg['parallel'] = config.getfloat('process', 'parallel')  # -1 or inf: all cores
+                cfg['shard'] = config.get('process', 'shard', fallback='week')  # day, week or days (RunSharded)
+                cfg['shard_margin'] = config.getfloat('process', 'shard_margin', fallback=2)  # hours
+                cfg['checkpoint'] = config.getboolean('process', 'checkpoint', fallback=False)  # see _resume
                 cfg['skip_instruments'] = config.get('process', 'skip').split(',')
                 cfg['qc_mode'] = config.get('process', 'qc_mode', fallback='default')
                 cfg['qc_once_for_all'] = config.get('process', 'qc_once_for_all', fallback='default')
@@ -60,10 +95,60 @@ class InLineAnalysis:
                 
             # Load sync delay from the [sync] section
             if 'sync' in config:
-                cfg['sync_delay_flow'] = config.getint('sync', 'delay_FLOW', fallback=10)
+                cfg['sync'] = {
+                    'mode': config.get('sync', 'mode', fallback='manual'),  # manual (delay_*) or auto
+                    'reference': config.get('sync', 'reference', fallback='FLOW'),
+                    'skip': [x.strip().lower() for x in config.get('sync', 'skip', fallback='').split(',') if x.strip()],
+                    'delay': {key[len('delay_'):]: config.getfloat('sync', key)
+                              for key in config['sync'] if key.startswith('delay_')},
+                    'step': config.getfloat('sync', 'step', fallback=1),  # seconds
+                    'max_lag': config.getfloat('sync', 'max_lag', fallback=600),  # seconds
+                    'window': config.getfloat('sync', 'window', fallback=6),  # hours
+                    'min_confidence': config.getfloat('sync', 'min_confidence', fallback=0.5),
+                }
+                cfg['sync_delay_flow'] = cfg['sync']['delay'].get('flow', 10)
             else:
                 print("Warning: No [sync] section found in the configuration file.")
             
+            # Load split settings from the [split] section (keys are lower case)
+            if 'split' in config:
+                cfg['split'] = {
+                    'reference': config.get('split', 'reference', fallback='FLOW'),
+                    'skip': [x.strip().lower() for x in config.get('split', 'skip', fallback='').split(',') if x.strip()],
+                    'buffer': {key[len('buffer_'):]: tuple(float(x) for x in config.get('split', key).split(','))
+                               for key in config['split'] if key.startswith('buffer_')},
+                }
+            else:
+                print("Warning: No [split] section found in the configuration file.")
+
+            # Load binning settings from the [bin] section (keys are lower case)
+            if 'bin' in config:
+                cfg['bin'] = {
+                    'bin_size': {key[len('bin_size_'):]: config.getfloat('bin', key)
+                                 for key in config['bin'] if key.startswith('bin_size_')},
+                    'prctile_detection': [float(x) for x in config.get('bin', 'prctile_detection', fallback='2.5, 97.5').split(',')],
+                    'prctile_average': [float(x) for x in config.get('bin', 'prctile_average', fallback='2.5, 97.5').split(',')],
+                    'mode': config.get('bin', 'mode', fallback='ByDay'),
+                    'skip': [x.strip() for x in config.get('bin', 'skip', fallback='').split(',') if x.strip()],
+                }
+            else:
+                print("Warning: No [bin] section found in the configuration file.")
+
+            # Load flagging settings from the [flag] section
+            if 'flag' in config:
+                cfg['flag'] = {
+                    'skip': [x.strip().lower() for x in config.get('flag', 'skip', fallback='').split(',') if x.strip()],
+                    'maximum_fudge_factor': config.getfloat('flag', 'maximum_fudge_factor', fallback=4),
+                    'variance_fudge_factor': config.getfloat('flag', 'variance_fudge_factor', fallback=3),
+                    'avg_sensitivity': config.getfloat('flag', 'avg_sensitivity', fallback=1),
+                    'unc1_sensitivity': config.getfloat('flag', 'unc1_sensitivity', fallback=1),
+                    'unc2_sensitivity': config.getfloat('flag', 'unc2_sensitivity', fallback=2),
+                    'smooth_threshold': config.getfloat('flag', 'smooth_threshold', fallback=60),  # minutes
+                    'min_flag_n': config.getint('flag', 'min_flag_n', fallback=1),
+                }
+            else:
+                print("Warning: No [flag] section found in the configuration file.")
+
             # Load QC mode from the [qc] section
             if 'qcref' in config:
                 cfg['qcref']={}
@@ -71,10 +156,25 @@ class InLineAnalysis:
                 cfg['qcref']['view'] = config.get('qcref', 'view')
                 cfg['qcref']['MinFiltPeriod'] = config.get('qcref', 'MinFiltPeriod')
                 cfg['qcref']['szFilt'] = config.get('qcref', 'szFilt')
+                cfg['qcref']['remove_old'] = config.getboolean('qcref', 'remove_old', fallback=False)
 
             else:
                 print("Warning: No [qc] section found in the configuration file.")
                 
+            # Load automatic QC settings from the [qc] section
+            if 'qc' in config:
+                flow_below = config.get('qc', 'remove_when_flow_below', fallback='false').strip()
+                cfg['qc'] = {
+                    'skip': [x.strip().lower() for x in config.get('qc', 'skip', fallback='').split(',') if x.strip()],
+                    # Flow rate below which data is removed, false: data kept
+                    'remove_when_flow_below': None if flow_below.lower() in ('false', 'default', '') else float(flow_below),
+                    'spike_window': config.getint('qc', 'spike_window', fallback=5),
+                    'spike_threshold': config.getfloat('qc', 'spike_threshold', fallback=5),
+                    'saturation_threshold': config.getfloat('qc', 'saturation_threshold', fallback=SATURATION_THRESHOLD),
+                    'max_nan_fraction': config.getfloat('qc', 'max_nan_fraction', fallback=0.5),
+                    'spectral_threshold': config.getfloat('qc', 'spectral_threshold', fallback=10),
+                }
+
             # Accessing calibration settings from the [calibrate] section
             if 'calibrate' in config:
                 cfg['calibrate']={}
@@ -106,6 +206,7 @@ class InLineAnalysis:
                     instruments[instrument_name] = {
                         'model': config.get(section, 'model', fallback=None),
                         'TSG_source': config.getboolean(section, 'TSG_source', fallback=False),
+                        'CDOM_source': config.getboolean(section, 'CDOM_source', fallback=False),
                         'boat': config.get(section, 'boat', fallback=None),
                         'logger': config.get(section, 'logger', fallback=None),
                         'sn': config.get(section, 'sn', fallback=None),
@@ -117,7 +218,14 @@ class InLineAnalysis:
                         'view_varcol': config.get(section, 'view_varcol', fallback=None),
                         'temperature_variable': config.get(section, 'temperature_variable', fallback=None),
                         'device_file': config.get(section, 'device_file', fallback=None),
+                        'psi_file': config.get(section, 'psi_file', fallback=None),
+                        'htjs_enable': config.getboolean(section, 'htjs_enable', fallback=False),
+                        'htjs_model_path': config.get(section, 'htjs_model_path', fallback=None),
+                        'htjs_dtype': config.get(section, 'htjs_dtype', fallback='float64'),
+                        'salinity_variable': config.get(section, 'salinity_variable', fallback=None),
                         'prefix': config.get(section, 'prefix', fallback=None),
+                        'cache_format': config.get(section, 'cache_format', fallback='npy'),
+                        'cache_checksum': config.getboolean(section, 'cache_checksum', fallback=False),
 
                     }
 
@@ -129,96 +237,127 @@ class InLineAnalysis:
         return cfg, instruments
 
 
-    def ReadRaw(self):
-        
-        # Maybe this piece of code needs to go outside as instrument classes should be called
-        # even if raw data is not read
-        for instrument_name in self.cfg['instruments2run']:
-            try:
-                # Dynamically import the instrument class from the /instruments directory
-                instrument_module = importlib.import_module(f'instruments.{instrument_name}')
-                # Get the class from the module
-                instrument_class = getattr(instrument_module, instrument_name)
-                # Initialize the instrument class with the corresponding configuration
-                self.instruments[instrument_name] = instrument_class(self.instruments[instrument_name])
-                print(f"Initialized instrument: {instrument_name}")
-            except ModuleNotFoundError:
-                raise ValueError(f"Instrument module '{instrument_name}' not found in the instruments directory.")
-            except AttributeError:
-                raise ValueError(f"Instrument class '{instrument_name}' not found in the module '{instrument_name}.py'.")
-        
-        """Pre-Process: Read raw data for each instrument."""
-        for instrument_name in self.cfg['instruments2run']:
+    def InitInstruments(self, instruments=None):
+        """Initialize the instrument classes of their configuration, resolved from
+        their model (see instruments.instrument_class)."""
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            cfg = self.instruments.get(instrument_name)
+            if not isinstance(cfg, dict):
+                continue  # Already initialized
+            # The module of the class is imported here, the first time its model is used
+            self.instruments[instrument_name] = instrument_class(instrument_name, cfg.get('model'))(cfg)
+            print(f"Initialized instrument: {instrument_name}")
+
+    def ReadRaw(self, instruments=None):
+        """Pre-Process: Read raw data for each instrument, with the data within
+        cfg['read_margin'] (timedelta, if any) of days2run."""
+        self.InitInstruments(instruments)
+        for instrument_name in instruments or self.cfg['instruments2run']:
             if instrument_name not in self.instruments:
                 raise ValueError(f'Instrument2run "{instrument_name}" does not match any instrument name in the cfg file: '
-                                 f'{", ".join(self.instrument.keys())}')
+                                 f'{", ".join(self.instruments.keys())}')
             else:
                 print(f'READ RAW: {instrument_name}')
-                self.instruments[instrument_name].read_raw(self.cfg['days2run'], self.cfg['force_import'], True)
+                self.instruments[instrument_name].read_raw(self.cfg['days2run'], self.cfg['force_import'], True,
+                                                          parallel=self.cfg.get('parallel', -1),
+                                                          margin=self.cfg.get('read_margin'))
+        self._update_status('ReadRaw', instruments)
+
+
+
+    def RefreshRaw(self):
+        """Pre-Process: Append the data written to the raw files since the last
+        ReadRaw or RefreshRaw, parsing only the new lines (tail-follow)."""
+        for instrument_name in self.cfg['instruments2run']:
+            if not hasattr(self.instruments[instrument_name], 'refresh_raw'):
+                raise ValueError(f'Instrument "{instrument_name}" not initialized, run ReadRaw first')
+            print(f'REFRESH RAW: {instrument_name}')
+            self.instruments[instrument_name].refresh_raw(self.cfg['days2run'])
+        self._update_status('RefreshRaw')
 
 
+    def _update_status(self, stage, instruments=None, levels=None):
+        """Summaries of the levels written by stage (see lib.level_summary), after it ran."""
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments.get(instrument_name)
+            if instrument is None or isinstance(instrument, dict):
+                continue
+            status = self.status.setdefault(instrument_name, {})
+            for level in levels or STAGE_LEVELS[stage]:
+                # Reinserted, the last level of status is the last written
+                status.pop(level, None)
+                status[level] = summarize(getattr(instrument, level, None), stage)
 
-    def CheckDataStatus(self):
-        print('---------------------------------------------------------------------------------------------+')
-        print('Instrument |   Data   |   Raw    |   Bin    |   QC     | Suspect  |   Bad    |    Prod       |')
-        print('-----------+----------+----------+----------+----------+----------+----------+---------------+')
+    def CheckDataStatus(self, memory=False):
+        """
+        Rows of each level of the instruments, their time span and the last stage
+        run, from the summaries of the levels (the data is not read).
 
+        Args:
+            memory (bool): Also report the bytes of each level summed over the
+                instruments (and their dtypes), e.g. to choose the levels to
+                release in a long run (see Run).
+        """
+        line = '-----------+' + '----------+' * len(LEVELS) + '------------+-------------------------'
+        print(line)
+        print('Instrument |' + ''.join(f' {level:>8s} |' for level in LEVELS) + ' Last stage | Span')
+        print(line)
         for instrument_name in self.cfg['instruments2run']:
+            status = self.status.get(instrument_name, {})
+            rows = ''.join(f' {status.get(level, EMPTY).rows:8d} |' for level in LEVELS)
+            last = list(status.values())[-1].stage if status else 'None'
+            starts = [v.start for v in status.values() if v.start is not None]
+            ends = [v.end for v in status.values() if v.end is not None]
+            span = f'{min(starts):%Y-%m-%d %H:%M} to {max(ends):%Y-%m-%d %H:%M}' if starts else ''
+            print(f'{instrument_name:10s} |{rows} {last:>10s} | {span}')
+        print(line)
 
-            print(self.instruments[instrument_name])
-            
-            sdata = self.instruments[instrument_name].data.shape
-            
-            try:
-                sraw = self.instruments[instrument_name].raw['tsw'].shape[0] + self.instruments[instrument_name].raw['diw'].shape[0]
-            except AttributeError:
-                sraw = 0
-            
-            try:
-                sbin = self.instruments[instrument_name].bin['tsw'].shape[0] + self.instruments[instrument_name].bin['diw'].shape[0]
-            except AttributeError:
-                sbin = 0
-            
-            try:
-                sqc = self.instruments[instrument_name].qc['tsw'].shape[0] + self.instruments[instrument_name].qc['diw'].shape[0]
-            except AttributeError:
-                sqc = 0
-                
-            try:
-                sbad = self.instruments[instrument_name].bad['tsw'].shape[0] + self.instruments[instrument_name].bad['diw'].shape[0]
-            except AttributeError:
-                sbad = 0
-                
-            try:
-                ssuspect = self.instruments[instrument_name].suspect['tsw'].shape[0] + self.instruments[instrument_name].suspect['diw'].shape[0]
-            except AttributeError:
-                ssuspect = 0
-            
-            sprod = []
-            nprod = []
-
-            # Check if 'prod' has any fields
-            try:
-                if 'prod' in self.instruments[instrument_name]:
-                    for t in self.instruments[instrument_name].prod:
-                        sprod.append(self.instruments[instrument_name].prod[t].shape)
-                        nprod.append(t)
-            except:
-                "No products yet in {}".format(self.instruments[instrument_name])
-
-            # Prepare the output
-            output = f"{instrument_name:10s} | {sdata[0]:5d}x{sdata[1]:2d} | {sraw:5d} | {sbin:5d} | {sqc:5d} | {ssuspect:5d} | {sbad:5d} | "
-            
-            if not sprod:
-                output += 'None          | '
-            else:
-                for k in range(len(sprod)):
-                    output += f"{nprod[k]}({sprod[k][0]:3d}x{sprod[k][1]:2d}) | "
+        if memory:
+            total = 0
+            print('Level      |    Memory  | Columns')
+            for level, (nbytes, dtypes) in memory_by_level(self.status).items():
+                total += nbytes
+                columns = ', '.join(f'{dtype} x {n}' for dtype, n in sorted(dtypes.items()))
+                print(f'{level:10s} | {format_bytes(nbytes):>10s} | {columns}')
+            print(f'{"total":10s} | {format_bytes(total):>10s} |')
+            print(line)
+
+    def Sync(self, instruments=None):
+        """
+        Synchronise the time of each instrument: delay (seconds) added to its time.
+        In auto mode the delay is estimated from the cross-correlation with the
+        reference (see lib.sync), and the delay_<instrument> of [sync] is used
+        when the estimate is not confident enough.
+        """
+        cfg = self.cfg['sync']
+        reference = self.instruments[cfg['reference']] if cfg['mode'] == 'auto' else None
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            if instrument_name.lower() in cfg['skip']:
+                continue
+            if instrument.data is None or len(instrument.data) == 0:
+                print(f"SYNC: {instrument_name} data table is empty")
+                continue
+
+            delay = cfg['delay'].get(instrument_name.lower(), 0)
+            if reference is not None and instrument is not reference:
+                result = estimate_delay(*view_signal(reference.data, reference.cfg.get('view_varname'),
+                                                     reference.cfg.get('view_varcol')),
+                                        *view_signal(instrument.data, instrument.cfg.get('view_varname'),
+                                                     instrument.cfg.get('view_varcol')),
+                                        cfg['step'], cfg['max_lag'], cfg['window'] * 3600)
+                print(f"SYNC: {instrument_name} estimated delay {result.delay:.1f} s "
+                      f"(confidence {result.confidence:.2f}, {len(result.window_delay)} windows)")
+                if result.confidence >= cfg['min_confidence']:
+                    delay = result.delay
+                else:
+                    print(f"Warning: {instrument_name} delay not confident, using delay_{instrument_name} = {delay} s")
+
+            if delay:
+                print(f"SYNC: {instrument_name} shifted by {delay:.1f} s")
+                instrument.data = shift_time(instrument.data, delay)
+        self._update_status('Sync', instruments)
 
-            print(output)
-        
-        print('---------------------------------------------------------------------------------------------+')
-    
     def QCRef(self):
     
         if not hasattr(self.instruments[self.cfg['qcref']['view']].data, 'dt') or len(self.instruments[self.cfg['qcref']['view']].data) == 0:
@@ -226,6 +365,8 @@ class InLineAnalysis:
     
         mode = self.cfg['qcref']['mode']
         if mode == 'ui':
+            import matplotlib.pyplot as plt  # GUI backend loaded for the selection only
+
             # Round datetime to the nearest second
             flow_data = self.instruments['FLOW'].data
             flow_data['dt'] = flow_data.index.astype('datetime64[s]')
@@ -247,209 +388,515 @@ class InLineAnalysis:
             fig, ax1 = plt.subplots()
             ax1.set_title('Switch position QC:\nSelect total (t; red) and filtered (f; green) sections.\nPress q to save and quit (close graph to cancel and quit)', fontsize=18)
             ax1.set_ylabel('Switch position', color='k')
-            ax1.plot(inst_ref.data.dt,inst_ref.data[inst_ref.cfg['view_varname']],
-                'k-', linewidth=2)
+            # Decimated to the pixel width, and again from the full data on zoom (see lib.lod_plot)
+            LODLine(ax1, inst_ref.data.dt.to_numpy(), inst_ref.data[inst_ref.cfg['view_varname']].to_numpy(),
+                    'k-', linewidth=2)
             ax2 = ax1.twinx()
-            ax2.scatter(
-                inst_view.data.dt,
-                inst_view.data.iloc[:, int(inst_view.cfg['view_varcol'])],
-                label=inst_view.cfg['view_varname']
-            )
-    
+            LODLine(ax2, inst_view.data.dt.to_numpy(),
+                    inst_view.data.iloc[:, int(inst_view.cfg['view_varcol'])].to_numpy(),
+                    '.', linestyle='none', label=inst_view.cfg['view_varname'])
+            # Spans are selected on the top axes, with blitting
+            picker = SpanPicker(ax2, {'t': 'total', 'f': 'filtered'}, {'total': 'red', 'filtered': 'green'})
+
             plt.legend(fontsize=14)
             plt.show()
-    
-            # Save selections to a file
-            user_selection = {'total': inst_ref.data[inst_ref.data.swt==0], 
-                              'filtered': inst_ref.data[inst_ref.data.swt==1]}  # Placeholder for selections from GUI
+            if not picker.saved:
+                print('QCRef: cancelled, selections not saved')
+                return
+
+            # Append the selections of this session to the file (see lib.user_selection),
+            # or replace the previous sessions with remove_old
+            user_selection = picker.selections
             save_path = os.path.join(inst_ref.cfg['path_ui'], 'QCRef_UserSelection.npy')
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            np.save(save_path, user_selection)
+            save_selections(save_path, user_selection, append=not self.cfg['qcref'].get('remove_old', False))
+            inst_ref.apply_user_inputs(user_selection)
             
         elif mode == 'load':
-            print(f"QCRef LOAD: {self.obj.cfg['qcref']['reference']}")
-            load_path = os.path.join(self.instruments[self.cfg['qcref']['reference']].path.ui, 'QCRef_UserSelection.npy')
+            inst_ref = self.instruments[self.cfg['qcref']['reference']]
+            print(f"QCRef LOAD: {self.cfg['qcref']['reference']}")
+            load_path = os.path.join(inst_ref.cfg['path_ui'], 'QCRef_UserSelection.npy')
             if os.path.exists(load_path):
-                file_selection = np.load(load_path, allow_pickle=True).item()
-                days2run = self.obj.cfg['days2run']
-    
-                # Filter selections based on days2run
-                if 'total' in file_selection and len(file_selection['total']) > 0:
-                    file_selection['total'] = [entry for entry in file_selection['total'] if not (entry[1] < min(days2run) or entry[0] > max(days2run))]
-                if 'filtered' in file_selection and len(file_selection['filtered']) > 0:
-                    file_selection['filtered'] = [entry for entry in file_selection['filtered'] if not (entry[1] < min(days2run) or entry[0] > max(days2run))]
-    
-                self.instruments[self.cfg['qcref']['reference']].apply_user_input(file_selection['total'], 'total')
-                self.instruments[self.cfg['qcref']['reference']].apply_user_input(file_selection['filtered'], 'filtered')
+                # Selections over the days to run only, by binary search
+                days2run = self.cfg['days2run']
+                file_selection = load_selections(load_path, min(days2run), max(days2run) + timedelta(days=1))
+
+                # All selections at once, later sessions overriding earlier ones where they overlap
+                inst_ref.apply_user_inputs(file_selection)
     
         elif mode == 'skip':
             print("WARNING: Reference is not QC.")
         else:
             raise ValueError("Unknown mode.")
+        self._update_status('QCRef', [self.cfg['qcref']['reference']])
 
-        
 
-    def Split(self):
+    def AutoQC(self, level='raw', instruments=None):
+        """
+        Automatic QC of the raw data (tsw, fsw, diw) of each instrument (see lib.auto_qc):
+        spikes and saturated values are removed, bad spectra and data taken at low
+        flow are moved to bad, suspect spectra are copied to suspect.
+        """
+        if level != 'raw':
+            raise ValueError(f"AutoQC: unknown level {level}")
+        cfg = self.cfg.get('qc', {})
+        flow, flow_below = None, cfg.get('remove_when_flow_below')
+        reference = self.instruments.get(self.cfg.get('split', {}).get('reference', 'FLOW'))
+        if flow_below is not None and reference is not None and reference.data is not None:
+            flow = (pd.DatetimeIndex(reference.data.index).as_unit('ns').asi8, reference.data['flow'].to_numpy(dtype=float))
+
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            if instrument_name.lower() in cfg.get('skip', []):
+                print(f"AUTOQC: Skip {instrument_name} (copy data to next level)")
+                instrument.qc = dict(instrument.raw)
+                continue
+            if self._resume('AutoQC', instrument_name):
+                continue
+            for level_name, data in instrument.raw.items():
+                if data is None or len(data) == 0:
+                    continue
+                instrument.qc[level_name], instrument.suspect[level_name], instrument.bad[level_name], stats = auto_qc(
+                    data, cfg.get('spike_window', 5), cfg.get('spike_threshold', 5),
+                    saturation_threshold=cfg.get('saturation_threshold', SATURATION_THRESHOLD),
+                    max_nan_fraction=cfg.get('max_nan_fraction', 0.5), n_mad_spectral=cfg.get('spectral_threshold', 10),
+                    flow=flow, flow_threshold=flow_below)
+                print(f"AUTOQC: {instrument_name} {level_name}: " + ', '.join(f"{k} {v}" for k, v in stats.items()))
+            self._save_checkpoint('AutoQC', instrument_name)
+        self._update_status('AutoQC', instruments)
+
+    def Split(self, instruments=None):
         """
+        Split the data of each instrument in total (raw['tsw']) and filtered
+        (raw['fsw']) water with the switch periods of the reference (see lib.split).
+        Buffers are in seconds, (filtered, total) per instrument (buffer_<instrument> in [split]).
         Note: Run all days loaded (independent of days2run)
         """
-        for i in self.cfg['instruments2run']:
-            # i in MATLAB is a cell array, access the first element in Python
-            instrument_name = i
-            
+        cfg = self.cfg['split']
+        reference = self.instruments[cfg['reference']]
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+
             # Check if data is empty
-            if not self.instrument[instrument_name].get('data'):
+            if instrument.data is None or len(instrument.data) == 0:
                 raise ValueError(f"{instrument_name} data table is empty")
-            
+
             # Check if the instrument is in the skip list
-            if instrument_name in self.cfg['split']['skip']:
+            if instrument_name.lower() in cfg['skip']:
                 print(f"SPLIT: Skip {instrument_name} (copy data to next level)")
-                self.instrument[instrument_name]['raw']['tsw'] = self.instrument[instrument_name]['data']
-            
+                instrument.raw['tsw'] = instrument.data
+
             # Check if the split mode is 'None'
-            elif self.instrument[instrument_name]['split']['mode'] == 'None':
+            elif getattr(instrument, 'split_mode', 'Default') == 'None':
                 print(f"SPLIT: Not available for {instrument_name}")
-            
+
+            elif self._resume('Split', instrument_name):
+                continue
+
             # Perform the split operation
             else:
                 print(f"SPLIT: {instrument_name}")
-                reference_instrument = self.instrument[self.cfg['split']['reference']]
-                buffer_value = self.cfg['split']['buffer'][instrument_name]
-                self.instrument[instrument_name].Split(reference_instrument, buffer_value)
+                buffer = cfg['buffer'].get(instrument_name.lower())
+                if buffer is None:
+                    print(f"Warning: No buffer_{instrument_name} in [split], no buffer applied.")
+                    buffer = (0, 0)
+                instrument.Split(reference, buffer)
+                self._save_checkpoint('Split', instrument_name)
+        self._update_status('Split', instruments)
+
+
+    def Bin(self, instruments=None):
+        """
+        Bin the data (tsw, fsw, diw) of each instrument in fixed time bins (see lib.binning):
+        its qc level when AutoQC ran, else its raw level (see _bin_level).
+        Bin sizes are in minutes, per instrument (bin_size_<instrument> in [bin]).
+        """
+        cfg = self.cfg.get('bin', {})
+        skip = [x.lower() for x in cfg.get('skip', [])]
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            if instrument_name.lower() in skip:
+                print(f"BIN: Skip {instrument_name} (copy data to next level)")
+                instrument.bin = dict(getattr(instrument, self._bin_level(instrument_name)))
+                continue
 
+            if self._resume('Bin', instrument_name):
+                continue
+            bin_size = cfg.get('bin_size', {}).get(instrument_name.lower(), 1)
+            print(f"BIN: {instrument_name} ({bin_size} min)")
+            for level, data in getattr(instrument, self._bin_level(instrument_name)).items():
+                if data is None or len(data) == 0:
+                    continue
+                instrument.bin[level] = bin_data(data, bin_size,
+                                                 cfg.get('prctile_detection', (2.5, 97.5)),
+                                                 cfg.get('prctile_average', (2.5, 97.5)),
+                                                 cfg.get('mode', 'ByDay'))
+            self._save_checkpoint('Bin', instrument_name)
+        self._update_status('Bin', instruments)
 
 
-    
-    def calibrate(self):
-        # Iterate through instruments to be calibrated (obj.cfg['instruments2run'])
-        for instrument_name in self.cfg['instruments2run']:
-            if instrument_name in self.cfg['calibrate']['skip']:
+    def _bin_level(self, instrument_name):
+        """Level binned by Bin: qc if AutoQC wrote it, else raw."""
+        qc = getattr(self.instruments[instrument_name], 'qc', None) or {}
+        return 'qc' if any(v is not None and len(v) for v in qc.values()) else 'raw'
+
+    def Flag(self, instruments=None):
+        """
+        Flag the binned data (tsw, fsw, diw) of each instrument with the fudge factor
+        tests of [flag] (see lib.flag): one uint8 flag code per bin in flag[level].
+        """
+        cfg = dict(self.cfg.get('flag', {}))
+        skip = cfg.pop('skip', [])
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            if instrument_name.lower() in skip:
+                print(f"FLAG: Skip {instrument_name}")
+                continue
+            if self._resume('Flag', instrument_name):
+                continue
+            for level, data in instrument.bin.items():
+                if data is None or len(data) == 0:
+                    continue
+                instrument.flag[level] = flag_bins(data, **cfg)
+                flagged = int((instrument.flag[level] > 0).sum())
+                print(f"FLAG: {instrument_name} {level}: {flagged}/{len(data)} bins flagged")
+            self._save_checkpoint('Flag', instrument_name)
+        self._update_status('Flag', instruments)
+
+
+    def calibration_settings(self, instrument_name):
+        """
+        Settings of [calibrate] for an instrument, overridden by the dict
+        cfg['calibrate'][<instrument>] if any (e.g. {'interpolation_method': 'CDOM'}).
+        """
+        cfg = self.cfg['calibrate']
+        settings = {k: v for k, v in cfg.items() if not isinstance(v, dict)}
+        settings.update(cfg.get(instrument_name, cfg.get(instrument_name.lower(), {})))
+        return settings
+
+    def calibration_skip(self):
+        """Lowercase names of the instruments in skip of [calibrate]."""
+        skip = self.cfg['calibrate'].get('skip', [])
+        if isinstance(skip, str):
+            skip = [x.strip() for x in skip.split(',') if x.strip()]
+        return [x.lower() for x in skip]
+
+    def _calibration_source(self, name, flag):
+        """
+        Instrument of name if loaded, else the first instrument loaded with flag
+        (TSG_source or CDOM_source) set in its section, else None.
+        """
+        def loaded(instrument):
+            return not isinstance(instrument, dict) and getattr(instrument, 'qc', {}).get('tsw') is not None
+        if name and loaded(self.instruments.get(name)):
+            return self.instruments[name]
+        return next((i for i in self.instruments.values() if loaded(i) and i.cfg.get(flag)), None)
+
+    def calibrate(self, instruments=None):
+        """
+        Calibrate the binned data of each instrument in products (prod), with the
+        settings of [calibrate] (see calibration_settings). Instruments of skip copy
+        their qc tsw to prod['a']. The CDOM_source (CDOM interpolation) and TSG_source
+        (temperature and salinity correction) instruments are used when loaded.
+        """
+        skip = self.calibration_skip()
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            if instrument_name.lower() in skip:
                 print(f'CALIBRATE: Skip {instrument_name} (copy data to next level)')
-                self.instrument[instrument_name]['prod']['a'] = self.instrument[instrument_name]['qc']['tsw']
+                instrument.prod = {'a': instrument.qc['tsw']}
+                continue
+            model = instrument.cfg.get('model')
+            if model not in ('ACS', 'AC9'):
+                print(f'CALIBRATE: No calibration for {instrument_name} ({model}), skipped')
+                continue
+            if self._resume('calibrate', instrument_name):
+                continue
+
+            print(f'CALIBRATE: {instrument_name}')
+            settings = self.calibration_settings(instrument_name)
+            method = settings.get('interpolation_method', 'linear')
+            cdom = self._calibration_source(settings.get('CDOM_source'), 'CDOM_source') if method == 'CDOM' else None
+            if method == 'CDOM' and cdom is None:
+                print('No CDOM data available for CDOM interpolation: using linear interpolation')
+                method = 'linear'
+            tsg = self._calibration_source(settings.get('TSG_source'), 'TSG_source')
+            if tsg is None:
+                print('No TSG data available for T/S correction: S/T are assumed to be constant')
+            flow = self.instruments.get(settings.get('FLOW_source', self.cfg.get('split', {}).get('reference', 'FLOW')))
+            instrument.calibrate(self.cfg['days2run'], settings.get('compute_dissolved', False), method, cdom, flow,
+                                 settings.get('di_method', 'best_di'),
+                                 settings.get('scattering_correction', 'Rottgers2013_semiempirical'),
+                                 settings.get('compute_ad_aphi', False), tsg,
+                                 settings.get('min_nb_pts_per_cluster', 3), settings.get('time_weight_for_cluster', 1))
+            self._save_checkpoint('calibrate', instrument_name)
+        self._update_status('calibrate', instruments)
+
+    def _source_names(self, name, flag):
+        """Instruments to run that may be the TSG_source or CDOM_source (see _calibration_source)."""
+        if name in self.cfg['instruments2run']:
+            return [name]
+        return [n for n in self.cfg['instruments2run']
+                if (self.instruments[n] if isinstance(self.instruments[n], dict) else self.instruments[n].cfg).get(flag)]
+
+    def _stage_references(self, stage, instrument_name):
+        """
+        Instruments whose same stage must be done before stage of instrument_name,
+        and levels read by the stage as (instrument, level). None if the stage
+        does not run for the instrument.
+        """
+        split_ref = self.cfg.get('split', {}).get('reference', 'FLOW')
+        if stage == 'Sync':
+            if 'sync' not in self.cfg:
+                return None
+            ref = self.cfg['sync']['reference']
+            refs = [ref] if self.cfg['sync']['mode'] == 'auto' else []
+            return refs, [(instrument_name, 'data')] + [(r, 'data') for r in refs if r != instrument_name]
+        if stage == 'QCRef':
+            if self.cfg.get('qcref', {}).get('reference') != instrument_name:
+                return None
+            # The view instrument is plotted and checked for data: its reading must be done
+            view = self.cfg['qcref'].get('view')
+            refs = [view] if view and view != instrument_name else []
+            return refs, [(instrument_name, 'data')] + [(r, 'data') for r in refs]
+        if stage == 'Split':
+            return [split_ref], [(instrument_name, 'data'), (split_ref, 'data')]
+        if stage == 'AutoQC':
+            refs = [split_ref] if self.cfg.get('qc', {}).get('remove_when_flow_below') is not None else []
+            return refs, [(instrument_name, 'raw')] + [(r, 'data') for r in refs if r != instrument_name]
+        if stage == 'Bin':
+            # qc, or raw when AutoQC is not run (see _bin_level)
+            return [], [(instrument_name, 'qc'), (instrument_name, 'raw')]
+        if stage == 'Flag':
+            return [], [(instrument_name, 'bin')]
+        if stage == 'calibrate':
+            if 'calibrate' not in self.cfg:
+                return None
+            instrument = self.instruments[instrument_name]
+            model = (instrument if isinstance(instrument, dict) else instrument.cfg).get('model')
+            if instrument_name.lower() in self.calibration_skip() or model not in ('ACS', 'AC9'):
+                return [], [(instrument_name, 'qc')]
+            settings = self.calibration_settings(instrument_name)
+            refs = [settings.get('FLOW_source', split_ref)] + self._source_names(settings.get('TSG_source'), 'TSG_source')
+            if settings.get('interpolation_method') == 'CDOM':
+                refs += self._source_names(settings.get('CDOM_source'), 'CDOM_source')
+            return refs, [(instrument_name, 'bin'), (instrument_name, 'qc')] + [(r, 'qc') for r in refs]
+        return [], []
+
+    def _release(self, instrument_name, level):
+        """Empty a level of an instrument, keeping its columns (data) or its keys (raw, bin...)."""
+        instrument = self.instruments[instrument_name]
+        value = getattr(instrument, level, None)
+        if isinstance(value, dict):
+            setattr(instrument, level, {k: v.iloc[:0] if v is not None else v for k, v in value.items()})
+        elif value is not None:
+            setattr(instrument, level, value.iloc[:0])
+        self._update_status('release', [instrument_name], [level])
+
+    def Run(self, stages=('ReadRaw', 'Sync', 'QCRef', 'Split', 'AutoQC', 'Bin', 'Flag', 'calibrate'),
+            release=True, keep=('bin', 'qc')):
+        """
+        Run stages for all instruments2run, independent instruments concurrently
+        (see lib.scheduler): each stage of an instrument waits for its previous
+        stage and for the same stage of the instruments it depends on (sync and
+        split reference, qcref view, TSG_source, CDOM_source and FLOW_source of
+        [calibrate]).
+        Threads: parallel of [process] (-1 or inf: one per core); in qcref ui
+        mode stages run one at a time in this thread (for the figure).
+
+        Args:
+            stages (tuple): Stages, in order.
+            release (bool): Empty the levels (data, raw...) of an instrument once
+                every stage reading them is done, to bound the memory.
+            keep (tuple): Levels never released.
+        """
+        instruments = self.cfg['instruments2run']
+        specs = {}
+
+        def references(stage, instrument_name):
+            spec = self._stage_references(stage, instrument_name)
+            if spec is None:
+                return None
+            refs, reads = spec
+            specs[(stage, instrument_name)] = [(n, level) for n, level in reads if n in instruments]
+            return refs
+
+        graph = build_graph(instruments, stages, references)
+        workers = n_workers(self.cfg.get('parallel', -1), len(instruments))
+        if 'QCRef' in stages and self.cfg.get('qcref', {}).get('mode') == 'ui':
+            workers = 1
+
+        def run(node):
+            stage, instrument_name = node
+            if stage == 'QCRef':
+                self.QCRef()
             else:
-                print(f'CALIBRATE: {instrument_name}')
-
-                # Handle instrument class extraction for certain instruments
-                if any(key in instrument_name for key in ['AC', 'LISSTTau', 'LISSTTAU', 'LISST-Tau', 'TAU', 'CSTAR', 'BB', 'BB3', 'HBB']):
-                    instrument_class = []
-                    for instrument in self.instrument:
-                        class_name = type(self.instrument[instrument]).__name__  # Get class name
-                        instrument_class.append({'instrument': instrument, 'class': class_name})
-                
-                # Handle CDOM source selection for certain instruments
-                if any(key in instrument_name for key in ['AC', 'LISSTTau', 'LISSTTAU', 'LISST-Tau', 'TAU', 'CSTAR']):
-                    if (self.cfg['calibrate'][instrument_name]['interpolation_method'] == 'CDOM' and 
-                        self.cfg['calibrate'][instrument_name]['CDOM_source']):
-                        
-                        # Find CDOM table name
-                        cdom_tblname = list(self.instrument[self.cfg['calibrate'][instrument_name]['CDOM_source']]['prod'].keys())
-                        if not cdom_tblname:
-                            # Find another CDOM source from available classes
-                            self.cfg['calibrate'][instrument_name]['CDOM_source'] = next(
-                                (inst['instrument'] for inst in instrument_class if inst['class'] == 'CD' and
-                                 inst['instrument'] != self.cfg['calibrate'][instrument_name]['CDOM_source']),
-                                None
-                            )
-                        else:
-                            # Check if the time matches for the CDOM source
-                            time_match = (self.instrument[self.cfg['calibrate'][instrument_name]['CDOM_source']]['prod'][cdom_tblname[0]]['dt'] >= min(self.cfg['days2run']) and 
-                                          self.instrument[self.cfg['calibrate'][instrument_name]['CDOM_source']]['prod'][cdom_tblname[0]]['dt'] < max(self.cfg['days2run']) + 1)
-                            if not any(time_match):
-                                self.cfg['calibrate'][instrument_name]['CDOM_source'] = next(
-                                    (inst['instrument'] for inst in instrument_class if inst['class'] == 'CD' and
-                                     inst['instrument'] != self.cfg['calibrate'][instrument_name]['CDOM_source']),
-                                    None
-                                )
-                        cdom_tblname = list(self.instrument[self.cfg['calibrate'][instrument_name]['CDOM_source']]['prod'].keys())
-                        if not cdom_tblname:
-                            print('No CDOM data available for CDOM interpolation: using linear interpolation')
-                        cdom_source = self.instrument.get(self.cfg['calibrate'][instrument_name].get('CDOM_source'))
-                    else:
-                        cdom_source = None
-
-                # Handle TSG source selection for calibration
-                if any(key in instrument_name for key in ['AC', 'LISSTTau', 'LISSTTAU', 'LISST-Tau', 'TAU', 'CSTAR', 'BB', 'BB3', 'HBB']):
-                    if self.cfg['calibrate'][instrument_name].get('TSG_source'):
-                        tsg_tblname = list(self.instrument[self.cfg['calibrate'][instrument_name]['TSG_source']]['prod'].keys())
-                        if not tsg_tblname:
-                            self.cfg['calibrate'][instrument_name]['TSG_source'] = next(
-                                (inst['instrument'] for inst in instrument_class if inst['class'] == 'TSG' and
-                                 inst['instrument'] != self.cfg['calibrate'][instrument_name]['TSG_source']),
-                                None
-                            )
-                        else:
-                            # Check if the time matches for the TSG source
-                            time_match = (self.instrument[self.cfg['calibrate'][instrument_name]['TSG_source']]['prod'][tsg_tblname[0]]['dt'] >= min(self.cfg['days2run']) and
-                                          self.instrument[self.cfg['calibrate'][instrument_name]['TSG_source']]['prod'][tsg_tblname[0]]['dt'] < max(self.cfg['days2run']) + 1)
-                            if not any(time_match):
-                                self.cfg['calibrate'][instrument_name]['TSG_source'] = next(
-                                    (inst['instrument'] for inst in instrument_class if inst['class'] == 'TSG' and
-                                     inst['instrument'] != self.cfg['calibrate'][instrument_name]['TSG_source']),
-                                    None
-                                )
-                        tsg_tblname = list(self.instrument[self.cfg['calibrate'][instrument_name]['TSG_source']]['prod'].keys())
-                        if not tsg_tblname:
-                            print('No TSG data available for T/S correction: S/T are assumed to be constant')
-                        tsg_source = self.instrument.get(self.cfg['calibrate'][instrument_name].get('TSG_source'))
-                    else:
-                        tsg_source = None
-
-                # Call the calibration function based on the instrument model
-                instrument_model = self.instrument[instrument_name]['model']
-                if instrument_model == 'AC9':
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'], 
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.cfg['calibrate'][instrument_name]['interpolation_method'],
-                                                              cdom_source,
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'],
-                                                              self.cfg['calibrate'][instrument_name]['scattering_correction'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_ad_aphi'],
-                                                              tsg_source,
-                                                              self.cfg['min_nb_pts_per_cluster'],
-                                                              self.cfg['time_weight_for_cluster'])
-                elif instrument_model == 'ACS':
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.cfg['calibrate'][instrument_name]['interpolation_method'],
-                                                              cdom_source,
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'],
-                                                              self.cfg['calibrate'][instrument_name]['scattering_correction'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_ad_aphi'],
-                                                              tsg_source,
-                                                              self.cfg['min_nb_pts_per_cluster'],
-                                                              self.cfg['time_weight_for_cluster'])
-                elif instrument_model in ['BB', 'BB3', 'HBB']:
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('TSG_source')],
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'],
-                                                              self.cfg['calibrate'][instrument_name]['filt_method'])
-                elif instrument_model == 'FL':
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'],
-                                                              self.cfg['calibrate'][instrument_name]['filt_method'])
-                elif instrument_model == 'CD':
-                    self.instrument[instrument_name].calibrate(self.cfg['calibrate'][instrument_name]['compute_dissolved'])
-                elif instrument_model in ['LISST', 'LISST100X', 'LISST100x', 'LISST200X', 'LISST200x']:
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'])
-                elif instrument_model in ['LISSTTau', 'LISSTTAU', 'LISST-Tau', 'TAU']:
-                    self.instrument[instrument_name].calibrate(self.cfg['days2run'],
-                                                              self.cfg['calibrate'][instrument_name]['compute_dissolved'],
-                                                              self.cfg['calibrate'][instrument_name]['interpolation_method'],
-                                                              cdom_source,
-                                                              self.instrument[self.cfg['calibrate'][instrument_name].get('FLOW_source')],
-                                                              self.cfg['calibrate'][instrument_name]['di_method'])
-                else:
-                    self.instrument[instrument_name].calibrate()
-                    
-                    
-                    
+                getattr(self, stage)(instruments=[instrument_name])
+
+        def release_level(instrument_name, level):
+            if level not in keep:
+                self._release(instrument_name, level)
+
+        print(f'RUN: {len(graph)} stages of {len(instruments)} instruments on {workers} threads')
+        run_graph(graph, run, workers, specs.get, release_level if release else None)
+
+    def RunSharded(self, stages=('ReadRaw', 'Sync', 'QCRef', 'Split', 'AutoQC', 'Bin', 'Flag', 'calibrate'),
+                   chunk=None, margin=None, levels=('bin', 'flag', 'prod')):
+        """
+        Run stages on chunks of days2run, each in a worker process (see lib.shard),
+        and merge their levels in the instruments of this session.
+        Processes: parallel of [process] (-1 or inf: one per core); the stages
+        of a chunk run one at a time in its process.
+
+        Args:
+            stages (tuple): Stages run on each chunk (see Run); qcref ui mode
+                is not available (run QCRef in load mode).
+            chunk: 'day', 'week' or number of days per chunk (default: shard of [process]).
+            margin (float): Hours of data read before and after each chunk, for the
+                split buffers and filtered water events crossing midnight
+                (default: shard_margin of [process]).
+            levels (tuple): Levels of the instruments merged.
+        """
+        if 'QCRef' in stages and self.cfg.get('qcref', {}).get('mode') == 'ui':
+            raise ValueError('RunSharded: QCRef ui mode not available, select the switch periods first and use load mode.')
+        shards = shard_days(self.cfg['days2run'], chunk or self.cfg.get('shard', 'week'))
+        margin = timedelta(hours=self.cfg.get('shard_margin', 2) if margin is None else margin)
+        print(f'RUN SHARDED: {len(shards)} chunks of {shards[0][0]:%Y-%m-%d} to {shards[-1][1]:%Y-%m-%d}')
+        results = run_shards(_run_shard, shards, self.cfg.get('parallel', -1),
+                             self.config_path, self.cfg, tuple(stages), margin, tuple(levels))
+
+        self.InitInstruments()
+        for instrument_name in self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            for level in levels:
+                merged = merge([r.get(instrument_name, {}).get(level) for r in results])
+                if merged is not None:
+                    setattr(instrument, level, merged)
+        self._update_status('RunSharded', levels=levels)
+
+
+    def _checkpoint_store(self, instrument_name):
+        """Checkpoints of an instrument in path_wk/checkpoints, None if checkpoint of [process] is off."""
+        path_wk = getattr(self.instruments[instrument_name], 'cfg', {}).get('path_wk')
+        if not self.cfg.get('checkpoint') or not path_wk:
+            return None
+        return CheckpointStore(os.path.join(path_wk, CHECKPOINT_DIR, instrument_name))
+
+    def _level_keys(self, instrument_name, level):
+        """Day keys of a level: of its checkpoints if saved or loaded, else the hash of its content."""
+        keys = self.checkpoint_keys.get(instrument_name, {}).get(level)
+        return keys if keys is not None else day_hashes(getattr(self.instruments[instrument_name], level, None))
+
+    def _stage_keys(self, stage, instrument_name):
+        """Day keys of the levels of a stage: upstream levels, settings and code (see lib.checkpoint)."""
+        _, reads, modules = STAGE_CHECKPOINTS[stage]
+        if stage == 'Bin':
+            reads = (self._bin_level(instrument_name),)
+        instrument = self.instruments[instrument_name]
+        upstream = [self._level_keys(instrument_name, level) for level in reads]
+        split_ref = self.cfg.get('split', {}).get('reference', 'FLOW')
+        if stage == 'Split':
+            config = [self.cfg['split']['buffer'].get(instrument_name.lower()), split_ref]
+            upstream.append(day_hashes(self.instruments[split_ref].data) if split_ref != instrument_name else {})
+        elif stage == 'AutoQC':
+            config = self.cfg.get('qc', {})
+            if config.get('remove_when_flow_below') is not None and split_ref in self.instruments:
+                upstream.append(day_hashes(getattr(self.instruments[split_ref], 'data', None)))
+        elif stage == 'calibrate':
+            settings = self.calibration_settings(instrument_name)
+            # Content of the files, replaced at the same path they invalidate the products
+            files = [instrument.cfg.get('device_file'), instrument.cfg.get('psi_file')]
+            for filename, _ in (HTJS_MODELS.values() if instrument.cfg.get('htjs_enable') else ()):
+                try:
+                    files.append(resolve_path(filename, instrument.cfg.get('htjs_model_path')))
+                except FileNotFoundError:
+                    files.append(None)
+            config = [settings, instrument.cfg, file_hashes(files)]
+            for name, flag in ((settings.get('TSG_source'), 'TSG_source'), (settings.get('CDOM_source'), 'CDOM_source')):
+                source = self._calibration_source(name, flag)
+                source_name = next((n for n, i in self.instruments.items() if i is source), None)
+                upstream.append(self._level_keys(source_name, 'qc') if source_name else {})
+        elif stage == 'Bin':
+            cfg = self.cfg.get('bin', {})
+            config = [cfg.get('bin_size', {}).get(instrument_name.lower(), 1),
+                      {k: v for k, v in cfg.items() if k not in ('bin_size', 'skip')}]
+        else:
+            config = self.cfg.get('flag', {})
+        return stage_keys(upstream, config, code_version(type(instrument).__module__, *modules))
+
+    def _resume(self, stage, instrument_name):
+        """
+        Load the levels of a stage from the checkpoints of an earlier run, if all
+        its days are saved under the current keys (see lib.checkpoint).
+
+        Returns:
+            bool: True if loaded, the stage does not need to run.
+        """
+        store = self._checkpoint_store(instrument_name)
+        if store is None:
+            return False
+        keys = self._stage_keys(stage, instrument_name)
+        levels = {}
+        for level in STAGE_CHECKPOINTS[stage][0]:
+            levels[level] = store.load(level, keys) if keys else None
+            if levels[level] is None:
+                return False
+        instrument = self.instruments[instrument_name]
+        for level, value in levels.items():
+            setattr(instrument, level, value)
+            self.checkpoint_keys.setdefault(instrument_name, {})[level] = keys
+        print(f'{stage.upper()}: {instrument_name} loaded from checkpoints ({len(keys)} days)')
+        return True
+
+    def _save_checkpoint(self, stage, instrument_name):
+        """Save the levels of a stage just run, per day (see _resume)."""
+        store = self._checkpoint_store(instrument_name)
+        if store is None:
+            return
+        keys = self._stage_keys(stage, instrument_name)
+        instrument = self.instruments[instrument_name]
+        for level in STAGE_CHECKPOINTS[stage][0]:
+            store.save(level, getattr(instrument, level), keys)
+            self.checkpoint_keys.setdefault(instrument_name, {})[level] = keys
+
+    def Write(self, level='prod', product=None, instruments=None):
+        """
+        Write a level of each instrument, one pickle per day: prod in path_prod,
+        the other levels (raw, bin, qc, suspect, bad, flag) in path_wk, named
+        <prefix>_<level>[_<product>]_<YYYYMMDD>.pkl.
+
+        Args:
+            level (str): Level written.
+            product (str): 'part' (prod p, or tsw of the other levels), 'diss'
+                (prod g, or fsw), or None for all of the level.
+            instruments (list): Instruments, by default instruments2run.
+        """
+        if product is not None and product not in WRITE_PRODUCTS:
+            raise ValueError(f"Write: unknown product {product} ({', '.join(WRITE_PRODUCTS)})")
+        for instrument_name in instruments or self.cfg['instruments2run']:
+            instrument = self.instruments[instrument_name]
+            value = getattr(instrument, level, None)
+            if product is not None and isinstance(value, dict):
+                value = value.get(WRITE_PRODUCTS[product][0 if level == 'prod' else 1])
+            folder = instrument.cfg.get('path_prod' if level == 'prod' else 'path_wk')
+            if value is None or not folder:
+                print(f'WRITE: No {level} {product or ""} for {instrument_name}')
+                continue
+            name = '_'.join(x for x in (instrument.cfg.get('prefix') or instrument_name, level, product) if x)
+            paths = write_days(folder, name, value)
+            print(f'WRITE: {instrument_name} {level} {product or ""}: {len(paths)} days in {folder}')
+
 
+def _run_shard(days, config_path, cfg, stages, margin, levels):
+    """Stages of InLineAnalysis.RunSharded on one chunk of days, in a worker process.
+    Returns the levels of each instrument, trimmed to the days of the chunk."""
+    ila = InLineAnalysis.__new__(InLineAnalysis)
+    ila.config_path = config_path
+    ila.checkpoint_keys = {}
+    ila.status = {}
+    # Settings of the session, instruments from their configuration
+    _, ila.instruments = ila.load_config(config_path)
+    ila.cfg = dict(cfg, days2run=days, read_margin=margin, parallel=1)
+    print(f'SHARD: {days[0]:%Y-%m-%d} to {days[1]:%Y-%m-%d}')
+    ila.Run(stages, release=True, keep=levels)
+    return {name: {level: trim(getattr(ila.instruments[name], level, None), days) for level in levels}
+            for name in ila.cfg['instruments2run']}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Inlinino ACS csv parsers: row by row vs bulk decoding.
+
+Usage (from the Inlinanalysispy folder):
+    python -m benchmarks.bench_import_inlinino_acs [file.csv] [--rows N]
+
+Without a file, a synthetic ACS file (4 Hz, 86 c and 85 a wavelengths) is
+written to a temporary folder.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from lib.import_inlinino_base import import_inlinino_acs
+
+
+def write_synthetic_acs(path, n_rows, n_c=86, n_a=85, seed=0):
+    """Write an Inlinino ACS csv with random spectra, inf and nan values."""
+    rng = np.random.default_rng(seed)
+    c_wv = np.round(np.linspace(401.1, 749.8, n_c), 1)
+    a_wv = np.round(np.linspace(400.5, 750.2, n_a), 1)
+    time_acs = pd.date_range('2024-11-04', periods=n_rows, freq='250ms')
+    c = rng.normal(1, 0.5, (n_rows, n_c))
+    a = rng.normal(0.5, 0.3, (n_rows, n_a))
+    a[::97, 3] = np.inf
+    c[::131, 5] = -np.inf
+    a[::151, 7] = np.nan
+
+    with open(path, 'w') as f:
+        f.write('time,c,a,flag_outside_calibration_range\n')
+        f.write('yyyy/mm/dd HH:MM:SS.fff,1/m lambda=' + ' '.join(map(str, c_wv)) +
+                ',1/m lambda=' + ' '.join(map(str, a_wv)) + ',none\n')
+        for i in range(n_rows):
+            f.write('{},[{}],[{}],{}\n'.format(time_acs[i].strftime('%Y/%m/%d %H:%M:%S.%f')[:-3],
+                                               ' '.join(f'{x:.4f}' for x in c[i]),
+                                               ' '.join(f'{x:.4f}' for x in a[i]),
+                                               i % 50 == 0))
+
+
+def timeit(fun, repeat):
+    """Best wall time of fun over repeat runs, and its last output."""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fun()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', nargs='?', help='Inlinino ACS csv file')
+    parser.add_argument('--rows', type=int, default=50000, help='rows of the synthetic file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f = args.file
+        if f is None:
+            f = os.path.join(tmp, 'ACS_synthetic.csv')
+            write_synthetic_acs(f, args.rows)
+        print(f'File: {f} ({os.path.getsize(f) / 1e6:.1f} MB)')
+
+        t_rows, ref = timeit(lambda: import_inlinino_acs(f, bulk=False), args.repeat)
+        t_bulk, out = timeit(lambda: import_inlinino_acs(f, bulk=True), args.repeat)
+        pd.testing.assert_frame_equal(ref, out)
+
+    print(f'{len(out)} rows x {out.shape[1]} columns, outputs identical')
+    print(f'row by row: {t_rows:7.3f} s ({len(out) / t_rows:9.0f} rows/s)')
+    print(f'bulk:       {t_bulk:7.3f} s ({len(out) / t_bulk:9.0f} rows/s)')
+    print(f'speed-up:   {t_rows / t_bulk:7.2f} x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ACS calibration with the linear interpolation method
+(ACS.process_acs_linear), against a per wavelength np.interp loop.
+
+Usage (from the Inlinanalysispy folder):
+    python -m benchmarks.bench_process_acs_linear [--days N]
+
+Synthetic 1 min bins (86 c and 85 a wavelengths): total water all the time
+but 10 min of filtered water per hour, DI water once a day.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from instruments.ACS import ACS
+from lib.acs_processing import REFERENCE_WAVELENGTH, scattering_correction
+
+
+def synthetic_bins(index, lambda_a, lambda_c, rng):
+    """Binned ACS data (avg of lib.binning.bin_data) at index."""
+    a = 0.1 * np.exp(-0.01 * (lambda_a - 400)) + rng.normal(0, 0.005, (len(index), len(lambda_a)))
+    c = 0.3 * (lambda_c / 532) ** -0.8 + rng.normal(0, 0.005, (len(index), len(lambda_c)))
+    columns = pd.MultiIndex.from_tuples([('avg', wl) for wl in np.r_[lambda_a, lambda_c]])
+    return pd.DataFrame(np.hstack([a, c]), index=index, columns=columns)
+
+
+def reference(acs, scattering_corr):
+    """ap and cp with one np.interp per wavelength."""
+    tsw, fsw = acs.bin['tsw']['avg'], acs.bin['fsw']['avg']
+    x, xf = tsw.index.asi8.astype(float), fsw.index.asi8.astype(float)
+    p = tsw.to_numpy() - np.column_stack([np.interp(x, xf, fsw.iloc[:, k].to_numpy(), left=np.nan, right=np.nan)
+                                          for k in range(fsw.shape[1])])
+    n_a = np.argmax(np.diff(tsw.columns.to_numpy(dtype=float)) < 0) + 1
+    lambda_a, lambda_c = tsw.columns[:n_a].to_numpy(dtype=float), tsw.columns[n_a:].to_numpy(dtype=float)
+    ap, cp = p[:, :n_a], p[:, n_a:]
+    ap_ref = np.array([np.interp(REFERENCE_WAVELENGTH, lambda_a, row) for row in ap])
+    cp_ref = np.array([np.interp(REFERENCE_WAVELENGTH, lambda_c, row) for row in cp])
+    cp_a = np.array([np.interp(lambda_a, lambda_c, row) for row in cp])
+    return scattering_correction(ap, cp_a, ap_ref, cp_ref, scattering_corr), cp
+
+
+def timeit(fun, repeat):
+    """Best wall time of fun over repeat runs, and its last output."""
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fun()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=30, help='days of synthetic bins')
+    parser.add_argument('--scattering', default='ZaneveldRottgers_blended')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    lambda_a, lambda_c = np.round(np.linspace(400.5, 750.2, 85), 1), np.round(np.linspace(401.1, 749.8, 86), 1)
+    index = pd.date_range('2024-11-01', periods=args.days * 1440, freq='1min')
+    filtered = index.minute < 10
+    acs = ACS({'device_file': 'synthetic.dev'})
+    acs.bin = {'tsw': synthetic_bins(index[~filtered], lambda_a, lambda_c, rng),
+               'fsw': synthetic_bins(index[filtered], lambda_a, lambda_c, rng),
+               'diw': synthetic_bins(index[::1440], lambda_a, lambda_c, rng)}
+    calibrate = lambda: acs.process_acs_linear(None, True, {}, {'a': [], 'c': []}, 'best_di',
+                                               args.scattering, True)
+
+    t_ref, (ap, cp) = timeit(lambda: reference(acs, args.scattering), 1)
+    t_vec, prod = timeit(calibrate, args.repeat)
+    np.testing.assert_allclose(prod['p']['ap'].to_numpy(), ap, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(prod['p']['cp'].to_numpy(), cp, rtol=1e-9, atol=1e-12)
+
+    print(f'{args.days} days: {len(acs.bin["tsw"])} total, {len(acs.bin["fsw"])} filtered water bins, '
+          f'ap and cp identical')
+    print(f'per wavelength loop (ap, cp):          {t_ref:7.3f} s')
+    print(f'process_acs_linear (ap, cp, ad, aphi, ag, cg): {t_vec:7.3f} s')
+    print(f'speed-up: {t_ref / t_vec:7.2f} x')
+
+
+if __name__ == '__main__':
+    main()
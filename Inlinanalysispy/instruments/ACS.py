@@ -7,9 +7,19 @@ Created on Tue Jan  7 15:35:50 2025
 """
 
 import os
-from scipy.io import loadmat
-from lib.i_read import i_read
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from functools import partial
+from lib.i_read import i_read, i_read_iter
 from lib.import_inlinino_base import import_inlinino_acs
+from lib.tail_read import TailReader, list_raw_files
+from lib.spectra import Spectra
+from lib.split import split_data
+from lib.acs_device import read_device_file, read_psi_table, psi_on_wavelengths, ts_signal
+from lib.acs_processing import acs_arrays, interp_filtered, interp_time, particulate, dissolved, to_frame
+from lib.cdom_interpolation import cdom_signal, interp_cdom
+from lib.htjs_model import load_models, evaluate
 
 class ACS:
     """
@@ -31,42 +41,126 @@ class ACS:
         self.lambda_c = []
         self.lambda_a = []
         self.cal_param = {}
-        self.modelG50 = None
-        self.modelmphi = None
+        self.htjs_model = None  # G50 and mphi models, see lib.htjs_model
         self.logger = self.cfg.get('logger', 'Compass_2.1rc_scheduled')
+        self.data = None
+        self.raw = {'tsw': None, 'fsw': None, 'diw': None}
+        self.bin = {'tsw': None, 'fsw': None, 'diw': None}
+        self.qc = {'tsw': None, 'fsw': None, 'diw': None}
+        self.bad = {'tsw': None, 'fsw': None, 'diw': None}
+        self.suspect = {'tsw': None, 'fsw': None, 'diw': None}
+        self.flag = {'tsw': None, 'fsw': None, 'diw': None}  # Flag codes of the bins, see lib.flag
+        self.tail = None  # TailReader following the raw files, see refresh_raw
 
 
-    def read_device_file(self):
+    def read_device_file(self, force=False):
         """
-        Reads the device file to set wavelengths and calibration parameters.
+        Reads the device file to set wavelengths and calibration parameters, once
+        per instance (the parsed files are also cached on their content, see
+        lib.acs_device).
+        :param force: Read the device file again.
         """
-        # Placeholder for the actual import function
+        if self.cal_param and not force:
+            return
         self.lambda_c, self.lambda_a, self.cal_param = self.import_acs_device_file(self.device_file)
         if not self.lambda_ref:
             self.lambda_ref = self.lambda_a
 
     def load_htjsetal2021_model(self):
         """
-        Loads models for G50 and mphi from Haëntjens et al. 2021.
+        Loads models for G50 and mphi from Haëntjens et al. 2021, from the folder
+        htjs_model_path of the configuration or the package data (read once per
+        process, see lib.htjs_model).
         """
-        self.modelG50 = loadmat('HTJS20_LinearRegression_5features.mat')['model_G50']
-        self.modelmphi = loadmat('HTJS20_LinearRegression_5P-mphi.mat')['model_mphi']
+        self.htjs_model = load_models(self.cfg.get('htjs_model_path'))
 
-    def read_raw(self, days2run, force_import, write):
+    def phytoplankton_size(self, p, dtype=None):
+        """
+        G50 and mphi of the ap spectra of a product (see lib.htjs_model).
+        :param p: Particulate product (prod['p']).
+        :param dtype: float type of the evaluation (htjs_dtype of the configuration, float64 by default).
+        :return: DataFrame of G50 and mphi indexed as p.
+        """
+        if self.htjs_model is None:
+            self.load_htjsetal2021_model()
+        dtype = dtype or self.cfg.get('htjs_dtype', 'float64')
+        size = evaluate(self.htjs_model, p['ap'].to_numpy(), p['ap'].columns.to_numpy(dtype=float), np.dtype(dtype))
+        return pd.DataFrame(size, index=p.index)
+
+    def read_raw(self, days2run, force_import, write, parallel=-1, stream=False, margin=None, as_spectra=False):
         """
         Reads raw data using the configured logger.
         :param days2run: List of days to process.
         :param force_import: Force re-import of data.
         :param write: Whether to write processed data.
+        :param parallel: Number of processes importing raw files (-1 or inf for all cores).
+        :param stream: Return a generator of daily DataFrames (see i_read_iter)
+            instead of loading all days in self.data.
+        :param margin: Also load the data this close (timedelta) to the days (see i_read).
+        :param as_spectra: Load the data as a Spectra (see lib.spectra) instead of
+            a DataFrame, converting one day at a time (margin is not read).
         """
         self.read_device_file()
 
         if self.logger == 'Inlinino_base':
-            self.data = i_read(import_inlinino_acs, self.cfg["path_raw"], self.cfg["path_wk"], 
-                                    self.cfg["prefix"], days2run, 'Inlinino')
+            reader = i_read_iter if stream or as_spectra else partial(i_read, read_margin=margin)
+            data = reader(import_inlinino_acs, self.cfg["path_raw"], self.cfg["path_wk"],
+                          self.cfg["prefix"], days2run, 'Inlinino', force=force_import,
+                          nowrite=not write, parallel_flag=parallel,
+                          cache=self.cfg.get('cache_format', 'npy'),
+                          checksum=self.cfg.get('cache_checksum', False))
         else:
             raise ValueError(f'FTH: Unknown logger: {self.logger}')
 
+        if as_spectra:
+            data = (Spectra.from_dataframe(day) for day in data)
+            if not stream:
+                days = list(data)
+                self.data = Spectra.concat(days) if days else None
+                self._follow(days2run, self.data.dt if self.data is not None else [])
+                return
+        if stream:
+            return data
+        self.data = data
+        self._follow(days2run, data.index)
+
+    def _follow(self, days2run, index):
+        """Record the raw files of days2run as read up to index (times of the
+        rows read), for refresh_raw to parse only the lines appended later."""
+        self.tail = TailReader(import_inlinino_acs)
+        self.tail.mark_read(list_raw_files(self.cfg["path_raw"], self.cfg["prefix"], days2run, 'Inlinino'), index)
+
+    def refresh_raw(self, days2run, verbose=False):
+        """
+        Appends the data written to the raw files since read_raw or the last call.
+        Only the lines appended to the raw files are parsed (see lib.tail_read).
+        :param days2run: List of days to follow.
+        :param verbose: Print the number of new rows of each file.
+        """
+        if self.logger != 'Inlinino_base':
+            raise ValueError(f'ACS: Tail-follow not supported for logger: {self.logger}')
+        if self.tail is None:
+            self.tail = TailReader(import_inlinino_acs)
+        files = list_raw_files(self.cfg["path_raw"], self.cfg["prefix"], days2run, 'Inlinino')
+        if isinstance(self.data, Spectra):
+            new = self.tail.update(None, files, verbose)
+            if new is not None and len(new):
+                # Replaces the rows over the time range of new, as merge_rows
+                new = Spectra.from_dataframe(new)
+                start = np.searchsorted(self.data.dt, new.dt[0], 'left')
+                stop = np.searchsorted(self.data.dt, new.dt[-1], 'right')
+                self.data = Spectra.concat([self.data[:start], new, self.data[stop:]])
+        else:
+            self.data = self.tail.update(self.data, files, verbose)
+
+
+    def Split(self, reference, buffer):
+        """
+        Splits data in total (raw['tsw']) and filtered (raw['fsw']) water.
+        :param reference: Instrument giving the switch periods (FLOW, see lib.split).
+        :param buffer: Seconds removed at the start of filtered and total periods.
+        """
+        self.raw['tsw'], self.raw['fsw'] = split_data(self.data, reference.switch_periods(), buffer)
 
     def read_raw_di(self, days2run, force_import, write):
         """
@@ -87,22 +181,29 @@ class ACS:
         """
         Performs calibration based on the specified parameters.
         """
+        self.read_device_file()
         lambda_params = {'ref': self.lambda_ref, 'a': self.lambda_a, 'c': self.lambda_c}
         SWT_constants = {'SWITCH_FILTERED': SWT.SWITCH_FILTERED, 'SWITCH_TOTAL': SWT.SWITCH_TOTAL}
 
-        self.load_htjsetal2021_model()
+        # G50 and mphi are opt-in, their features are not validated (see lib.htjs_model);
+        # models missing or of another layout raise before the products are computed
+        htjs = self.cfg.get('htjs_enable', False)
+        if htjs:
+            self.load_htjsetal2021_model()
 
         if interpolation_method == 'linear':
             self.prod = self.process_acs_linear(days2run, compute_dissolved, SWT_constants, lambda_params,
-                                                di_method, scattering_corr, compute_ad_aphi)
+                                                di_method, scattering_corr, compute_ad_aphi, TSG)
         elif interpolation_method == 'CDOM':
-            if not CDOM or not hasattr(CDOM, 'qc') or not CDOM.qc.get('tsw'):
+            if not CDOM or not hasattr(CDOM, 'qc') or CDOM.qc.get('tsw') is None:
                 raise ValueError('No CDOM data loaded: required for CDOM interpolation.')
             self.prod = self.process_acs_cdom(days2run, compute_dissolved, SWT_constants, lambda_params,
                                               CDOM, di_method, scattering_corr, compute_ad_aphi,
                                               TSG, min_nb_pts_per_cluster, time_weight_for_cluster)
         else:
             raise ValueError('Method not supported.')
+        if htjs:
+            self.prod['size'] = self.phytoplankton_size(self.prod['p'])
 
     # Helper methods
     @staticmethod
@@ -118,14 +219,122 @@ class ACS:
         pass
 
     def import_acs_device_file(self, device_file):
-        """Placeholder for the ACS device file importer."""
-        # Replace with actual logic to parse the device file.
-        return [], [], {}
+        """
+        Parses an ACS device file (see lib.acs_device).
+        :param device_file: Path of the .dev file.
+        :return: c and a wavelengths, and calibration parameters: the fields of
+            the device file, and the psi of the temperature and salinity correction
+            on the wavelengths (psi_t_a, psi_s_a, psi_t_c, psi_s_c) when psi_file
+            is configured.
+        """
+        dev = read_device_file(device_file)
+        cal_param = dev._asdict()
+        psi_file = self.cfg.get('psi_file')
+        if psi_file:
+            cal_param['psi'] = psi_on_wavelengths(read_psi_table(psi_file), dev.lambda_a, dev.lambda_c)
+        return list(dev.lambda_c), list(dev.lambda_a), cal_param
 
-    def process_acs_linear(self, *args, **kwargs):
-        """Placeholder for linear interpolation processing."""
-        pass
+    def process_acs_linear(self, days2run, compute_dissolved, SWT_constants, lambda_params, di_method,
+                           scattering_corr, compute_ad_aphi, TSG=None):
+        """
+        Calibrates the binned total and filtered water with the linear interpolation
+        method: the filtered water is interpolated linearly in time on the total water
+        bins (see lib.acs_processing).
+        :param days2run: Days of total water calibrated (None for all the bins).
+        :param compute_dissolved: Also compute ag and cg from the DI water (bin['diw']).
+        :param SWT_constants: Switch positions (unused, the data is already split).
+        :param lambda_params: Wavelengths of the device file ('a', 'c'), the
+            wavelengths of the binned data are used when empty.
+        :param di_method: DI water of each filtered bin, 'best_di' (nearest) or 'interpolate'.
+        :param scattering_corr: Residual scattering correction (see scattering_correction).
+        :param compute_ad_aphi: Also compute ad and aphi.
+        :param TSG: TSG_source instrument for the residual temperature and salinity
+            correction (needs the psi of psi_file), None for no correction.
+        :return: Dict of products: 'p' (ap, cp and ad, aphi) and 'g' (ag, cg),
+            DataFrames indexed by time with (product, wavelength) columns.
+        """
+        return self._process_bins(days2run, compute_dissolved, lambda_params, di_method, scattering_corr,
+                                  compute_ad_aphi, interp_filtered, TSG)
 
-    def process_acs_cdom(self, *args, **kwargs):
-        """Placeholder for CDOM interpolation processing."""
-        pass
+    def process_acs_cdom(self, days2run, compute_dissolved, SWT_constants, lambda_params, CDOM, di_method,
+                         scattering_corr, compute_ad_aphi, TSG, min_nb_pts_per_cluster, time_weight_for_cluster):
+        """
+        Calibrates the binned total and filtered water with the CDOM interpolation
+        method: the filtered water of each total water bin follows the CDOM
+        fluorescence of the CDOM_source instrument (see lib.cdom_interpolation).
+        Bins without CDOM fall back on the linear interpolation method.
+        :param CDOM: CDOM_source instrument (its qc tsw and fsw are used).
+        :param TSG: TSG_source instrument (see process_acs_linear).
+        :param min_nb_pts_per_cluster: Smallest number of filter events of a cluster.
+        :param time_weight_for_cluster: Weight of one day against one robust
+            standard deviation of CDOM when clustering the filter events.
+        Other parameters and output as process_acs_linear.
+        """
+        t_cdom, cdom = cdom_signal([CDOM.qc.get('tsw'), CDOM.qc.get('fsw')], CDOM.cfg.get('cdom_variable'))
+
+        def filtered(t_tsw, t_fsw, a_fsw, c_fsw):
+            a, c, n_events, n_clusters = interp_cdom(t_tsw, t_fsw, a_fsw, c_fsw, t_cdom, cdom,
+                                                     int(min_nb_pts_per_cluster), float(time_weight_for_cluster))
+            missing = np.isnan(a).all(axis=1) & np.isnan(c).all(axis=1)
+            print(f'ACS: CDOM interpolation, {n_events} filter events in {n_clusters} clusters, '
+                  f'{int(missing.sum())}/{len(t_tsw)} bins without CDOM interpolated linearly')
+            if missing.any():
+                a[missing], c[missing] = interp_filtered(t_tsw[missing], t_fsw, a_fsw, c_fsw)
+            return a, c
+
+        return self._process_bins(days2run, compute_dissolved, lambda_params, di_method, scattering_corr,
+                                  compute_ad_aphi, filtered, TSG)
+
+    def _process_bins(self, days2run, compute_dissolved, lambda_params, di_method, scattering_corr,
+                      compute_ad_aphi, filtered, TSG=None):
+        """
+        Particulate (and dissolved) products of the binned data, the filtered water
+        of the total water bins given by filtered(t_tsw, t_fsw, a_fsw, c_fsw).
+        """
+        if self.bin['tsw'] is None or self.bin['fsw'] is None:
+            raise ValueError('ACS: No binned total and filtered water to calibrate.')
+        t_tsw, a_tsw, c_tsw, lambda_a, lambda_c = acs_arrays(self.bin['tsw'])
+        t_fsw, a_fsw, c_fsw, _, _ = acs_arrays(self.bin['fsw'])
+        if len(lambda_params.get('a', [])) == len(lambda_a) and len(lambda_params.get('c', [])) == len(lambda_c):
+            lambda_a = np.asarray(lambda_params['a'], dtype=float)
+            lambda_c = np.asarray(lambda_params['c'], dtype=float)
+        if days2run:
+            start = np.datetime64(min(days2run), 'ns').astype(np.int64)
+            end = np.datetime64(max(days2run) + timedelta(days=1), 'ns').astype(np.int64)
+            sel = slice(np.searchsorted(t_tsw, start), np.searchsorted(t_tsw, end))
+            t_tsw, a_tsw, c_tsw = t_tsw[sel], a_tsw[sel], c_tsw[sel]
+
+        a_dis, c_dis = filtered(t_tsw, t_fsw, a_fsw, c_fsw)
+        p = particulate(a_tsw, c_tsw, a_dis, c_dis, lambda_a, lambda_c, scattering_corr, compute_ad_aphi,
+                        self._ts_differences(TSG, t_tsw, t_fsw))
+        wavelengths = {'ap': lambda_a, 'cp': lambda_c, 'ad': lambda_a, 'aphi': lambda_a}
+        prod = {'p': to_frame(t_tsw, p, wavelengths)}
+        if compute_dissolved:
+            if self.bin['diw'] is None or not len(self.bin['diw']):
+                print('ACS: No DI water binned, ag and cg not computed.')
+            else:
+                t_diw, a_diw, c_diw, _, _ = acs_arrays(self.bin['diw'])
+                g = dissolved(t_fsw, a_fsw, c_fsw, t_diw, a_diw, c_diw, di_method)
+                prod['g'] = to_frame(t_fsw, g, {'ag': lambda_a, 'cg': lambda_c})
+        return prod
+
+    def _ts_differences(self, TSG, t_tsw, t_fsw):
+        """
+        Temperature and salinity of the total water bins minus those of their
+        filtered water (interpolated linearly in time), and psi, for the residual
+        correction of particulate (None without TSG or psi).
+        """
+        if TSG is None or 'psi' not in self.cal_param:
+            return None
+        qc = getattr(TSG, 'qc', {})
+        t_ts, t, s = ts_signal([qc.get('tsw'), qc.get('fsw')], TSG.cfg.get('temperature_variable'),
+                               TSG.cfg.get('salinity_variable'))
+        if not len(t_ts):
+            print('ACS: No TSG data, no temperature and salinity correction.')
+            return None
+        ts = np.column_stack([t, s])
+        valid = np.isfinite(ts).all(axis=1)
+        at_tsw = interp_time(t_tsw, t_ts[valid], ts[valid])
+        at_fsw = interp_time(t_tsw, t_fsw, interp_time(t_fsw, t_ts[valid], ts[valid]))
+        delta = at_tsw - at_fsw
+        return delta[:, 0], delta[:, 1], self.cal_param['psi']
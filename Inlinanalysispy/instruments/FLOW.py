@@ -8,9 +8,11 @@ Created on Tue Jan  7 16:28:03 2025
 
 import numpy as np
 import pandas as pd
-from datetime import datetime
-from lib.i_read import i_read
+from functools import partial
+from lib.i_read import i_read, i_read_iter
 from lib.import_inlinino_base import import_inlinino_flow
+from lib.tail_read import TailReader, list_raw_files
+from lib.split import switch_periods, split_data, merge_intervals, in_periods
 # Assuming that FLOW is the base class for this instrument
 class FLOW:
     SAMPLING_FREQUENCY = 1  # Hz, equivalent to the MATLAB constant
@@ -33,79 +35,187 @@ class FLOW:
   
         # Initialize attributes as dictionaries
         self.data = None  # Example: could be a NumPy array or DataFrame
+        self.tail = None  # TailReader following the raw files, see refresh_raw
+        self._periods = None  # Data and switch periods computed from it, see switch_periods
         self.raw = {
             'tsw': None,  # Placeholder, replace with actual data
+            'fsw': None,
             'diw': None
         }
         self.bin = {
             'tsw': None,
+            'fsw': None,
             'diw': None
         }
         self.qc = {
             'tsw': None,
+            'fsw': None,
             'diw': None
         }
         self.bad = {
             'tsw': None,
+            'fsw': None,
             'diw': None
         }
         self.suspect = {
             'tsw': None,
+            'fsw': None,
+            'diw': None
+        }
+        self.flag = {  # Flag codes of the bins, see lib.flag
+            'tsw': None,
+            'fsw': None,
             'diw': None
         }
             
   
 
-    def read_raw(self, days2run, force_import, write):
-        """Pre-Process: Read raw data for FTH."""
+    def read_raw(self, days2run, force_import, write, parallel=-1, stream=False, margin=None):
+        """Pre-Process: Read raw data for FTH.
+
+        With stream=True, return a generator of daily DataFrames (see
+        i_read_iter) instead of loading all days in self.data. margin
+        (timedelta) also loads the data this close to the days (see i_read).
+        """
         if self.logger == 'Inlinino_base':
-            self.data = i_read(import_inlinino_flow, self.cfg["path_raw"], self.cfg["path_wk"], 
-                                    self.cfg["prefix"], days2run, 'Inlinino')
+            reader = i_read_iter if stream else partial(i_read, read_margin=margin)
+            data = reader(import_inlinino_flow, self.cfg["path_raw"], self.cfg["path_wk"],
+                          self.cfg["prefix"], days2run, 'Inlinino', force=force_import,
+                          nowrite=not write, parallel_flag=parallel,
+                          cache=self.cfg.get('cache_format', 'npy'),
+                          checksum=self.cfg.get('cache_checksum', False))
         else:
             raise ValueError(f'FTH: Unknown logger: {self.logger}')
 
+        if stream:
+            return data
+        self.data = data
+        # The next refresh_raw parses only the lines appended from now on
+        self.tail = TailReader(import_inlinino_flow, rewind_last_bin=True)
+        self.tail.mark_read(list_raw_files(self.cfg["path_raw"], self.cfg["prefix"], days2run, 'Inlinino'),
+                            data.index)
+
+    def refresh_raw(self, days2run, verbose=False):
+        """Pre-Process: Append the data written to the raw files since the last call.
+
+        Only the lines appended to the raw files since read_raw or the last call
+        are parsed (see lib.tail_read), the last minute is parsed again at the
+        next call as it may be incomplete.
+        """
+        if self.logger != 'Inlinino_base':
+            raise ValueError(f'FTH: Tail-follow not supported for logger: {self.logger}')
+        if self.tail is None:
+            self.tail = TailReader(import_inlinino_flow, rewind_last_bin=True)
+        files = list_raw_files(self.cfg["path_raw"], self.cfg["prefix"], days2run, 'Inlinino')
+        self.data = self.tail.update(self.data, files, verbose)
+
+
+    def switch_periods(self):
+        """Total and filtered periods of the switch position (see lib.split).
+
+        Computed once for the data loaded and shared by all instruments split
+        on this reference; replacing self.data (read_raw, apply_user_input)
+        computes them again.
+        """
+        if self.data is None or len(self.data) == 0:
+            raise ValueError('FLOW: raw data not loaded')
+        if self._periods is None or self._periods[0] is not self.data:
+            dt = pd.DatetimeIndex(self.data.index).as_unit('ns').asi8
+            self._periods = (self.data, switch_periods(dt, self.data['swt'].to_numpy(dtype=float),
+                                                       self.SWITCH_FILTERED, self.SWITCH_TOTAL))
+        return self._periods[1]
+
+    def Split(self, reference, buffer):
+        """Split data in total (raw['tsw']) and filtered (raw['fsw']) water
+        with the switch periods of reference, removing buffer (filtered, total)
+        seconds at the start of each period."""
+        self.raw['tsw'], self.raw['fsw'] = split_data(self.data, reference.switch_periods(), buffer)
 
     def apply_user_input(self, user_selection, mode):
-        """Correct part of switch data based on user input."""
+        """Correct part of switch data based on user input (see apply_user_inputs)."""
+        self.apply_user_inputs({mode: user_selection})
+
+    def apply_user_inputs(self, selections):
+        """
+        Correct the switch position over all user selections at once.
+
+        Rows within the selections are replaced by rows at SAMPLING_FREQUENCY
+        with the switch position of the selection and the other variables
+        interpolated from the data, in a single pass over the data whatever
+        the number of selections.
+
+        Args:
+            selections (dict or list): (start, end) selections of each mode
+                ('total', 'filtered'), as POSIX seconds (UTC) or datetime64,
+                or list of (mode, selections) applied in order (e.g. QCRef
+                sessions, see lib.user_selection.load_selections). Where
+                selections overlap, the last one wins.
+        """
         print('User input processing...')
-        for start, end in user_selection:
-            dt_st = datetime.fromtimestamp(start)  # Start date
-            dt_end = datetime.fromtimestamp(end)  # End date
-            dt = np.arange(dt_st, dt_end, np.timedelta64(1, 's') * (1 / self.SAMPLING_FREQUENCY))
-
-            if not self.data.empty:
-                self.data['dt'] = pd.to_datetime(self.data['dt'], unit='s')
-                self.data = self.data.loc[~self.data['dt'].duplicated()]
+        if self.data is None or self.data.empty:
+            raise ValueError('FLOW raw data not loaded')
+        switch = {'total': self.SWITCH_TOTAL, 'filtered': self.SWITCH_FILTERED}
+        selections = list(selections.items()) if isinstance(selections, dict) else list(selections)
+        if {mode for mode, _ in selections} - set(switch):
+            raise ValueError('Unknown mode.')
+
+        data = self.data.sort_index() if not self.data.index.is_monotonic_increasing else self.data
+        data = data.loc[~data.index.duplicated()]
+        t = pd.DatetimeIndex(data.index).as_unit('ns').asi8
+        unit = pd.DatetimeIndex(data.index).unit
+        resolution = pd.Timedelta(1, unit=unit).value
+        step = np.int64(round(1e9 / self.SAMPLING_FREQUENCY))
+
+        times, positions, all_starts, all_ends = [], [], [], []
+        for mode, selection in selections:
+            selection = np.asarray(selection)
+            if not selection.size:
+                continue
+            selection = selection.reshape(-1, 2)
+            if selection.dtype.kind == 'M':
+                bounds = selection.astype('datetime64[ns]').view(np.int64)
             else:
-                raise ValueError(f'{self.model} raw data not loaded')
-
-            # Interpolate flow rate data
-            spd_vars = [col for col in self.data.columns if 'spd' in col]
-            interp_spd = np.full((len(dt), len(spd_vars)), np.nan)
-
-            for i, spd_var in enumerate(spd_vars):
-                interp_spd[:, i] = np.interp(dt, self.data['dt'].values, self.data[spd_var].values)
-
-            # Remove existing data within the selection period
-            self.data = self.data.loc[~self.data['dt'].between(start, end)]
-
-            # Adjust the dataframe to include interpolated data
-            varnam = ['dt', 'swt', 'spd1', 'spd2']
-            if len(varnam) == 3:
-                varnam = ['dt', 'swt', 'spd1', 'spd2']
-                self.data['spd2'] = np.nan
-
-            # Append the new data based on the mode
-            if mode == 'total':
-                new_data = pd.DataFrame(np.column_stack([dt, np.ones_like(dt) * self.SWITCH_TOTAL, interp_spd]), columns=varnam)
-                self.data = pd.concat([self.data, new_data])
-            elif mode == 'filtered':
-                new_data = pd.DataFrame(np.column_stack([dt, np.ones_like(dt) * self.SWITCH_FILTERED, interp_spd]), columns=varnam)
-                self.data = pd.concat([self.data, new_data])
+                bounds = np.round(selection.astype(float) * 1e9).astype(np.int64)
+            # Bounds at the resolution of the index (e.g. ms for parsed times)
+            starts, ends = merge_intervals(-(-bounds[:, 0] // resolution) * resolution,
+                                           bounds[:, 1] // resolution * resolution)
+            # Synthetic rows of all intervals: start, start + step, ... before end
+            counts = np.maximum(-(-(ends - starts) // step), 0)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            new_t = np.repeat(starts, counts) + offsets * step
+            # Rows of previous selections within these intervals are replaced
+            for k, previous in enumerate(times):
+                keep = ~in_periods(previous, starts, ends + 1)
+                times[k], positions[k] = previous[keep], positions[k][keep]
+            times.append(new_t)
+            positions.append(np.full(len(new_t), switch[mode], dtype=float))
+            all_starts.append(starts)
+            all_ends.append(ends)
+        if not times:
+            print('Done')
+            return
+
+        # Rows of the data within any selection (both ends included) are replaced
+        starts, ends = merge_intervals(np.concatenate(all_starts), np.concatenate(all_ends))
+        kept = data.loc[~in_periods(t, starts, ends + 1)]
+        new_t, positions = np.concatenate(times), np.concatenate(positions)
+        order = np.argsort(new_t, kind='stable')
+        new_t, positions = new_t[order], positions[order]
+
+        index = pd.DatetimeIndex(new_t.view('datetime64[ns]'), name=data.index.name).as_unit(unit)
+        new_data = pd.DataFrame(index=index)
+        for col in data.columns:
+            if col == 'swt':
+                new_data[col] = positions
+            elif col == 'dt':
+                new_data[col] = index
+            elif pd.api.types.is_numeric_dtype(data[col]):
+                new_data[col] = np.interp(new_t, t, data[col].to_numpy(dtype=float))
             else:
-                raise ValueError('Unknown mode.')
+                new_data[col] = np.nan
 
-        self.data = self.data.sort_values(by='dt')
+        # Both tables are sorted, the stable merge sort only merges the two runs
+        self.data = pd.concat([kept, new_data]).sort_index(kind='mergesort')
         print('Done')
 
     # Additional methods like i_read, import_flow_control, etc., should be defined here or inherited from the base class
@@ -1,7 +1,81 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Created on Tue Jan  7 15:36:04 2025
+Registry of the instrument classes.
 
-@author: clemence
+Instruments are resolved from the model of their section of the configuration
+(e.g. [instruments][FLOW] model = ADU200), not from the name of the section,
+so that instruments named after their serial number (SBE384504970286,
+SUVF6244) find their class. The table only holds 'module:Class' strings: a
+module is imported the first time one of its models is used, keeping the
+start of a session free of the instruments (and their dependencies) it does
+not run.
+
+Classes of other packages are registered with the entry point group
+pylias.instruments (name: model, value: 'module:Class'), read only for models
+missing from the table, or at run time with register.
 """
+import importlib
+
+# Class of each model, 'module:Class'
+INSTRUMENT_MODELS = {
+    'ACS': 'instruments.ACS:ACS',
+    'ADU200': 'instruments.FLOW:FLOW',
+    'FLOW': 'instruments.FLOW:FLOW',
+    'FTH': 'instruments.FLOW:FLOW',
+}
+ENTRY_POINT_GROUP = 'pylias.instruments'
+# Classes imported, by 'module:Class'
+_LOADED = {}
+
+
+def register(model, target):
+    """Register the class of a model: a class, or 'module:Class' imported when first used."""
+    INSTRUMENT_MODELS[model] = target
+
+
+def _entry_point(model):
+    from importlib.metadata import entry_points
+    return next((ep.value for ep in entry_points(group=ENTRY_POINT_GROUP) if ep.name == model), None)
+
+
+def _load(target):
+    if not isinstance(target, str):
+        return target
+    if target not in _LOADED:
+        module, _, name = target.partition(':')
+        _LOADED[target] = getattr(importlib.import_module(module), name)
+    return _LOADED[target]
+
+
+def instrument_class(name, model=None):
+    """
+    Class of an instrument.
+
+    Args:
+        name (str): Name of the instrument (section of the configuration).
+        model (str): Model of its section.
+
+    Returns:
+        type: Class of the model (registry, then entry points), else of the
+        module of instruments named as the instrument.
+
+    Raises:
+        ValueError: No class for the model nor the name.
+    """
+    target = INSTRUMENT_MODELS.get(model) if model else None
+    if target is None and model:
+        target = _entry_point(model)
+        if target is not None:
+            INSTRUMENT_MODELS[model] = target
+    if target is None:
+        target = f'instruments.{name}:{name}'
+    try:
+        return _load(target)
+    except ModuleNotFoundError as e:
+        if not e.name or not target.startswith(e.name):
+            raise
+    except AttributeError:
+        pass
+    raise ValueError(f'Instrument {name}: no class for model {model} (registered: '
+                     f'{", ".join(sorted(INSTRUMENT_MODELS))}) nor module instruments/{name}.py')
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ACS device files and temperature and salinity correction.
+
+A device file (.dev, WET Labs) holds the wavelengths of c and a, their
+offsets and the temperature corrections of each wavelength on a grid of
+temperature bins, one line per wavelength:
+
+    C401.1  A400.3  4  c_offset  a_offset  dT_c (n bins)  dT_a (n bins)  ; comment
+
+Parsed device files and psi tables (temperature and salinity dependence of
+the absorption of water, Sullivan et al. 2006, read from the psi_file of the
+configuration) are cached on the sha1 of their content, so that reading them
+again for each day or for the DI water costs a hash of the file. The psi are
+interpolated once on the wavelengths of the instrument, and the residual
+temperature and salinity correction of ap and cp is then one broadcast
+over the whole (bins x wavelengths) matrix:
+
+    ap -= psi_T dT + psi_S_a dS        cp -= psi_T dT + psi_S_c dS
+
+with dT and dS the differences of temperature and salinity between the
+total water and its filtered water reference.
+"""
+import hashlib
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Wavelengths, offsets and temperature corrections of a device file, and the
+# temperature of calibration (tcal) and of the instrument (ical)
+DeviceFile = namedtuple('DeviceFile', ['serial', 'lambda_c', 'lambda_a', 'c_offset', 'a_offset', 't_bins',
+                                       'delta_t_c', 'delta_t_a', 'tcal', 'ical'])
+# Parsed files by sha1 of their content
+_CACHE = {}
+_WAVELENGTH_LINE = re.compile(r'^\s*C(\d+(?:\.\d+)?)\s+A(\d+(?:\.\d+)?)\s')
+# Names of the columns of the psi tables (lowercase, alphanumeric only)
+PSI_COLUMNS = {'psi_t': ('psit',), 'psi_s_c': ('cpsis', 'psisc'), 'psi_s_a': ('apsis', 'psisa')}
+
+
+def _cached(path, parser):
+    """parser(text) of the file path, cached on the sha1 of its content."""
+    with open(path, 'rb') as f:
+        content = f.read()
+    key = (parser.__name__, hashlib.sha1(content).hexdigest())
+    if key not in _CACHE:
+        _CACHE[key] = parser(content.decode('latin-1'))
+    return _CACHE[key]
+
+
+def _parse_device(text):
+    serial, tcal, ical, t_bins, rows = None, np.nan, np.nan, None, []
+    for line in text.splitlines():
+        values, _, comment = line.partition(';')
+        comment = comment.strip().lower()
+        if _WAVELENGTH_LINE.match(values):
+            rows.append(values.split())
+        elif comment.startswith('serial number'):
+            serial = values.strip()
+        elif comment.startswith('temperature bins'):
+            t_bins = np.array(values.split(), dtype=float)
+        elif values.strip().lower().startswith('tcal'):
+            # tcal: 21.6 C, ical: 21.5 C.
+            numbers = re.findall(r'[-+]?\d+(?:\.\d+)?', values)
+            tcal, ical = (float(numbers[0]), float(numbers[1])) if len(numbers) > 1 else (tcal, ical)
+    if not rows or t_bins is None:
+        raise ValueError('ACS device file: no wavelength or temperature bins found.')
+    n_bins = len(t_bins)
+    lambda_c = np.array([float(r[0][1:]) for r in rows])
+    lambda_a = np.array([float(r[1][1:]) for r in rows])
+    values = np.array([r[3:5 + 2 * n_bins] for r in rows], dtype=float)
+    if values.shape[1] != 2 + 2 * n_bins:
+        raise ValueError(f'ACS device file: expected {2 + 2 * n_bins} values per wavelength.')
+    return DeviceFile(serial, lambda_c, lambda_a, values[:, 0], values[:, 1], t_bins,
+                      values[:, 2:2 + n_bins], values[:, 2 + n_bins:], tcal, ical)
+
+
+def read_device_file(path):
+    """DeviceFile of an ACS device file, parsed once per content."""
+    return _cached(path, _parse_device)
+
+
+def _parse_psi(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    sep = '\t' if '\t' in lines[0] else ','
+    header = [re.sub(r'[^a-z0-9]', '', h.lower()) for h in lines[0].split(sep)]
+    table = np.array([[float(v) if v.strip() else np.nan for v in line.split(sep)] for line in lines[1:]])
+    out = {'wavelength': table[:, 0]}
+    for key, names in PSI_COLUMNS.items():
+        col = next((k for k, h in enumerate(header) if h in names), None)
+        if col is None:
+            raise ValueError(f'psi table: missing column {key} ({", ".join(names)}).')
+        out[key] = table[:, col]
+    return out
+
+
+def read_psi_table(path):
+    """psi_T, psi_S_c and psi_S_a of a csv or tab separated table (first column
+    wavelength), parsed once per content."""
+    return _cached(path, _parse_psi)
+
+
+def psi_on_wavelengths(psi, lambda_a, lambda_c):
+    """
+    psi interpolated on the wavelengths of the instrument.
+
+    Returns:
+        dict: psi_t_a and psi_s_a on lambda_a, psi_t_c and psi_s_c on lambda_c.
+    """
+    x = psi['wavelength']
+    return {'psi_t_a': np.interp(lambda_a, x, psi['psi_t']), 'psi_s_a': np.interp(lambda_a, x, psi['psi_s_a']),
+            'psi_t_c': np.interp(lambda_c, x, psi['psi_t']), 'psi_s_c': np.interp(lambda_c, x, psi['psi_s_c'])}
+
+
+def ts_signal(data, t_name=None, s_name=None):
+    """
+    Sorted time (int64 ns), temperature and salinity of TSG data.
+
+    Args:
+        data (pd.DataFrame or list): TSG data indexed by time, or list of them.
+        t_name, s_name (str): Columns, by default the first of t, t1, tcal,
+            temperature, sst and of s, sal, salinity found.
+    """
+    frames = [d for d in (data if isinstance(data, (list, tuple)) else [data]) if d is not None and len(d)]
+    if not frames:
+        return np.array([], dtype=np.int64), np.array([]), np.array([])
+    dt, t, s = [], [], []
+    for df in frames:
+        col_t = t_name or next(c for c in ('t', 't1', 'tcal', 'temperature', 'sst') if c in df.columns)
+        col_s = s_name or next(c for c in ('s', 'sal', 'salinity') if c in df.columns)
+        dt.append(pd.DatetimeIndex(df.index).as_unit('ns').asi8)
+        t.append(df[col_t].to_numpy(dtype=float))
+        s.append(df[col_s].to_numpy(dtype=float))
+    dt = np.concatenate(dt)
+    order = np.argsort(dt, kind='stable')
+    return dt[order], np.concatenate(t)[order], np.concatenate(s)[order]
+
+
+def ts_correction(ap, cp, d_t, d_s, psi):
+    """
+    Residual temperature and salinity correction of ap and cp, in place.
+
+    Args:
+        ap, cp (array): Bins x wavelengths particulate absorption and attenuation.
+        d_t, d_s (array): Temperature and salinity of each bin minus those of
+            its filtered water (NaN: no correction).
+        psi (dict): Output of psi_on_wavelengths.
+    """
+    d_t, d_s = np.nan_to_num(d_t)[:, None], np.nan_to_num(d_s)[:, None]
+    ap -= psi['psi_t_a'] * d_t + psi['psi_s_a'] * d_s
+    cp -= psi['psi_t_c'] * d_t + psi['psi_s_c'] * d_s
+    return ap, cp
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Calibration of binned ACS data in particulate and dissolved properties.
+
+Every step works on (bins x wavelengths) arrays, all wavelengths at once:
+
+    interp_filtered       filtered water spectra interpolated linearly on the
+                          times of the total water bins (one searchsorted and
+                          one weighted sum of two gathered rows for all
+                          wavelengths)
+    interp_wavelength     spectra interpolated on other wavelengths (c on the
+                          a wavelengths, a and c at 715 nm) with gathered
+                          columns, NaN staying in their own wavelength
+    ts_correction         residual temperature and salinity correction of ap
+                          and cp (see lib.acs_device)
+    scattering_correction residual scattering correction of ap, broadcast over
+                          bins and wavelengths
+    ad_aphi               non algal and phytoplankton absorption
+
+ap = a(tsw) - a(fsw) and cp = c(tsw) - c(fsw), the filtered water of each
+total water bin coming from the filtered water bracketing it (linear
+interpolation method) or from the CDOM fluorescence (CDOM interpolation
+method, see lib.cdom_interpolation), and ag, cg = a, c(fsw) - a, c(DI water)
+when DI water was measured.
+"""
+import numpy as np
+import pandas as pd
+
+from lib.acs_device import ts_correction
+from lib.spectra import split_wavelengths
+
+SCATTERING_METHODS = ('Baseline', 'Zaneveld1994_proportional', 'Rottgers2013_semiempirical',
+                      'ZaneveldRottgers_blended')
+# Wavelength (nm) of the scattering corrections, where ap is assumed small
+REFERENCE_WAVELENGTH = 715
+# Röttgers et al. (2013): fraction of the scattering seen by c, and ap(715) of
+# the semi-empirical relation true ap(715) = 0.212 * measured ap(715) ** 1.135
+ROTTGERS_EC = 0.56
+ROTTGERS_A715 = (0.212, 1.135)
+# Spectral slope (1/nm) of non algal particle absorption, around 440 nm
+NAP_SLOPE = 0.0123
+NAP_REFERENCE = 440
+
+
+def acs_arrays(binned):
+    """
+    Arrays of binned ACS data.
+
+    Args:
+        binned (pd.DataFrame or Spectra): Output of lib.binning.bin_data (its
+            avg statistic is used), or Spectra when binning was skipped.
+
+    Returns:
+        tuple: Sorted time of the bins (int64 ns), a and c (bins x
+        wavelengths, float) and their wavelengths.
+    """
+    if hasattr(binned, 'lambda_a'):
+        dt, a, c = binned.dt, binned.a, binned.c
+        lambda_a, lambda_c = binned.lambda_a, binned.lambda_c
+    else:
+        avg = binned['avg'] if isinstance(binned.columns, pd.MultiIndex) else binned
+        # Positions, a and c wavelengths may share labels
+        wavelengths = [k for k, col in enumerate(avg.columns) if isinstance(col, (float, np.floating))]
+        labels = [avg.columns[k] for k in wavelengths]
+        n_a = split_wavelengths(labels)
+        values = avg.iloc[:, wavelengths].to_numpy(dtype=float)
+        dt = pd.DatetimeIndex(avg.index).as_unit('ns').asi8
+        a, c = values[:, :n_a], values[:, n_a:]
+        lambda_a, lambda_c = labels[:n_a], labels[n_a:]
+    a, c = np.asarray(a, dtype=float), np.asarray(c, dtype=float)
+    if len(dt) > 1 and np.any(np.diff(dt) < 0):
+        order = np.argsort(dt, kind='stable')
+        dt, a, c = dt[order], a[order], c[order]
+    return np.asarray(dt, dtype=np.int64), a, c, np.asarray(lambda_a, dtype=float), np.asarray(lambda_c, dtype=float)
+
+
+def interp_time(t_dst, t_src, values):
+    """
+    Rows of values (at sorted times t_src) interpolated linearly at times t_dst,
+    all columns at once; NaN out of the range of t_src.
+    """
+    t_dst, t_src = np.asarray(t_dst, dtype=np.int64), np.asarray(t_src, dtype=np.int64)
+    out = np.full((len(t_dst),) + values.shape[1:], np.nan)
+    if not len(t_src):
+        return out
+    if len(t_src) == 1:
+        out[t_dst == t_src[0]] = values[0]
+        return out
+    rows = np.flatnonzero((t_dst >= t_src[0]) & (t_dst <= t_src[-1]))
+    k = np.minimum(np.searchsorted(t_src, t_dst[rows], side='right') - 1, len(t_src) - 2)
+    w = (t_dst[rows] - t_src[k]) / (t_src[k + 1] - t_src[k])
+    # lo + w (hi - lo), in place on the gathered rows
+    lo, hi = values[k], values[k + 1]
+    hi -= lo
+    hi *= w.reshape((-1,) + (1,) * (values.ndim - 1))
+    hi += lo
+    out[rows] = hi
+    return out
+
+
+def interp_nearest(t_dst, t_src, values):
+    """Rows of values (at sorted times t_src) nearest in time to t_dst."""
+    k = np.clip(np.searchsorted(t_src, t_dst), 1, max(len(t_src) - 1, 1))
+    if len(t_src) > 1:
+        k -= (t_dst - t_src[k - 1]) <= (t_src[k] - t_dst)
+    return values[np.minimum(k, len(t_src) - 1)]
+
+
+def interp_wavelength(values, x_src, x_dst):
+    """
+    Columns of values (at sorted wavelengths x_src) interpolated linearly at
+    wavelengths x_dst, all rows at once; the first and last columns are held
+    out of the range of x_src.
+    """
+    x_src, x_dst = np.asarray(x_src, dtype=float), np.atleast_1d(np.asarray(x_dst, dtype=float))
+    if len(x_src) == 1:
+        return np.repeat(values, len(x_dst), axis=1)
+    k = np.clip(np.searchsorted(x_src, x_dst, side='right') - 1, 0, len(x_src) - 2)
+    w = np.clip((x_dst - x_src[k]) / (x_src[k + 1] - x_src[k]), 0, 1).astype(values.dtype, copy=False)
+    return values[:, k] * (1 - w) + values[:, k + 1] * w
+
+
+def scattering_correction(ap, cp, ap_ref, cp_ref, method='Rottgers2013_semiempirical'):
+    """
+    Residual scattering correction of ap.
+
+    Args:
+        ap (array): Bins x wavelengths particulate absorption.
+        cp (array): Particulate attenuation on the wavelengths of ap.
+        ap_ref, cp_ref (array): ap and cp at REFERENCE_WAVELENGTH, one per bin.
+        method (str): One of SCATTERING_METHODS:
+            Baseline                    ap - ap(715)
+            Zaneveld1994_proportional   ap - ap(715) (cp - ap) / (cp(715) - ap(715))
+            Rottgers2013_semiempirical  as Zaneveld1994_proportional, with the
+                                        true ap(715) of Röttgers et al. (2013)
+                                        and cp / ec for the attenuation
+            ZaneveldRottgers_blended    mean of the two corrections above
+
+    Returns:
+        array: Corrected ap.
+    """
+    ap_ref, cp_ref = np.asarray(ap_ref, dtype=float)[:, None], np.asarray(cp_ref, dtype=float)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'Baseline':
+            return ap - ap_ref
+        if method in ('Zaneveld1994_proportional', 'ZaneveldRottgers_blended'):
+            zaneveld = ap - ap_ref * (cp - ap) / (cp_ref - ap_ref)
+            if method == 'Zaneveld1994_proportional':
+                return zaneveld
+        if method in ('Rottgers2013_semiempirical', 'ZaneveldRottgers_blended'):
+            # Negative ap(715) (noise) have no true absorption
+            true_ref = ROTTGERS_A715[0] * np.clip(ap_ref, 0, None) ** ROTTGERS_A715[1]
+            rottgers = ap - (ap_ref - true_ref) * (cp / ROTTGERS_EC - ap) / (cp_ref / ROTTGERS_EC - true_ref)
+            if method == 'Rottgers2013_semiempirical':
+                return rottgers
+            return (zaneveld + rottgers) / 2
+    raise ValueError(f'Unknown scattering correction: {method}')
+
+
+def ad_aphi(ap, lambda_a, slope=NAP_SLOPE):
+    """
+    Non algal (ad) and phytoplankton (aphi) absorption of ap.
+
+    ad is the exponential ad(440) exp(-slope (lambda - 440)) of the largest
+    amplitude keeping aphi = ap - ad positive at every wavelength (a fixed
+    slope simplification of the ap decomposition of Zheng and Stramski, 2013).
+
+    Returns:
+        tuple: ad and aphi, bins x wavelengths.
+    """
+    shape = np.exp(-slope * (np.asarray(lambda_a, dtype=float) - NAP_REFERENCE))
+    # fmin skips NaN, rows without any value give NaN
+    amplitude = np.clip(np.fmin.reduce(ap / shape, axis=1), 0, None) if ap.shape[1] else np.full(len(ap), np.nan)
+    ad = amplitude[:, None] * shape
+    return ad, ap - ad
+
+
+def interp_filtered(t_tsw, t_fsw, a_fsw, c_fsw):
+    """
+    a and c of the filtered water interpolated linearly on the total water
+    bins (times t_tsw and t_fsw sorted, int64 ns); NaN out of the filtered
+    water range.
+    """
+    # Filtered bins without any value would spread NaN to their neighbours
+    keep = ~(np.isnan(a_fsw).all(axis=1) & np.isnan(c_fsw).all(axis=1))
+    values = interp_time(t_tsw, np.asarray(t_fsw)[keep], np.hstack([a_fsw[keep], c_fsw[keep]]))
+    n_a = a_fsw.shape[1]
+    return values[:, :n_a], values[:, n_a:]
+
+
+def particulate(a_tsw, c_tsw, a_fsw, c_fsw, lambda_a, lambda_c,
+                scattering_corr='Rottgers2013_semiempirical', compute_ad_aphi=False, ts=None):
+    """
+    Particulate properties of the total water bins.
+
+    Args:
+        a_tsw, c_tsw (array): Bins x wavelengths a and c of the total water.
+        a_fsw, c_fsw (array): a and c of the filtered water on the same bins
+            (see interp_filtered, or lib.cdom_interpolation).
+        lambda_a, lambda_c (array): Wavelengths of a and c.
+        scattering_corr (str): Residual scattering correction, see scattering_correction.
+        compute_ad_aphi (bool): Also compute ad and aphi.
+        ts (tuple): Temperature and salinity differences between the total
+            water and its filtered water, and psi on the wavelengths, for the
+            residual temperature and salinity correction (see lib.acs_device).
+
+    Returns:
+        dict: Bins x wavelengths arrays ap, cp (and ad, aphi), ap and ad on
+        lambda_a and cp on lambda_c.
+    """
+    ap = a_tsw - a_fsw
+    cp = c_tsw - c_fsw
+    if ts is not None:
+        ts_correction(ap, cp, *ts)
+    ap_ref = interp_wavelength(ap, lambda_a, REFERENCE_WAVELENGTH)[:, 0]
+    cp_ref = interp_wavelength(cp, lambda_c, REFERENCE_WAVELENGTH)[:, 0]
+    ap = scattering_correction(ap, interp_wavelength(cp, lambda_c, lambda_a), ap_ref, cp_ref, scattering_corr)
+    out = {'ap': ap, 'cp': cp}
+    if compute_ad_aphi:
+        out['ad'], out['aphi'] = ad_aphi(ap, lambda_a)
+    return out
+
+
+def dissolved(t_fsw, a_fsw, c_fsw, t_diw, a_diw, c_diw, di_method='best_di'):
+    """
+    Dissolved properties (ag, cg) of the filtered water bins relative to DI water.
+
+    Args:
+        di_method (str): 'best_di' for the DI water bin nearest in time,
+            'interpolate' for the DI water interpolated linearly in time (the
+            first and last DI water out of their range).
+    """
+    diw = np.hstack([a_diw, c_diw])
+    if di_method == 'best_di':
+        ref = interp_nearest(t_fsw, t_diw, diw)
+    elif di_method == 'interpolate':
+        ref = interp_time(t_fsw, t_diw, diw)
+        out = np.isnan(ref).all(axis=1)
+        ref[out] = interp_nearest(t_fsw[out], t_diw, diw)
+    else:
+        raise ValueError(f'Unknown DI method: {di_method}')
+    n_a = a_fsw.shape[1]
+    return {'ag': a_fsw - ref[:, :n_a], 'cg': c_fsw - ref[:, n_a:]}
+
+
+def to_frame(dt, products, wavelengths):
+    """
+    DataFrame indexed by time (dt, int64 ns) with (product, wavelength) columns.
+
+    Args:
+        products (dict): Bins x wavelengths array of each product.
+        wavelengths (dict): Wavelengths of each product.
+    """
+    columns = pd.MultiIndex.from_tuples([(name, wl) for name in products for wl in wavelengths[name]])
+    values = np.hstack(list(products.values())) if products else np.zeros((len(dt), 0))
+    return pd.DataFrame(values, index=pd.DatetimeIndex(np.asarray(dt).view('datetime64[ns]'), name='dt'),
+                        columns=columns)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Automatic QC of raw data.
+
+All tests run on the whole (time x variable) matrix of an instrument, every
+wavelength of the ACS spectra at once:
+
+    spikes       values away from the running median of their column by more
+                 than n_mad robust standard deviations of the noise (from the
+                 MAD of the differences of successive samples, per hour and
+                 column)
+    saturation   ACS values out of [0, saturation threshold], as in
+                 import_inlinino_acs (saturation_mask)
+    spectra      ACS spectra missing most of a or c (bad), or with a
+                 wavelength departing from the shape of the spectrum (suspect:
+                 second difference along wavelength away from its usual
+                 values by more than n_mad_spectral robust deviations)
+    low flow     samples taken while the FLOW flow rate was below a threshold
+
+The running median is computed with a sorting network of np.minimum and
+np.maximum over shifted copies of the data, by chunks of rows, which is much
+faster than sorting each window. NaN (e.g. saturated values) are left out of
+the windows, so that spikes next to them are still found. Spikes and saturated values are set to NaN
+in qc, samples of bad spectra or low flow are moved to bad, and suspect
+spectra are copied to suspect.
+"""
+import numpy as np
+import pandas as pd
+
+from lib.binning import bin_edges
+from lib.import_inlinino_base import saturation_mask, SATURATION_THRESHOLD
+from lib.spectra import Spectra, split_wavelengths
+
+# Values per chunk of rows of the running median (fits in cache)
+CHUNK_VALUES = 1 << 18
+# MAD to standard deviation of a normal distribution
+MAD_TO_STD = 1.4826
+# Rows used to estimate the median of each column (evenly spaced)
+MEDIAN_ROWS = 4096
+
+
+def rolling_median(values, window=5):
+    """
+    Running median of each column over window rows (odd), centred; the first
+    and last rows are repeated at the edges. NaN are left out of the windows
+    (median of the other values, as np.nanmedian), windows of NaN only give NaN.
+    """
+    values = np.asarray(values)
+    h, n = window // 2, len(values)
+    out = np.empty_like(values)
+    if not n:
+        return out
+    padded = np.concatenate([np.repeat(values[:1], h, axis=0), values, np.repeat(values[-1:], h, axis=0)])
+    chunk = max(1, CHUNK_VALUES // max(values[0].size, 1))
+    rows = np.empty((window, min(chunk, n)) + values.shape[1:], dtype=values.dtype)
+    low = np.empty_like(rows[0])
+    floating = np.issubdtype(values.dtype, np.floating)
+    for start in range(0, n, chunk):
+        m = min(chunk, n - start)
+        r, t = rows[:, :m], low[:m]
+        for k in range(window):
+            r[k] = padded[start + k:start + k + m]
+        nan = np.isnan(r) if floating and np.isnan(padded[start:start + m + 2 * h]).any() else None
+        if nan is not None:
+            # Sorted last as +inf, the median is taken over the valid values only
+            valid = window - nan.sum(axis=0)
+            r[nan] = np.inf
+        # Odd-even transposition sort of the window rows
+        for step in range(window):
+            for i in range(step % 2, window - 1, 2):
+                np.minimum(r[i], r[i + 1], out=t)
+                np.maximum(r[i], r[i + 1], out=r[i + 1])
+                r[i] = t
+        if nan is None:
+            out[start:start + m] = r[h]
+            continue
+        lo = np.take_along_axis(r, np.maximum(valid - 1, 0)[None] // 2, axis=0)[0]
+        hi = np.take_along_axis(r, valid[None] // 2, axis=0)[0]
+        with np.errstate(invalid='ignore'):
+            median = np.where(valid % 2, lo, (lo + hi) / 2)
+        median[valid == 0] = np.nan
+        out[start:start + m] = median
+    return out
+
+
+def _median(values):
+    """Median of each column (NaN excluded), estimated on MEDIAN_ROWS rows at most."""
+    return np.nanmedian(values[::max(1, len(values) // MEDIAN_ROWS)], axis=0)
+
+
+def spike_mask(values, dt, window=5, n_mad=5, block=3600):
+    """
+    Mask of spikes.
+
+    Args:
+        values (array): Samples x variables.
+        dt (array): Sorted time of the samples, int64 ns.
+        window (int): Rows of the running median (odd).
+        n_mad (float): Threshold, in robust standard deviations.
+        block (float): Duration (s) over which the deviation is estimated.
+
+    Returns:
+        array: Boolean mask of values.
+    """
+    departure = np.abs(values - rolling_median(values, window))
+    mask = np.zeros(values.shape, dtype=bool)
+    _, first = bin_edges(dt, int(block * 1e9))
+    with np.errstate(all='ignore'):
+        for start, stop in zip(first[:-1], first[1:]):
+            # Noise from the differences of successive samples (std x sqrt(2)),
+            # the departures from the median are biased low (the sample is
+            # often the median itself)
+            rows = np.arange(start, stop - 1, max(1, (stop - start) // MEDIAN_ROWS))
+            scale = MAD_TO_STD / np.sqrt(2) * np.nanmedian(np.abs(values[rows + 1] - values[rows]), axis=0)
+            # Columns without variations (scale 0) have no spikes
+            mask[start:stop] = (departure[start:stop] > n_mad * scale) & (scale > 0)
+    return mask
+
+
+def spectral_mask(a, c, max_nan_fraction=0.5, n_mad_spectral=10):
+    """
+    Bad and suspect spectra.
+
+    Returns:
+        tuple: Rows missing more than max_nan_fraction of their a or c values
+        (bad), and rows with a wavelength departing from the spectral shape by
+        more than n_mad_spectral robust deviations (suspect).
+    """
+    bad = (np.isnan(a).mean(axis=1) > max_nan_fraction) | (np.isnan(c).mean(axis=1) > max_nan_fraction)
+    suspect = np.zeros(len(a), dtype=bool)
+    for spectra in (a, c):
+        if spectra.shape[1] < 3:
+            continue
+        # Second difference along wavelength, centred on its median per wavelength
+        d2 = np.diff(spectra, n=2, axis=1)
+        with np.errstate(all='ignore'):
+            d2 = np.abs(d2 - _median(d2))
+            scale = MAD_TO_STD * _median(d2)
+            suspect |= ((d2 > n_mad_spectral * scale) & (scale > 0)).any(axis=1)
+    return bad, suspect & ~bad
+
+
+def low_flow_mask(dt, flow_dt, flow, threshold):
+    """Samples at times dt (int64 ns) while the flow rate (last value at or
+    before each time) was below threshold."""
+    k = np.searchsorted(flow_dt, dt, side='right') - 1
+    with np.errstate(invalid='ignore'):
+        return (k >= 0) & (flow[np.maximum(k, 0)] < threshold)
+
+
+def auto_qc(data, window=5, n_mad=5, block=3600, saturation_threshold=SATURATION_THRESHOLD,
+            max_nan_fraction=0.5, n_mad_spectral=10, flow=None, flow_threshold=None):
+    """
+    Automatic QC of a DataFrame indexed by time or of Spectra.
+
+    Args:
+        data (pd.DataFrame or Spectra): Raw data; the numeric columns of a
+            DataFrame are tested (except dt and the switch position swt), its
+            wavelength columns (ACS) as spectra.
+        window, n_mad, block: Spike test, see spike_mask.
+        saturation_threshold (float): ACS saturation (spectra only).
+        max_nan_fraction, n_mad_spectral: Spectral test (spectra only), see spectral_mask.
+        flow (tuple): Time (int64 ns) and flow rate of the FLOW, for the low flow test.
+        flow_threshold (float): Flow rate below which samples are bad (None: no test).
+
+    Returns:
+        tuple: qc (data without bad samples, spikes and saturated values set
+        to NaN), suspect (suspect samples of qc) and bad (samples removed),
+        and a dict counting each test.
+    """
+    spectra = hasattr(data, 'lambda_a')
+    if spectra:
+        dt = data.dt
+        values = np.hstack([data.a, data.c])
+        wavelengths = slice(None)
+        n_a = data.a.shape[1]
+    else:
+        dt = pd.DatetimeIndex(data.index).as_unit('ns').asi8
+        # Positions, a and c wavelengths of the ACS may share labels
+        tested = [k for k, (col, dtype) in enumerate(zip(data.columns, data.dtypes)) if col not in ('dt', 'swt')
+                  and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+        columns = [data.columns[k] for k in tested]
+        values = np.array(data.iloc[:, tested].to_numpy(dtype=float))
+        # ACS DataFrame (import_inlinino_acs): a then c columns labelled by wavelength
+        wavelengths = np.array([k for k, col in enumerate(columns) if isinstance(col, (float, np.floating))], dtype=int)
+        n_a = split_wavelengths([columns[k] for k in wavelengths])
+        if len(wavelengths) and wavelengths[-1] - wavelengths[0] == len(wavelengths) - 1:
+            wavelengths = slice(wavelengths[0], wavelengths[-1] + 1)
+
+    masked = spike_mask(values, dt, window, n_mad, block)
+    stats = {'spike': int(masked.sum())}
+    bad = np.zeros(len(dt), dtype=bool)
+    suspect = np.zeros(len(dt), dtype=bool)
+    if values[:, wavelengths].shape[1]:
+        spectral = values[:, wavelengths]
+        saturated = saturation_mask(spectral, saturation_threshold) & ~np.isnan(spectral)
+        stats['saturated'] = int(saturated.sum())
+        masked[:, wavelengths] |= saturated
+    values[masked] = np.nan
+    if values[:, wavelengths].shape[1]:
+        spectral = values[:, wavelengths]
+        bad, suspect = spectral_mask(spectral[:, :n_a], spectral[:, n_a:], max_nan_fraction, n_mad_spectral)
+        stats['bad_spectra'], stats['suspect_spectra'] = int(bad.sum()), int(suspect.sum())
+    if flow is not None and flow_threshold is not None:
+        low = low_flow_mask(dt, flow[0], flow[1], flow_threshold)
+        stats['low_flow'] = int(low.sum())
+        bad |= low
+        suspect &= ~low
+
+    keep = ~bad
+    if spectra:
+        flag = data.flag
+        qc = Spectra(dt[keep], values[keep, :n_a], values[keep, n_a:], data.lambda_a, data.lambda_c,
+                     flag[keep], data.a.dtype)
+        out_suspect = qc[np.flatnonzero(suspect[keep])]
+        out_bad = data[np.flatnonzero(bad)]
+    else:
+        others = [k for k in range(data.shape[1]) if k not in set(tested)]
+        qc = pd.concat([pd.DataFrame(values[keep], index=data.index[keep], columns=columns),
+                        data.iloc[np.flatnonzero(keep), others]], axis=1)
+        qc = qc.iloc[:, np.argsort(tested + others, kind='stable')]
+        out_suspect = qc.loc[suspect[keep]]
+        out_bad = data.loc[bad]
+    return qc, out_suspect, out_bad, stats
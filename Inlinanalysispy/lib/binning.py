@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binning of instrument data in fixed time bins.
+
+Samples are sorted in time, so the samples of each bin are a contiguous run
+whose boundaries are found from the changes of bin. Runs are copied into a
+(bins x columns x samples per bin) array padded with NaN and sorted along the
+samples axis, which gives percentiles, percentile-trimmed mean and standard
+deviation, median and count of all columns (e.g. every wavelength of the ACS
+spectra) in a few vectorized operations. Bins are processed by chunks so that
+the padded array stays small.
+
+Statistics of each bin and column, as in the [bin] section of the cfg file:
+    avg  mean of the values within the prctile_average percentiles
+    std  standard deviation of the values within the prctile_detection percentiles
+    med  median of all values
+    n    number of values (NaN excluded)
+"""
+import numpy as np
+import pandas as pd
+
+BIN_STATS = ('avg', 'std', 'med', 'n')
+# Padded values per chunk of bins (bins x columns x samples per bin)
+CHUNK_VALUES = 1 << 20
+
+
+def bin_edges(dt, bin_size):
+    """
+    Time bins holding samples.
+
+    Args:
+        dt (array): Sorted time of the samples, int64 ns.
+        bin_size (int): Bin width in ns, bins are aligned on midnight.
+
+    Returns:
+        tuple: Start time of each bin (int64 ns) and first sample of each bin,
+        with the number of samples appended (bin k holds samples
+        first[k]:first[k + 1]).
+    """
+    if not len(dt):
+        return np.array([], dtype=np.int64), np.array([0])
+    labels = dt // bin_size
+    # Runs of equal labels in the sorted times
+    starts = np.flatnonzero(np.diff(labels)) + 1
+    bins = labels[np.r_[0, starts]] * bin_size
+    return bins, np.r_[0, starts, len(dt)]
+
+
+def _percentile(s, n, p):
+    """Percentile p of sorted padded values s (bins x columns x samples) with
+    n values, interpolated linearly as np.percentile does."""
+    pos = np.clip(p / 100 * (n - 1), 0, None)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    v_lo = np.take_along_axis(s, lo[..., None], axis=-1)[..., 0]
+    v_hi = np.take_along_axis(s, hi[..., None], axis=-1)[..., 0]
+    out = v_lo + (pos - lo) * (v_hi - v_lo)
+    out[n == 0] = np.nan
+    return out
+
+
+def _trimmed(c, n, tot1, tot2, bounds, prctile):
+    """
+    Mean and standard deviation (ddof=1) of the values within the percentiles
+    prctile of each bin and column, the mean being relative to the median.
+
+    c are the sorted values centred on the median (bins x columns x samples,
+    n values then padding), and bounds the percentiles centred the same way.
+    Values out of the bounds are the few first and last of the sorted values:
+    their sums (and the sums of their squares) are taken out of the totals
+    tot1 and tot2 of each bin.
+    """
+    width = c.shape[-1]
+    lo, hi = bounds[prctile[0]], bounds[prctile[1]]
+    # Values below lo are within the first floor(pos_lo) + 1 sorted values
+    k = min(width, int(np.floor(prctile[0] / 100 * (width - 1))) + 1)
+    low = (np.arange(k) < n[..., None]) & (c[..., :k] < lo[..., None])
+    c_low = np.where(low, c[..., :k], 0)
+
+    # Values above hi are past the floor(pos_hi) + 1 first sorted values
+    after = np.floor(np.clip(prctile[1] / 100 * (n - 1), 0, None)).astype(np.intp) + 1
+    h = int((n - after).max(initial=0))
+    idx = after[..., None] + np.arange(h)
+    high = idx < n[..., None]
+    c_high = np.take_along_axis(c, np.minimum(idx, width - 1), axis=-1)
+    high &= c_high > hi[..., None]
+    c_high = np.where(high, c_high, 0)
+
+    count = n - low.sum(axis=-1) - high.sum(axis=-1)
+    s1 = tot1 - c_low.sum(axis=-1) - c_high.sum(axis=-1)
+    s2 = tot2 - np.einsum('ijk,ijk->ij', c_low, c_low) - np.einsum('ijk,ijk->ij', c_high, c_high)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = s1 / count
+        std = np.sqrt(np.clip((s2 - s1 * s1 / count) / (count - 1), 0, None))
+    avg[count == 0] = np.nan
+    std[count < 2] = np.nan
+    return avg, std
+
+
+def bin_arrays(dt, values, bin_size, prctile_detection=(2.5, 97.5), prctile_average=(2.5, 97.5)):
+    """
+    Bin the columns of a 2-D array in fixed time bins.
+
+    Args:
+        dt (array): Sorted time of the samples, int64 ns.
+        values (array): Samples x columns, float.
+        bin_size (int): Bin width in ns.
+        prctile_detection (tuple): Percentiles bounding the values of std.
+        prctile_average (tuple): Percentiles bounding the values of avg.
+
+    Returns:
+        tuple: Start time of each bin (int64 ns), and dict of bins x columns
+        arrays for each statistic of BIN_STATS.
+    """
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    if np.isinf(values).any():
+        # Infinite values are missing values, as NaN
+        values = np.where(np.isinf(values), np.nan, values)
+    bins, first = bin_edges(np.asarray(dt, dtype=np.int64), bin_size)
+    n_bins, n_cols = len(bins), values.shape[1]
+    stats = {'avg': np.full((n_bins, n_cols), np.nan, dtype=values.dtype),
+             'std': np.full((n_bins, n_cols), np.nan, dtype=values.dtype),
+             'med': np.full((n_bins, n_cols), np.nan, dtype=values.dtype),
+             'n': np.zeros((n_bins, n_cols), dtype=np.int64)}
+    if not n_bins or not n_cols:
+        return bins, stats
+
+    sizes = np.diff(first)
+    step = max(1, CHUNK_VALUES // (int(sizes.max()) * n_cols))
+    # Reused by all chunks, allocating large arrays costs as much as filling them
+    buffer = np.empty(min(step, n_bins) * n_cols * int(sizes.max()), dtype=values.dtype)
+    for k in range(0, n_bins, step):
+        chunk = slice(k, min(k + step, n_bins))
+        size = sizes[chunk]
+        width = int(size.max())
+        # Samples of each bin along the last axis, padded with NaN
+        padded = buffer[:len(size) * n_cols * width].reshape(len(size), n_cols, width)
+        if (size == width).all():
+            padded[:] = values[first[chunk.start]:first[chunk.stop]].reshape(len(size), width, n_cols).transpose(0, 2, 1)
+        else:
+            padded.fill(np.nan)
+            rows = np.arange(first[chunk.start], first[chunk.stop])
+            b = np.repeat(np.arange(len(size)), size)
+            padded.transpose(0, 2, 1)[b, rows - np.repeat(first[chunk.start:chunk.stop], size)] = values[rows]
+        # NaN are sorted last, after the n values of each column
+        padded.sort(axis=-1)
+        missing = np.isnan(padded)
+        n = width - missing.sum(axis=-1)
+        med = _percentile(padded, n, 50)
+        bounds = {p: _percentile(padded, n, p) - med for p in {*prctile_average, *prctile_detection}}
+
+        # Centre the values on the median in place, padding counts as -med
+        np.copyto(padded, 0, where=missing)
+        padded -= med[..., None]
+        pad = width - n
+        with np.errstate(invalid='ignore'):
+            tot1 = padded.sum(axis=-1) + pad * med
+            tot2 = np.einsum('ijk,ijk->ij', padded, padded) - pad * med * med
+
+        stats['n'][chunk] = n
+        stats['med'][chunk] = med
+        stats['avg'][chunk] = med + _trimmed(padded, n, tot1, tot2, bounds, prctile_average)[0]
+        stats['std'][chunk] = _trimmed(padded, n, tot1, tot2, bounds, prctile_detection)[1]
+    return bins, stats
+
+
+def bin_data(data, bin_size, prctile_detection=(2.5, 97.5), prctile_average=(2.5, 97.5), mode='ByDay'):
+    """
+    Bin a time indexed DataFrame (or Spectra) in fixed time bins.
+
+    Args:
+        data (pd.DataFrame or Spectra): Samples indexed by time; non numeric
+            columns and the dt column are left out.
+        bin_size (float): Bin width in minutes.
+        prctile_detection (tuple): Percentiles bounding the values of std.
+        prctile_average (tuple): Percentiles bounding the values of avg.
+        mode (str): 'ByDay' to bin one day at a time (bounded memory), or
+            'OneShot' to bin all data at once.
+
+    Returns:
+        pd.DataFrame: One row per bin with data, indexed by the start time of
+        the bin, with (stat, variable) columns for each statistic of BIN_STATS.
+    """
+    if hasattr(data, 'lambda_a'):
+        # Spectra: a then c columns, labelled by wavelength as in import_inlinino_acs
+        dt, labels = data.dt, list(data.lambda_a) + list(data.lambda_c)
+        columns = (data.a, data.c)
+    else:
+        data = data.sort_index() if not data.index.is_monotonic_increasing else data
+        # Positions, a and c wavelengths of the ACS may share labels
+        numeric = [k for k, (c, dtype) in enumerate(zip(data.columns, data.dtypes)) if c != 'dt'
+                   and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+        dt, labels = pd.DatetimeIndex(data.index).as_unit('ns').asi8, [data.columns[k] for k in numeric]
+        columns = (data.iloc[:, numeric].to_numpy(dtype=float),)
+    bin_size = int(round(bin_size * 60e9))
+
+    if mode == 'ByDay':
+        day = np.int64(86400 * 10**9)
+        cuts = np.flatnonzero(np.diff(dt // day)) + 1
+        parts = list(zip(np.r_[0, cuts], np.r_[cuts, len(dt)]))
+    elif mode == 'OneShot':
+        parts = [(0, len(dt))]
+    else:
+        raise ValueError(f'Unknown binning mode: {mode}')
+
+    frames = []
+    for start, stop in parts:
+        values = columns[0][start:stop] if len(columns) == 1 else np.hstack([c[start:stop] for c in columns])
+        bins, stats = bin_arrays(dt[start:stop], values, bin_size, prctile_detection, prctile_average)
+        index = pd.DatetimeIndex(bins.view('datetime64[ns]'), name='dt')
+        frames.append(pd.concat({s: pd.DataFrame(stats[s], index=index, columns=labels) for s in BIN_STATS},
+                                axis=1, names=['stat', 'var']))
+    return pd.concat(frames)
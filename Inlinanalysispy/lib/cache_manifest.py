@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Manifests of the day caches written by i_read.
+
+Each day cache of path_wk comes with {prefix}{YYYYMMDD}{postfix}.manifest.json
+recording the parser that produced it (name, PARSER_VERSION of its module and
+extra arguments) and, for every raw file behind the day, its name, size,
+modification time, optional sha1 and the rows it holds in the cache. i_read
+uses it to re-parse only the raw files that are new or changed since the
+cache was written.
+"""
+import hashlib
+import json
+import os
+import sys
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(fn_base):
+    """Path of the manifest of the day cache fn_base (path without extension)."""
+    return fn_base + '.manifest.json'
+
+
+def parser_signature(fun, otherarg1=None, otherarg2=None):
+    """Identify an import function, its version and its extra arguments."""
+    module = sys.modules.get(fun.__module__)
+    return {'name': f'{fun.__module__}.{fun.__qualname__}',
+            'version': getattr(module, 'PARSER_VERSION', None),
+            'args': repr((otherarg1, otherarg2))}
+
+
+def file_signature(path, checksum=False):
+    """Name, size and modification time (and sha1 if checksum) of a raw file."""
+    st = os.stat(path)
+    sig = {'name': os.path.basename(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if checksum:
+        sig['sha1'] = sha1(path)
+    return sig
+
+
+def sha1(path, blocksize=1 << 20):
+    """sha1 of a file, read by blocks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_manifest(fn_base):
+    """Manifest of a day cache, or None if missing or of another version."""
+    try:
+        with open(manifest_path(fn_base)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+
+def write_manifest(fn_base, parser, files, **extra):
+    """
+    Write the manifest of a day cache.
+
+    Args:
+        fn_base (str): Path of the day cache without extension.
+        parser (dict): Output of parser_signature.
+        files (list): Signature of each raw file (see file_signature) with
+            the number of rows it holds in the cache ('rows'), in cache order.
+        extra: Other entries to record.
+    """
+    manifest = {'version': MANIFEST_VERSION, 'parser': parser, 'files': files, **extra}
+    tmp = manifest_path(fn_base) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path(fn_base))
+
+
+def remove_manifest(fn_base):
+    """Remove the manifest of a day cache, if any."""
+    if os.path.exists(manifest_path(fn_base)):
+        os.remove(manifest_path(fn_base))
+
+
+def cached_rows(manifest):
+    """Row range (start, stop) of each raw file in the day cache."""
+    rows, start = {}, 0
+    for f in manifest['files']:
+        rows[f['name']] = (start, start + f['rows'])
+        start += f['rows']
+    return rows
+
+
+def changed_files(manifest, files, parser, checksum=False):
+    """
+    Compare the raw files behind a day with the ones recorded in its manifest.
+
+    A file is unchanged if its size and modification time are the ones
+    recorded, or if only its modification time changed and its sha1 (when
+    recorded and checksum is set) is the same; such files are reported as
+    touched so that the manifest can be refreshed, as are unchanged files
+    without a recorded sha1 when checksum is set.
+
+    Args:
+        manifest (dict): Manifest of the day cache.
+        files (list): Raw files currently behind the day.
+        parser (dict): Signature of the import function.
+        checksum (bool): Compare sha1 of files whose modification time changed.
+
+    Returns:
+        tuple: (files to parse, names of recorded files that are gone, names
+        of touched files). All files are to be parsed if the parser changed.
+    """
+    recorded = {f['name']: f for f in manifest['files']}
+    if manifest['parser'] != parser:
+        return list(files), [], []
+    stale, touched = [], []
+    for path in files:
+        old = recorded.get(os.path.basename(path))
+        st = os.stat(path)
+        if old is None or old['size'] != st.st_size:
+            stale.append(path)
+        elif old['mtime_ns'] != st.st_mtime_ns:
+            if checksum and 'sha1' in old and old['sha1'] == sha1(path):
+                touched.append(old['name'])
+            else:
+                stale.append(path)
+        elif checksum and 'sha1' not in old:
+            touched.append(old['name'])
+    names = {os.path.basename(f) for f in files}
+    removed = [name for name in recorded if name not in names]
+    return stale, removed, touched
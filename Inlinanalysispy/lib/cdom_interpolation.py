@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CDOM interpolation of the filtered water of the ACS.
+
+Filtered water is measured a few minutes per hour, while the dissolved a and
+c change with the water masses in between. The CDOM method follows them with
+the fluorescence of a CDOM fluorometer (CDOM_source) measured all the time:
+
+    events      runs of consecutive filtered water bins, averaged, with the
+                CDOM fluorescence at their time
+    clusters    events consecutive in time and with similar CDOM: sorted by
+                time, a cluster ends where the distance between two successive
+                events (time in days x time_weight_for_cluster and CDOM in
+                robust standard deviations) is above 1, then clusters of fewer
+                than min_nb_pts_per_cluster events are merged with the closest
+                of their neighbours
+    regression  a and c of the events of each cluster regressed linearly on
+                CDOM, every wavelength at once from the sums of each cluster
+    dissolved   a and c of each total water bin from the regression of the
+                cluster of the event nearest in time, at the CDOM of the bin
+
+Events being sorted by time, clustering only compares successive events and
+clusters are contiguous runs of events (sums with np.add.reduceat), so that
+every step is O(n) or O(n log n) in the number of events and bins, with
+memory in events x wavelengths. CDOM values are joined on the ACS times with
+binary searches in the sorted CDOM times.
+"""
+import numpy as np
+import pandas as pd
+
+from lib.acs_processing import interp_time
+
+# MAD to standard deviation of a normal distribution
+MAD_TO_STD = 1.4826
+
+
+def cdom_signal(data, varname=None):
+    """
+    Sorted time (int64 ns) and fluorescence of CDOM data.
+
+    Args:
+        data (pd.DataFrame or list): CDOM data indexed by time, or list of
+            them (e.g. the qc tsw and fsw of the CDOM_source instrument).
+        varname (str): Fluorescence column, by default fdom if present, else
+            the first numeric column (dt and swt left out).
+    """
+    frames = [d for d in (data if isinstance(data, (list, tuple)) else [data]) if d is not None and len(d)]
+    if not frames:
+        return np.array([], dtype=np.int64), np.array([])
+    dt, values = [], []
+    for df in frames:
+        col = varname
+        if col is None:
+            numeric = [c for c, dtype in zip(df.columns, df.dtypes) if c not in ('dt', 'swt')
+                       and pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)]
+            col = 'fdom' if 'fdom' in df.columns else numeric[0]
+        dt.append(pd.DatetimeIndex(df.index).as_unit('ns').asi8)
+        values.append(df[col].to_numpy(dtype=float))
+    dt, values = np.concatenate(dt), np.concatenate(values)
+    order = np.argsort(dt, kind='stable')
+    return dt[order], values[order]
+
+
+def cdom_at(t, t_cdom, cdom):
+    """CDOM interpolated linearly at times t (int64 ns), NaN out of the CDOM data."""
+    valid = np.isfinite(cdom)
+    return interp_time(t, t_cdom[valid], cdom[valid, None])[:, 0]
+
+
+def filter_events(t_fsw, values, max_gap):
+    """
+    Runs of filtered water bins.
+
+    Args:
+        t_fsw (array): Sorted times of the filtered water bins, int64 ns.
+        values (array): Bins x wavelengths a and c.
+        max_gap (int): Largest time (ns) between two bins of the same event.
+
+    Returns:
+        tuple: Mean time of each event (int64 ns), events x wavelengths mean
+        of values (NaN excluded), and first bin of each event.
+    """
+    if not len(t_fsw):
+        return np.array([], dtype=np.int64), np.zeros((0,) + values.shape[1:]), np.array([], dtype=int)
+    first = np.r_[0, np.flatnonzero(np.diff(t_fsw) > max_gap) + 1]
+    sizes = np.diff(np.r_[first, len(t_fsw)])
+    # Relative to the first bin of each event, the sums of times do not overflow
+    t = t_fsw[first] + np.add.reduceat(t_fsw - np.repeat(t_fsw[first], sizes), first) // sizes
+    valid = np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(valid, values, 0), first) / np.add.reduceat(valid, first)
+    return t, mean, first
+
+
+def cluster_events(t, cdom, min_nb_pts_per_cluster=3, time_weight_for_cluster=1):
+    """
+    Clusters of events (see module).
+
+    Args:
+        t (array): Sorted times of the events, int64 ns.
+        cdom (array): CDOM fluorescence of the events (NaN: events not clustered
+            on CDOM, only on time).
+        min_nb_pts_per_cluster (int): Smallest number of events of a cluster.
+        time_weight_for_cluster (float): Weight of one day against one robust
+            standard deviation of CDOM.
+
+    Returns:
+        array: Cluster of each event, 0 to number of clusters - 1, increasing with time.
+    """
+    if len(t) < 2:
+        return np.zeros(len(t), dtype=int)
+    finite = cdom[np.isfinite(cdom)]
+    scale = MAD_TO_STD * np.median(np.abs(finite - np.median(finite))) if len(finite) else 0
+    d_cdom = np.nan_to_num(np.diff(cdom) / scale if scale > 0 else np.zeros(len(t) - 1))
+    d_time = np.diff(t) / 86400e9 * time_weight_for_cluster
+    # Distance between successive events, a cluster ends where it is above 1
+    distance = np.hypot(d_time, d_cdom)
+    cut = distance > 1
+
+    # Merge small clusters across their shortest cut, all of them at each round
+    while cut.any():
+        first = np.r_[0, np.flatnonzero(cut) + 1]
+        sizes = np.diff(np.r_[first, len(t)])
+        small = np.flatnonzero(sizes < min_nb_pts_per_cluster)
+        if not len(small):
+            break
+        # Cut before (first[k] - 1) and after (first[k + 1] - 1) each cluster
+        before = np.where(small > 0, first[small] - 1, -1)
+        after = np.where(small < len(first) - 1, first[np.minimum(small + 1, len(first) - 1)] - 1, -1)
+        d_before = np.where(before >= 0, distance[before], np.inf)
+        d_after = np.where(after >= 0, distance[after], np.inf)
+        cut[np.where(d_before <= d_after, before, after)] = False
+    return np.r_[0, np.cumsum(cut)]
+
+
+def fit_clusters(labels, cdom, values):
+    """
+    Linear regression of values on cdom in each cluster, every column at once.
+
+    Args:
+        labels (array): Sorted cluster of each event (output of cluster_events).
+        cdom (array): CDOM fluorescence of the events.
+        values (array): Events x wavelengths a and c.
+
+    Returns:
+        tuple: Clusters x wavelengths intercept and slope; clusters with a
+        single CDOM value have their mean and slope 0, clusters without values NaN.
+    """
+    first = np.r_[0, np.flatnonzero(np.diff(labels)) + 1]
+    valid = np.isfinite(values) & np.isfinite(cdom)[:, None]
+    # Centred, the sums keep their precision
+    offset = np.nanmedian(cdom) if np.isfinite(cdom).any() else 0
+    x = np.where(valid, np.nan_to_num(cdom - offset)[:, None], 0)
+    y = np.where(valid, values, 0)
+    n = np.add.reduceat(valid.astype(float), first)
+    sx, sy = np.add.reduceat(x, first), np.add.reduceat(y, first)
+    sxx, sxy = np.add.reduceat(x * x, first), np.add.reduceat(x * y, first)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denominator = n * sxx - sx * sx
+        regress = denominator > 1e-12 * n * n
+        slope = np.where(regress, (n * sxy - sx * sy) / np.where(regress, denominator, 1), 0)
+        intercept = (sy - slope * sx) / n - slope * offset
+    return intercept, slope
+
+
+def cdom_filtered(t_tsw, cdom_tsw, t_events, labels, intercept, slope):
+    """
+    a and c of the filtered water of the total water bins: regression of the
+    cluster of the event nearest in time, at the CDOM of each bin (NaN where
+    the CDOM is missing).
+    """
+    if not len(t_events):
+        return np.full((len(t_tsw), intercept.shape[1]), np.nan)
+    k = np.clip(np.searchsorted(t_events, t_tsw), 1, max(len(t_events) - 1, 1))
+    if len(t_events) > 1:
+        k -= (t_tsw - t_events[k - 1]) <= (t_events[k] - t_tsw)
+    cluster = labels[np.minimum(k, len(t_events) - 1)]
+    return intercept[cluster] + slope[cluster] * cdom_tsw[:, None]
+
+
+def interp_cdom(t_tsw, t_fsw, a_fsw, c_fsw, t_cdom, cdom, min_nb_pts_per_cluster=3,
+                time_weight_for_cluster=1, max_gap=None):
+    """
+    a and c of the filtered water on the total water bins with the CDOM method.
+
+    Args:
+        t_tsw, t_fsw (array): Sorted times of the total and filtered water bins, int64 ns.
+        a_fsw, c_fsw (array): Bins x wavelengths a and c of the filtered water.
+        t_cdom, cdom (array): Sorted times (int64 ns) and CDOM fluorescence (see cdom_signal).
+        min_nb_pts_per_cluster, time_weight_for_cluster: see cluster_events.
+        max_gap (int): Largest time (ns) between two bins of a filter event,
+            by default twice the usual time between filtered bins.
+
+    Returns:
+        tuple: a and c on the total water bins (NaN where the CDOM is missing),
+        and the number of events and of clusters.
+    """
+    values = np.hstack([a_fsw, c_fsw])
+    if max_gap is None:
+        max_gap = 2 * int(np.median(np.diff(t_fsw))) if len(t_fsw) > 1 else 0
+    t_events, events, _ = filter_events(t_fsw, values, max_gap)
+    if not len(t_events):
+        # No filtered water: NaN, as the linear method (and the linear fallback of process_acs_cdom)
+        n_a = a_fsw.shape[1]
+        out = np.full((len(t_tsw), values.shape[1]), np.nan)
+        return out[:, :n_a], out[:, n_a:], 0, 0
+    cdom_events = cdom_at(t_events, t_cdom, cdom)
+    labels = cluster_events(t_events, cdom_events, min_nb_pts_per_cluster, time_weight_for_cluster)
+    intercept, slope = fit_clusters(labels, cdom_events, events)
+    out = cdom_filtered(t_tsw, cdom_at(t_tsw, t_cdom, cdom), t_events, labels, intercept, slope)
+    n_a = a_fsw.shape[1]
+    return out[:, :n_a], out[:, n_a:], len(t_events), int(labels[-1]) + 1 if len(labels) else 0
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-hashed checkpoints of the processing levels.
+
+Each level produced by a stage (raw by Split, qc, suspect and bad by AutoQC,
+bin by Bin, flag by Flag, prod by calibrate) is saved per instrument and per
+day in path_wk/checkpoints/<instrument>/<level>/<YYYYMMDD>.pkl, under a key
+hashing everything the day depends on:
+
+    upstream    keys of the same day of the levels read by the stage (or the
+                content hash of the data read, for the first level)
+    config      the settings of the stage (e.g. [calibrate] of the instrument),
+                and the content of the files they name (device file, psi
+                table, HTJS models)
+    code        the source of the modules computing the stage
+
+A stage whose checkpoints are all present with the expected keys is not run:
+its levels are loaded instead, and their keys become the upstream of the next
+stage. Changing only scattering_correction of [calibrate] thus reloads raw,
+qc and bin and runs calibrate again, while a change of the data or of [bin]
+invalidates bin and everything after it.
+"""
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pickle
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from lib.cache_manifest import sha1
+from lib.shard import trim, merge
+
+CHECKPOINT_VERSION = 1
+# Folder of the checkpoints in the path_wk of an instrument
+CHECKPOINT_DIR = 'checkpoints'
+
+
+def _sha1(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _module_hash(name):
+    # Imported if not yet, the hash is always of the source
+    module = importlib.import_module(name)
+    try:
+        path = inspect.getsourcefile(module)
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (TypeError, OSError):
+        # Built-in or compiled modules, without source
+        return name
+
+
+def code_version(*modules):
+    """Hash of the source files of modules (names), read once per process."""
+    return _sha1(CHECKPOINT_VERSION, [_module_hash(m) for m in sorted(set(modules))])
+
+
+def file_hashes(paths):
+    """sha1 of the content of files (as lib.acs_device caches them), None for missing files."""
+    return [sha1(p) if p and os.path.isfile(p) else None for p in paths]
+
+
+def _days(index):
+    return pd.DatetimeIndex(index).normalize().as_unit('ns')
+
+
+def level_days(value):
+    """Sorted days with data of a level (DataFrame, Series or dict of them)."""
+    if isinstance(value, dict):
+        return sorted({d for v in value.values() for d in level_days(v)})
+    if isinstance(value, (pd.DataFrame, pd.Series)) and isinstance(value.index, pd.DatetimeIndex):
+        return list(_days(value.index).unique().sort_values())
+    return []
+
+
+def day_hashes(value):
+    """
+    Content hash of each day of value.
+
+    Args:
+        value: DataFrame or Series indexed by time, or dict of them (e.g. the
+            raw level {'tsw': ..., 'fsw': ...}).
+
+    Returns:
+        dict: Hash of each day (Timestamp) with data.
+    """
+    if isinstance(value, dict):
+        per_key = {k: day_hashes(v) for k, v in value.items()}
+        days = sorted({d for h in per_key.values() for d in h})
+        return {d: _sha1([[str(k), per_key[k].get(d)] for k in sorted(per_key, key=str)]) for d in days}
+    if not isinstance(value, (pd.DataFrame, pd.Series)) or not isinstance(value.index, pd.DatetimeIndex) or \
+            not len(value):
+        return {}
+    rows = pd.util.hash_pandas_object(value, index=True).to_numpy()
+    layout = _sha1([str(c) for c in (value.columns if isinstance(value, pd.DataFrame) else [value.name])],
+                   [str(t) for t in (value.dtypes if isinstance(value, pd.DataFrame) else [value.dtype])])
+    days = _days(value.index)
+    order = np.argsort(days.asi8, kind='stable')
+    unique, first = np.unique(days.asi8[order], return_index=True)
+    bounds = np.r_[first, len(order)]
+    return {pd.Timestamp(d): _sha1(layout.encode(), np.ascontiguousarray(rows[order[bounds[k]:bounds[k + 1]]]).tobytes())
+            for k, d in enumerate(unique)}
+
+
+def stage_keys(upstream, config, code):
+    """
+    Key of each day of a stage.
+
+    Args:
+        upstream (list): Dicts of day keys (or content hashes) of the inputs.
+        config: Settings of the stage (json serializable, str otherwise).
+        code (str): Code version (see code_version).
+    """
+    days = sorted({d for keys in upstream for d in keys})
+    return {d: _sha1([keys.get(d) for keys in upstream], config, code) for d in days}
+
+
+class CheckpointStore:
+    """Checkpoints of the levels of one instrument, in folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, level, day):
+        return os.path.join(self.folder, level, f'{day:%Y%m%d}.pkl')
+
+    def load(self, level, keys):
+        """
+        Level merged from the checkpoints of the days of keys, or None if one
+        is missing or saved under another key.
+        """
+        parts = []
+        for day, key in keys.items():
+            try:
+                with open(self.path(level, day), 'rb') as f:
+                    saved_key, value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+            if saved_key != key:
+                return None
+            parts.append(value)
+        return merge(parts) if parts else None
+
+    def save(self, level, value, keys):
+        """Save the days of keys of a level, replacing their previous checkpoints."""
+        os.makedirs(os.path.join(self.folder, level), exist_ok=True)
+        for day, key in keys.items():
+            path = self.path(level, day)
+            # Written aside then moved, an interrupted run leaves no partial checkpoint
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump((key, trim(value, [day, day])), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+
+
+def write_days(folder, name, value):
+    """
+    Write a level (DataFrame or dict of them indexed by time) as one pickle
+    per day, folder/<name>_<YYYYMMDD>.pkl.
+
+    Returns:
+        list: Paths written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for day in level_days(value):
+        path = os.path.join(folder, f'{name}_{day:%Y%m%d}.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(trim(value, [day, day]), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        paths.append(path)
+    return paths
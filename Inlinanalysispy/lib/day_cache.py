@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Day caches of the imported raw data.
+
+Each day read by i_read is stored in path_wk so that it does not need to be
+parsed again. Two backends are available:
+
+    npy     One folder per day ({prefix}{YYYYMMDD}{postfix}.ila) holding a
+            header.json and one .npy file per block of adjacent columns of
+            the same dtype. Blocks are memory mapped when loaded, so the ACS
+            spectra map straight into 2-D arrays and only the requested
+            columns are read from disk.
+    pickle  Legacy {prefix}{YYYYMMDD}{postfix}.pkl files.
+
+Usage to convert existing pickle caches (from the Inlinanalysispy folder):
+    python -m lib.day_cache path_wk [--remove]
+"""
+import argparse
+import glob
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+
+CACHE_SCHEMA_VERSION = 1
+
+
+class PickleDayCache:
+    """Legacy backend: one pickled DataFrame per day."""
+    name = 'pickle'
+    extension = '.pkl'
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            pickle.dump(data, f)
+
+    def read(self, path, columns=None, rows=None):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if rows is not None:
+            data = data.iloc[rows]
+        return data if columns is None else data[columns]
+
+    def read_index(self, path):
+        return self.read(path).index
+
+
+class NpyDayCache:
+    """Columnar backend: memory mappable .npy blocks plus a json header."""
+    name = 'npy'
+    extension = '.ila'
+
+    def exists(self, path):
+        return os.path.isfile(os.path.join(path, 'header.json'))
+
+    def write(self, path, data):
+        """
+        Write a DataFrame as blocks of adjacent columns sharing a dtype.
+
+        Numeric, boolean and datetime columns are stored as 2-D blocks; text
+        columns are stored one by one with their mask of missing values.
+        """
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        header = {'schema_version': CACHE_SCHEMA_VERSION,
+                  'n_rows': len(data),
+                  'index': _write_index(tmp, data.index),
+                  'columns': [],
+                  'blocks': [],
+                  'attrs': _to_json(data.attrs)}
+
+        i = 0
+        while i < data.shape[1]:
+            dtype = data.dtypes.iloc[i]
+            if _is_text(dtype):
+                j = i + 1
+            else:
+                j = i
+                while j < data.shape[1] and data.dtypes.iloc[j] == dtype:
+                    j += 1
+            block = {'file': f'block_{len(header["blocks"]):03d}.npy', 'dtype': str(dtype)}
+            if _is_text(dtype):
+                values, mask = _encode_text(data.iloc[:, i])
+                np.save(os.path.join(tmp, block['file']), values)
+                block['mask'] = block['file'].replace('.npy', '_mask.npy')
+                np.save(os.path.join(tmp, block['mask']), mask)
+            else:
+                np.save(os.path.join(tmp, block['file']),
+                        np.ascontiguousarray(data.iloc[:, i:j].to_numpy(dtype=dtype)))
+            for k in range(i, j):
+                header['columns'].append({'label': _to_json(data.columns[k]),
+                                          'block': len(header['blocks']), 'position': k - i})
+            header['blocks'].append(block)
+            i = j
+
+        with open(os.path.join(tmp, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    def read(self, path, columns=None, rows=None):
+        """
+        Load a day as a DataFrame, reading only the blocks holding columns
+        (list of labels or slice of positions) and the rows in rows (slice).
+
+        Blocks are memory mapped copy-on-write: pages are read from disk on
+        access and the DataFrame can still be modified in memory.
+        """
+        header = read_header(path)
+        rows = slice(None) if rows is None else rows
+        index = _read_index(path, header['index'])[rows]
+        selected = header['columns'] if columns is None else \
+            [header['columns'][i] for i in _find_columns(header, columns)]
+
+        frames = []
+        for b in _group_by_block(selected):
+            block = header['blocks'][b[0]['block']]
+            labels = [c['label'] for c in b]
+            values = load_block(path, block)[rows]
+            if values.ndim == 2:
+                values = _take_columns(values, [c['position'] for c in b])
+                frames.append(pd.DataFrame(values, index=index, columns=labels, copy=False))
+            else:
+                frames.append(pd.DataFrame({labels[0]: values}, index=index))
+
+        data = pd.concat(frames, axis=1) if frames else pd.DataFrame(index=index)
+        data.attrs = header.get('attrs', {})
+        return data
+
+    def read_index(self, path):
+        """Memory mapped index of a day, e.g. to find the rows of a time range."""
+        return _read_index(path, read_header(path)['index'])
+
+
+CACHE_BACKENDS = {'npy': NpyDayCache(), 'pickle': PickleDayCache()}
+
+
+def get_backend(name):
+    """Return the day cache backend registered under name."""
+    if name not in CACHE_BACKENDS:
+        raise ValueError(f'Unknown cache format: {name} ({", ".join(CACHE_BACKENDS)})')
+    return CACHE_BACKENDS[name]
+
+
+def read_header(path):
+    """Read and check the header of a npy day cache."""
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header.get('schema_version') != CACHE_SCHEMA_VERSION:
+        raise ValueError(f'{path}: cache schema version {header.get("schema_version")} '
+                         f'(expected {CACHE_SCHEMA_VERSION}), re-import with force=True')
+    return header
+
+
+def load_block(path, block, mmap_mode='c'):
+    """
+    Memory map one block of a npy day cache.
+
+    Text blocks are returned as an object array with None for missing values.
+    """
+    values = np.load(os.path.join(path, block['file']), mmap_mode=None if 'mask' in block else mmap_mode)
+    if 'mask' in block:
+        values = values.astype(object)
+        values[np.load(os.path.join(path, block['mask']))] = np.nan
+        return pd.array(values, dtype=block['dtype'])
+    return values
+
+
+def read_day_arrays(path, columns, mmap_mode='c'):
+    """
+    Return the index and a 2-D array of columns stored in a single block.
+
+    This is the zero-copy path for spectra: the array is a view of the memory
+    mapped block when columns are adjacent and in order (e.g. all a values).
+    As a and c wavelengths may share labels, columns can also be a slice of
+    column positions.
+    """
+    header = read_header(path)
+    selected = [header['columns'][i] for i in _find_columns(header, columns)]
+    blocks = {c['block'] for c in selected}
+    if len(blocks) != 1:
+        raise ValueError(f'{path}: columns are stored in {len(blocks)} blocks')
+    values = load_block(path, header['blocks'][blocks.pop()], mmap_mode)
+    return _read_index(path, header['index']), _take_columns(values, [c['position'] for c in selected])
+
+
+def convert_pickle_cache(dirname, remove=False, verbose=False):
+    """
+    Convert the legacy .pkl day caches of dirname to the npy format.
+
+    Args:
+        dirname (str): Folder holding the .pkl files (path_wk).
+        remove (bool): Delete each .pkl once converted.
+        verbose (bool): Print the converted files.
+
+    Returns:
+        list: Paths of the npy caches written.
+    """
+    src, dst = CACHE_BACKENDS['pickle'], CACHE_BACKENDS['npy']
+    converted = []
+    for fn in sorted(glob.glob(os.path.join(dirname, '*' + src.extension))):
+        fn_out = fn[:-len(src.extension)] + dst.extension
+        dst.write(fn_out, src.read(fn))
+        converted.append(fn_out)
+        if remove:
+            os.remove(fn)
+        if verbose:
+            print(f'Converted {fn} -> {fn_out}')
+    return converted
+
+
+# Helpers
+def _is_text(dtype):
+    return dtype == object or isinstance(dtype, pd.StringDtype)
+
+
+def _encode_text(col):
+    mask = col.isna().to_numpy()
+    values = col.astype(object).where(~mask, '').to_numpy()
+    if not all(isinstance(v, str) for v in values):
+        raise TypeError(f'Column {col.name} holds values that are neither text nor missing.')
+    return np.array(values, dtype=str), mask
+
+
+def _write_index(dirname, index):
+    np.save(os.path.join(dirname, 'index.npy'), np.asarray(index))
+    return {'file': 'index.npy', 'name': _to_json(index.name)}
+
+
+def _read_index(dirname, index):
+    values = np.load(os.path.join(dirname, index['file']), mmap_mode='c')
+    return pd.Index(values, name=index['name'], copy=False)
+
+
+def _find_columns(header, columns):
+    labels = [c['label'] for c in header['columns']]
+    if isinstance(columns, slice):
+        return list(range(len(labels)))[columns]
+    missing = [c for c in columns if _to_json(c) not in labels]
+    if missing:
+        raise KeyError(f'Columns not in cache: {missing}')
+    wanted = [_to_json(c) for c in columns]
+    return [labels.index(c) for c in wanted]
+
+
+def _take_columns(values, positions):
+    """Select columns of a 2-D block, as a view if they are adjacent."""
+    if positions == list(range(positions[0], positions[0] + len(positions))):
+        return values[:, positions[0]:positions[0] + len(positions)]
+    return values[:, positions]
+
+
+def _group_by_block(columns):
+    groups = []
+    for c in columns:
+        if groups and groups[-1][-1]['block'] == c['block']:
+            groups[-1].append(c)
+        else:
+            groups.append([c])
+    return groups
+
+
+def _to_json(value):
+    """Convert numpy scalars (e.g. float wavelengths) to json types."""
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pickle day caches to the npy format.')
+    parser.add_argument('dirname', help='folder holding the .pkl day caches (path_wk)')
+    parser.add_argument('--remove', action='store_true', help='delete the .pkl files once converted')
+    args = parser.parse_args()
+    convert_pickle_cache(args.dirname, args.remove, verbose=True)
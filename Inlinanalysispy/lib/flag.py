@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Flagging of binned data with the fudge factor tests of the [flag] section.
+
+Each bin (avg, std and n of each variable, see lib.binning) is compared to
+the bins around it, within smooth_threshold minutes:
+
+    FLAG_AVG             avg away from the running mean of avg by more than
+                         maximum_fudge_factor x avg_sensitivity running std
+                         of avg (the bin itself left out)
+    FLAG_VARIANCE        std above variance_fudge_factor x unc1_sensitivity
+                         times the running mean of std
+    FLAG_VARIANCE_HIGH   std above variance_fudge_factor x unc2_sensitivity
+                         times the running mean of std
+    FLAG_FEW             bin without any value (n = 0)
+
+A bin gets a flag when at least min_flag_n of its variables (e.g. ACS
+wavelengths) fail the test. Flags are bits of one uint8 code per bin.
+
+Running sums over time windows come from cumulative sums between the
+window bounds found by np.searchsorted, in O(n) whatever the window length,
+for all columns at once (by chunks of columns to bound memory) and with
+gaps in time taken into account.
+"""
+import numpy as np
+import pandas as pd
+
+FLAG_AVG = 1
+FLAG_VARIANCE = 2
+FLAG_VARIANCE_HIGH = 4
+FLAG_FEW = 8
+FLAG_NAMES = {FLAG_AVG: 'avg', FLAG_VARIANCE: 'variance', FLAG_VARIANCE_HIGH: 'variance_high', FLAG_FEW: 'few'}
+# Values per chunk of columns of the running sums
+CHUNK_VALUES = 1 << 22
+
+
+def window_bounds(dt, window):
+    """First and last + 1 rows within window/2 of each row (dt sorted, int64 ns)."""
+    half = int(window // 2)
+    return np.searchsorted(dt, dt - half, side='left'), np.searchsorted(dt, dt + half, side='right')
+
+
+def _running_sum(v, lo, hi, exclude_self):
+    c = np.zeros((len(v) + 1,) + v.shape[1:])
+    np.cumsum(v, axis=0, out=c[1:])
+    total = np.take(c, hi, axis=0)
+    total -= np.take(c, lo, axis=0)
+    if exclude_self:
+        total -= v
+    return total
+
+
+def rolling_mean_std(values, bounds, exclude_self=False, with_std=True):
+    """
+    Running mean and standard deviation (ddof=1, None unless with_std) of
+    each column between bounds (see window_bounds), NaN excluded, from
+    cumulative sums.
+
+    With exclude_self, each row is left out of its own window.
+    """
+    lo, hi = bounds
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    row_valid = valid.all(axis=1)
+    if np.array_equal(row_valid, valid.any(axis=1)):
+        # Missing values are whole rows (empty bins): one count for all columns
+        n = _running_sum(row_valid.astype(float), lo, hi, exclude_self)[:, None]
+    else:
+        n = _running_sum(valid.astype(float), lo, hi, exclude_self)
+    # Centred on the column means (0 for columns without values), the
+    # cumulative sums keep their precision
+    x = np.where(valid, values, 0)
+    offset = x.sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+    x = np.where(valid, values - offset, 0)
+    s1 = _running_sum(x, lo, hi, exclude_self)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        std = None
+        if with_std:
+            x *= x
+            s2 = _running_sum(x, lo, hi, exclude_self)
+            s2 -= s1 * mean
+            s2 /= n - 1
+            std = np.sqrt(np.clip(s2, 0, None))
+            std[np.broadcast_to(n < 2, std.shape)] = np.nan
+    mean[np.broadcast_to(n < 1, mean.shape)] = np.nan
+    mean += offset
+    return mean, std
+
+
+def flag_arrays(dt, avg, std, n, smooth_threshold=60, maximum_fudge_factor=4, variance_fudge_factor=3,
+                avg_sensitivity=1, unc1_sensitivity=1, unc2_sensitivity=2, min_flag_n=1):
+    """
+    Flag codes of bins.
+
+    Args:
+        dt (array): Sorted time of the bins, int64 ns.
+        avg, std, n (array): Bins x variables statistics (see lib.binning).
+        smooth_threshold (float): Window of the running statistics, minutes.
+        maximum_fudge_factor, variance_fudge_factor, avg_sensitivity,
+        unc1_sensitivity, unc2_sensitivity, min_flag_n: Tests, see module.
+
+    Returns:
+        array: uint8 flag code of each bin.
+    """
+    avg, std, n = (np.asarray(v, dtype=float).reshape(len(dt), -1) for v in (avg, std, n))
+    dt = np.asarray(dt, dtype=np.int64)
+    bounds = window_bounds(dt, smooth_threshold * 60e9)
+    counts = {code: np.zeros(len(dt), dtype=np.int32) for code in FLAG_NAMES}
+    step = max(1, CHUNK_VALUES // max(len(dt), 1))
+    for k in range(0, avg.shape[1], step):
+        cols = slice(k, k + step)
+        mean_avg, std_avg = rolling_mean_std(avg[:, cols], bounds, exclude_self=True)
+        mean_std, _ = rolling_mean_std(std[:, cols], bounds, with_std=False)
+        with np.errstate(invalid='ignore'):
+            counts[FLAG_AVG] += (np.abs(avg[:, cols] - mean_avg) >
+                                 maximum_fudge_factor * avg_sensitivity * std_avg).sum(axis=1)
+            ratio = std[:, cols] / mean_std
+            counts[FLAG_VARIANCE] += (ratio > variance_fudge_factor * unc1_sensitivity).sum(axis=1)
+            counts[FLAG_VARIANCE_HIGH] += (ratio > variance_fudge_factor * unc2_sensitivity).sum(axis=1)
+        counts[FLAG_FEW] += (n[:, cols] == 0).sum(axis=1)
+
+    code = np.zeros(len(dt), dtype=np.uint8)
+    for bit, count in counts.items():
+        code[count >= max(min_flag_n, 1)] |= bit
+    return code
+
+
+def flag_bins(binned, **kwargs):
+    """
+    Flag codes of binned data (output of lib.binning.bin_data).
+
+    Args:
+        binned (pd.DataFrame): Bins indexed by time, with (stat, variable) columns.
+        **kwargs: Settings of the [flag] section, see flag_arrays.
+
+    Returns:
+        pd.Series: uint8 flag code of each bin.
+    """
+    dt = pd.DatetimeIndex(binned.index).as_unit('ns').asi8
+    order = np.argsort(dt, kind='stable') if not binned.index.is_monotonic_increasing else None
+    stats = [binned[s].to_numpy(dtype=float) for s in ('avg', 'std', 'n')]
+    if order is not None:
+        dt, stats = dt[order], [s[order] for s in stats]
+    code = flag_arrays(dt, *stats, **kwargs)
+    if order is not None:
+        code = code[np.argsort(order)]
+    return pd.Series(code, index=binned.index, name='flag')
+
+
+def flag_names(code):
+    """Names of the flags set in a flag code."""
+    return [name for bit, name in FLAG_NAMES.items() if int(code) & bit]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Phytoplankton size from ap with the linear regression models of Haëntjens et
+al. (2021): G50 (median size) and mphi (slope of the size distribution).
+
+Each model is a linear regression on features of the ap spectrum: ap at the
+feature wavelengths of the model, normalised by their sum (spectral shape,
+independent of the concentration), standardised with the mean and scale of
+the training set:
+
+    y = intercept + ((features - mean) / scale) @ coef
+
+The .mat files are read once per process (load_model is cached on the
+resolved path, scipy is imported with the first) into LinearModel tuples of
+small float arrays. Models are evaluated on all spectra together: ap is
+interpolated once on the union of the feature wavelengths of the models,
+and the coefficients of all models are stacked in one (features x models)
+matrix, so that G50 and mphi of n spectra are one (n x features) @
+(features x models) product.
+
+Layout of the .mat files read (FIELDS); a file of any other layout raises
+ValueError:
+
+    variable    model_G50 in HTJS20_LinearRegression_5features.mat,
+                model_mphi in HTJS20_LinearRegression_5P-mphi.mat (HTJS_MODELS)
+    fields      a structure of exactly lambda (feature wavelengths, nm), coef,
+                mu and sigma (coefficient, mean and scale of each feature) and
+                intercept (scalar)
+    features    ap at the feature wavelengths divided by their sum
+
+No model file nor reference output ships with the package, and the features
+have not been checked against the published models: G50 and mphi are only
+computed by ACS.calibrate when htjs_enable is set for the instrument, after
+checking the models give the published outputs.
+"""
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from lib.acs_processing import interp_wavelength
+
+# Files and variables of the models of Haëntjens et al. (2021)
+HTJS_MODELS = {'G50': ('HTJS20_LinearRegression_5features.mat', 'model_G50'),
+               'mphi': ('HTJS20_LinearRegression_5P-mphi.mat', 'model_mphi')}
+# Folder of the model files shipped with the package
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+# Field of the model structures of each part of LinearModel
+FIELDS = {'wavelengths': 'lambda', 'coef': 'coef', 'intercept': 'intercept', 'mean': 'mu', 'scale': 'sigma'}
+
+# Feature wavelengths, mean and scale of the features, coefficients and intercept
+LinearModel = namedtuple('LinearModel', ['wavelengths', 'mean', 'scale', 'coef', 'intercept'])
+# Linear models stacked for evaluate, see stack_models
+StackedModels = namedtuple('StackedModels', ['names', 'wavelengths', 'columns', 'first', 'weights', 'offset'])
+
+
+def resolve_path(filename, folder=None):
+    """
+    Path of a model file: in folder (e.g. htjs_model_path of [calibrate]),
+    else in the data folder of the package, else in the working directory.
+    """
+    for candidate in ([folder] if folder else []) + [DATA_DIR, os.getcwd()]:
+        path = os.path.abspath(os.path.join(os.path.expanduser(candidate), filename))
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f'HTJS model {filename} not found in {folder or ""} {DATA_DIR} or {os.getcwd()}.')
+
+
+def _fields(struct, variable, path):
+    """Fields of a model structure as float arrays, ValueError if not exactly FIELDS."""
+    names = set(struct) if isinstance(struct, dict) else set(getattr(struct, '_fieldnames', None) or ())
+    if names != set(FIELDS.values()):
+        raise ValueError(f'HTJS model: {variable} of {path} has the fields {", ".join(sorted(names)) or "none"}, '
+                         f'expected {", ".join(sorted(FIELDS.values()))}.')
+    try:
+        return {key: np.atleast_1d(np.asarray(struct[name] if isinstance(struct, dict) else getattr(struct, name),
+                                              dtype=float)).ravel()
+                for key, name in FIELDS.items()}
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'HTJS model: {variable} of {path} has a non numeric field ({e}).')
+
+
+@lru_cache(maxsize=None)
+def load_model(path, variable):
+    """
+    Linear model of variable in the .mat file path, read once per process.
+
+    Raises:
+        ValueError: The file is not readable, or the model not of the layout
+            of FIELDS (one wavelength, coefficient, mean and finite non zero
+            scale per feature, one intercept).
+    """
+    from scipy.io import loadmat  # scipy loaded with the first model only
+    try:
+        struct = loadmat(path, squeeze_me=True, struct_as_record=False)[variable]
+    except KeyError:
+        raise ValueError(f'HTJS model: no variable {variable} in {path}.')
+    except NotImplementedError as e:
+        # MATLAB v7.3 (HDF5) files are not read by scipy
+        raise ValueError(f'HTJS model: {path} cannot be read ({e}).')
+    f = _fields(struct, variable, path)
+    n = len(f['wavelengths'])
+    if any(len(f[key]) != n for key in ('coef', 'mean', 'scale')) or len(f['intercept']) != 1:
+        raise ValueError(f'HTJS model: {variable} of {path} has ' +
+                         ', '.join(f'{len(f[key])} {FIELDS[key]}' for key in FIELDS) +
+                         f', expected {n} of each and 1 intercept.')
+    if not all(np.isfinite(v).all() for v in f.values()) or not np.all(f['scale'] != 0):
+        raise ValueError(f'HTJS model: {variable} of {path} has non finite values or a zero sigma.')
+    return LinearModel(f['wavelengths'], f['mean'], f['scale'], f['coef'], float(f['intercept'][0]))
+
+
+@lru_cache(maxsize=None)
+def load_models(folder=None):
+    """
+    Models of G50 and mphi (see HTJS_MODELS) stacked for evaluate, the files
+    resolved in folder; loaded once per process and folder.
+    """
+    return stack_models({name: load_model(resolve_path(filename, folder), variable)
+                         for name, (filename, variable) in HTJS_MODELS.items()})
+
+
+def stack_models(models):
+    """
+    Models of a dict of LinearModel stacked in one linear map.
+
+    Returns:
+        StackedModels: Output names, union of the feature wavelengths, feature
+        columns of all models (in the union), first feature of each model,
+        (features x models) coefficients on the normalised features and
+        offset of each model (intercept and mean of the standardisation).
+    """
+    names = tuple(models)
+    wavelengths = np.unique(np.concatenate([m.wavelengths for m in models.values()]))
+    columns = np.concatenate([np.searchsorted(wavelengths, m.wavelengths) for m in models.values()])
+    sizes = [len(m.coef) for m in models.values()]
+    first = np.r_[0, np.cumsum(sizes)[:-1]].astype(int)
+    weights = np.zeros((len(columns), len(names)))
+    for k, m in enumerate(models.values()):
+        weights[first[k]:first[k] + sizes[k], k] = m.coef / m.scale
+    offset = np.array([m.intercept - np.sum(m.coef * m.mean / m.scale) for m in models.values()])
+    return StackedModels(names, wavelengths, columns, first, weights, offset)
+
+
+def evaluate(models, ap, lambda_a, dtype=np.float64):
+    """
+    Outputs of the models for all spectra.
+
+    Args:
+        models (StackedModels): Models (see load_models and stack_models).
+        ap (array): Spectra x wavelengths particulate absorption.
+        lambda_a (array): Wavelengths of ap.
+        dtype: Type of the features and of the product (float32 halves their memory).
+
+    Returns:
+        dict: Output of each model, one value per spectrum (NaN where ap is
+        missing at a feature wavelength).
+    """
+    ap = interp_wavelength(np.asarray(ap), lambda_a, models.wavelengths)[:, models.columns].astype(dtype)
+    # Normalised by the sum of ap at the features of each model
+    sizes = np.diff(np.r_[models.first, len(models.columns)])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ap /= np.repeat(np.add.reduceat(ap, models.first, axis=1), sizes, axis=1)
+    out = ap @ models.weights.astype(dtype) + models.offset.astype(dtype)
+    return {name: out[:, k] for k, name in enumerate(models.names)}
@@ -4,11 +4,282 @@ import os
 import pandas as pd
 from datetime import datetime, timedelta
 import warnings
-import pickle  # For saving/loading `.mat` equivalent files
 import glob
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from lib.day_cache import get_backend, CACHE_BACKENDS
+from lib.cache_manifest import (parser_signature, file_signature, read_manifest, write_manifest,
+                                remove_manifest, changed_files, cached_rows, sha1)
+from lib.time_index import (raw_file_span, span_entry, manifest_spans, overlaps, rows_in_window)
+
+# Work to do for one day: existing cache (backend or None), raw files behind
+# the day (None if unknown) and their signatures taken before parsing, raw
+# files to parse, manifest of the cache, and whether the data must be rebuilt
+# from the files and the manifest rewritten
+DayPlan = namedtuple('DayPlan', ['day', 'fn_base', 'source', 'files', 'signatures', 'to_import', 'manifest',
+                                 'rebuild', 'refresh'])
+
+
+class FileImportError(Exception):
+    """Error raised by an import function, with the name of the file read."""
+
+    def __init__(self, file, error):
+        super().__init__(f"{file}: {type(error).__name__}: {error}")
+        self.file = file
+
+
+def n_workers_from_flag(parallel_flag):
+    """
+    Number of worker processes for a parallel flag.
+
+    -1 or inf use all available cores, 0, 1 or None read serially.
+    """
+    if parallel_flag is None:
+        return 1
+    if parallel_flag == -1 or parallel_flag == float('inf'):
+        return os.cpu_count() or 1
+    return max(1, min(int(parallel_flag), os.cpu_count() or 1))
+
+
+def list_files_from_software(software, dir_in, prefix, dt, postfix):
+    """Lists files based on the software type and datetime."""
+    if software in {'WetView', 'Compass_2.1rc', 'Compass_2.1rc_scheduled'}:
+        file_pattern = f"{prefix}*{postfix}.dat" if software != 'Compass_2.1rc_scheduled_bin' else f"{prefix}*{postfix}.bin"
+    elif software == 'Inlinino':
+        file_pattern = f"{prefix}*{dt.strftime('%Y%m%d')}*{postfix}.csv"
+        print(file_pattern)
+    else:
+        raise ValueError(f"Software {software} not supported.")
+
+    # Sorted so that data are always combined in the same order
+    files2read=sorted(glob.glob("{}/{}".format(dir_in,file_pattern)))
+    print(files2read)
+
+    return files2read
+
+
+def import_file(fun, file, otherarg1=None, otherarg2=None):
+    """Wrapper to handle import function calls with optional arguments."""
+    if otherarg1 is not None and otherarg2 is not None:
+        return fun(file, otherarg1, otherarg2)
+    elif otherarg1 is not None:
+        return fun(file, otherarg1)
+    else:
+        return fun(file)
+
+
+def _gather(files, futures):
+    """Results of the futures importing files, in order, with errors tagged."""
+    data = []
+    for file, future in zip(files, futures):
+        try:
+            data.append(future.result())
+        except Exception as e:
+            for f in futures:
+                f.cancel()
+            raise FileImportError(file, e) from e
+    return data
+
+
+def import_files(fun, files, parallel_flag=-1, verbose=False, otherarg1=None, otherarg2=None):
+    """
+    Import a list of files, in a pool of processes if parallel_flag allows it.
+
+    Args:
+        fun (function): Import function, fun(file[, otherarg1[, otherarg2]]).
+        files (list): Files to import.
+        parallel_flag (int): Number of parallel workers (-1 or inf for all available).
+        verbose (bool): Print verbose output.
+        otherarg1, otherarg2: Additional arguments for the import function.
+
+    Returns:
+        list: Output of fun for each file, in the order of files.
+
+    Raises:
+        FileImportError: If fun fails on a file, with the file name attached.
+    """
+    n_workers = min(n_workers_from_flag(parallel_flag), len(files))
+    if verbose:
+        print(f"Importing {len(files)} files with {max(n_workers, 1)} process(es)")
+
+    if n_workers <= 1:
+        data = []
+        for file in files:
+            try:
+                data.append(import_file(fun, file, otherarg1, otherarg2))
+            except Exception as e:
+                raise FileImportError(file, e) from e
+        return data
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return _gather(files, [executor.submit(import_file, fun, file, otherarg1, otherarg2) for file in files])
+
+
+def list_days(dirname_in, dirname_out, prefix, dt, software, force=False, postfix='', cache='npy',
+              parser=None, checksum=False):
+    """
+    List, day by day, the cache to load and the raw files to import.
+
+    A cache with a manifest is checked against the raw files of its day:
+    only new or changed files are to be imported and merged into it. A cache
+    without manifest (e.g. written before manifests) is rebuilt once from the
+    raw files of its day, which writes its manifest. Caches whose raw files
+    are not available are trusted.
+
+    Args:
+        parser (dict): Signature of the import function (see parser_signature).
+        checksum (bool): Compare the sha1 of raw files whose modification
+            time changed before re-importing them.
+        Other arguments: see i_read.
+
+    Returns:
+        list: DayPlan of each day with data.
+    """
+    backend = get_backend(cache)
+    others = [b for b in CACHE_BACKENDS.values() if b is not backend]
+
+    # Floor datetime to start of the day
+    start_dt = datetime(dt[0].year, dt[0].month, dt[0].day)
+    end_dt = datetime(dt[1].year, dt[1].month, dt[1].day)
+
+    days = []
+    current_dt = start_dt
+    while current_dt <= end_dt:
+        # Construct output file name
+        fn_base = os.path.join(dirname_out, f"{prefix}{current_dt.strftime('%Y%m%d')}{postfix}")
+        source = None
+        if not force:
+            source = next((b for b in [backend] + others if b.exists(fn_base + b.extension)), None)
+
+        # Get list of files for the current date
+        files = list_files_from_software(software, dirname_in, prefix, current_dt, postfix)
+        manifest = read_manifest(fn_base) if source is not None else None
+
+        signatures = [file_signature(f) for f in files]
+        if source is not None and not files:
+            days.append(DayPlan(current_dt, fn_base, source, None, None, [], None, False, False))
+        elif source is not None and manifest is None:
+            # Nothing tells which raw files the cache holds: read the day again
+            days.append(DayPlan(current_dt, fn_base, None, files, signatures, files, None, True, True))
+        elif source is not None:
+            stale, removed, touched = changed_files(manifest, files, parser, checksum)
+            rebuild = bool(stale or removed)
+            days.append(DayPlan(current_dt, fn_base, source, files, signatures, stale, manifest,
+                                rebuild, rebuild or bool(touched)))
+        elif files:
+            days.append(DayPlan(current_dt, fn_base, None, files, signatures, files, None, True, True))
+        else:
+            warnings.warn(f"No files found for date {current_dt.strftime('%Y-%m-%d')}")
+
+        # Increment date
+        current_dt += timedelta(days=1)
+
+    return days
+
+
+def i_read_iter(fun, dirname_in, dirname_out, prefix, dt, software, force=False, nowrite=False, verbose=False,
+                postfix='', parallel_flag=-1, otherarg1=None, otherarg2=None, cache='npy', checksum=False):
+    """
+    Generator yielding the data of one day at a time, see i_read for the arguments.
+
+    With parallel workers, the raw files of the next days are imported while
+    the current day is processed by the caller, with at most two files per
+    worker in flight so that memory stays bounded.
+
+    Yields:
+        pd.DataFrame: Processed data of each day with data, in time order.
+    """
+    # Ensure output directory exists
+    if not os.path.exists(dirname_out):
+        os.makedirs(dirname_out)
+
+    backend = get_backend(cache)
+    parser = parser_signature(fun, otherarg1, otherarg2)
+    days = list_days(dirname_in, dirname_out, prefix, dt, software, force, postfix, cache, parser, checksum)
+    n_files = sum(len(plan.to_import) for plan in days)
+    n_workers = min(n_workers_from_flag(parallel_flag), n_files)
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+
+    def submit(day_files):
+        return [executor.submit(import_file, fun, file, otherarg1, otherarg2) for file in day_files]
+
+    try:
+        # Days whose raw files are being imported
+        pending = {}
+        ahead = 0
+        for k, plan in enumerate(days):
+            if executor is not None:
+                while ahead < len(days) and sum(len(f) for f in pending.values()) < 2 * n_workers:
+                    if days[ahead].to_import:
+                        pending[ahead] = submit(days[ahead].to_import)
+                    ahead += 1
+
+            if plan.to_import:
+                if verbose:
+                    print(f"Processing {len(plan.to_import)} files for {plan.day.strftime('%Y-%m-%d')}")
+                if executor is not None:
+                    imported = _gather(plan.to_import, pending.pop(k) if k in pending else submit(plan.to_import))
+                else:
+                    imported = import_files(fun, plan.to_import, 1, verbose, otherarg1, otherarg2)
+                imported = dict(zip(plan.to_import, imported))
+            else:
+                imported = {}
+
+            if plan.source is not None:
+                # Load existing processed data
+                if verbose:
+                    print(f"Loading existing file: {plan.fn_base + plan.source.extension}")
+                data = plan.source.read(plan.fn_base + plan.source.extension)
+
+            if plan.refresh:
+                rows = cached_rows(plan.manifest) if plan.manifest else {}
+            if plan.rebuild and plan.source is not None and \
+                    sum(stop - start for start, stop in rows.values()) != len(data):
+                warnings.warn(f"{plan.fn_base}: cache does not match its manifest, re-importing the day")
+                missing = [f for f in plan.files if f not in imported]
+                imported.update(zip(missing, import_files(fun, missing, parallel_flag, verbose,
+                                                          otherarg1, otherarg2)))
+            if plan.rebuild:
+                # Merge the new and changed files with the unchanged part of the cache
+                pieces = [imported[f] if f in imported else data.iloc[slice(*rows[os.path.basename(f)])]
+                          for f in plan.files]
+                # Combine imported data
+                data = pd.concat(pieces) #, ignore_index=True)
+                n_rows = [len(p) for p in pieces]
+            elif plan.refresh:
+                n_rows = [rows[os.path.basename(f)][1] - rows[os.path.basename(f)][0] for f in plan.files]
+
+            # Save processed data if needed, converting caches of another format
+            if not nowrite:
+                if plan.rebuild or plan.source is not backend:
+                    fn_out = plan.fn_base + backend.extension
+                    if plan.rebuild:
+                        remove_manifest(plan.fn_base)
+                    backend.write(fn_out, data)
+                    if verbose:
+                        print(f"Saved file: {fn_out}")
+                if plan.refresh:
+                    recorded = {f['name']: f for f in plan.manifest['files']} if plan.manifest else {}
+                    entries = []
+                    stop = 0
+                    for f, sig, n in zip(plan.files, plan.signatures, n_rows):
+                        entry = dict(sig, rows=n, **span_entry(data.index, stop, stop + n))
+                        stop += n
+                        if checksum:
+                            old = recorded.get(sig['name'], {})
+                            entry['sha1'] = old['sha1'] if f not in imported and 'sha1' in old else sha1(f)
+                        entries.append(entry)
+                    write_manifest(plan.fn_base, parser, entries)
+
+            yield data
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
 
 def i_read(fun, dirname_in, dirname_out, prefix, dt, software, force=False, nowrite=False, verbose=False, 
-          read_margin=True, postfix='', parallel_flag=-1, otherarg1=None, otherarg2=None):
+          read_margin=None, postfix='', parallel_flag=-1, otherarg1=None, otherarg2=None, cache='npy',
+          checksum=False):
     """
     Reads and processes data files based on specific criteria.
 
@@ -22,112 +293,148 @@ def i_read(fun, dirname_in, dirname_out, prefix, dt, software, force=False, nowr
         force (bool): Force re-importing of data even if saved files exist.
         nowrite (bool): Do not write processed data to the output directory.
         verbose (bool): Print verbose output.
-        read_margin (bool): Read an extra margin around the time range.
+        read_margin (timedelta): Also read this margin before the first and after the
+            last day, reading only the files or cached rows it overlaps (see
+            i_read_window). None to read whole days only.
         postfix (str): File extension (e.g., '.csv', '.dat').
-        parallel_flag (int): Number of parallel workers (-1 for all available).
+        parallel_flag (int): Number of parallel workers importing the raw files of all
+            days (-1 or inf for all available, 1 to read serially).
         otherarg1, otherarg2: Additional arguments for the import function.
+        cache (str): Format of the day caches written to dirname_out ('npy' or
+            'pickle', see lib.day_cache). Caches of the other formats are still
+            read, and converted if writing is allowed.
+        checksum (bool): Record the sha1 of raw files in the cache manifests, and
+            compare it before re-importing a file whose modification time changed.
+
+    Caches come with a manifest of the raw files behind them (see
+    lib.cache_manifest): raw files that are new or changed since a cache was
+    written are imported and merged into it, the others are not read again.
 
     Returns:
         pd.DataFrame: Processed data for the specified time range.
     """
-    
-    
-    def ensure_directory(path):
-        """Ensures the output directory exists."""
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    def list_files_from_software(software, dir_in, prefix, dt, postfix):
-
-        """Lists files based on the software type and datetime."""
-        if software in {'WetView', 'Compass_2.1rc', 'Compass_2.1rc_scheduled'}:
-            file_pattern = f"{prefix}*{postfix}.dat" if software != 'Compass_2.1rc_scheduled_bin' else f"{prefix}*{postfix}.bin"
-        elif software == 'Inlinino':
-            file_pattern = f"{prefix}*{dt.strftime('%Y%m%d')}*{postfix}.csv"
-            print(file_pattern)
-        else:
-            raise ValueError(f"Software {software} not supported.")
-        
-        files2read=glob.glob("{}/{}".format(dir_in,file_pattern))
-        print(files2read)
-        
-        return files2read
-
-    def import_file(file, verbose=False):
-        """Wrapper to handle import function calls with optional arguments."""
+    # Days are concatenated once, i_read_iter streams them one at a time
+    days = list(i_read_iter(fun, dirname_in, dirname_out, prefix, dt, software, force, nowrite, verbose,
+                            postfix, parallel_flag, otherarg1, otherarg2, cache, checksum))
+    gdata = pd.concat(days) if days else pd.DataFrame() #, ignore_index=True)
+
+    # Handle read margins if specified
+    if read_margin and not gdata.empty:
+        margin = pd.Timedelta(read_margin)
+        start_dt = pd.Timestamp(datetime(dt[0].year, dt[0].month, dt[0].day))
+        end_dt = pd.Timestamp(datetime(dt[1].year, dt[1].month, dt[1].day)) + pd.Timedelta(days=1)
         if verbose:
-            print(f"Processing file: {file}")
-        if otherarg1 is not None and otherarg2 is not None:
-            return fun(file, otherarg1, otherarg2, verbose)
-        elif otherarg1 is not None:
-            return fun(file, otherarg1, verbose)
-        else:
-            return fun(file, verbose)
+            print("Reading margins...")
+        pre_data = i_read_window(fun, dirname_in, dirname_out, prefix, [start_dt - margin, start_dt],
+                                 software, None, force, verbose, postfix, parallel_flag, otherarg1, otherarg2, cache, checksum)
+        pre_data = pre_data[pre_data.index < start_dt] if not pre_data.empty else pre_data
+        post_data = i_read_window(fun, dirname_in, dirname_out, prefix, [end_dt, end_dt + margin],
+                                  software, None, force, verbose, postfix, parallel_flag, otherarg1, otherarg2, cache, checksum)
+        gdata = pd.concat([d for d in (pre_data, gdata, post_data) if not d.empty])
 
-    # Ensure output directory exists
-    ensure_directory(dirname_out)
+    return gdata
 
-    # Floor datetime to start of the day
-    start_dt = datetime(dt[0].year, dt[0].month, dt[0].day)
-    end_dt = datetime(dt[1].year, dt[1].month, dt[1].day)
 
-    gdata = pd.DataFrame()
-    current_dt = start_dt
+def i_read_window(fun, dirname_in, dirname_out, prefix, window, software, margin=None, force=False, verbose=False,
+                  postfix='', parallel_flag=-1, otherarg1=None, otherarg2=None, cache='npy', checksum=False):
+    """
+    Reads the data of an arbitrary time window, e.g. a few minutes around a day boundary.
 
-    while current_dt <= end_dt:
-        # Construct output file name
-        fn_out = os.path.join(dirname_out, f"{prefix}{current_dt.strftime('%Y%m%d')}{postfix}.pkl")
-
-        if not force and os.path.exists(fn_out):
-            # Load existing processed data
-            if verbose:
-                print(f"Loading existing file: {fn_out}")
-            with open(fn_out, 'rb') as f:
-                data = pickle.load(f)
-        else:
-            # Get list of files for the current date
-            files = list_files_from_software(software, dirname_in, prefix, current_dt, postfix)
-            if not files:
-                warnings.warn(f"No files found for date {current_dt.strftime('%Y-%m-%d')}")
-                current_dt += timedelta(days=1)
-                continue
-
-            # Import data in parallel
-            if verbose:
-                print(f"Processing files for {current_dt.strftime('%Y-%m-%d')}")
-            data=[fun(i) for i in files]
-
-            # Combine imported data
-            data = pd.concat(data) #, ignore_index=True)
-            
-
-            # Save processed data if needed            import_inlinino_base(self.cfg["path_raw"])
-
-            if nowrite is True:
-                with open(fn_out, 'wb') as f:
-                    pickle.dump(data, f)
-                if verbose:
-                    print(f"Saved file: {fn_out}")
+    Only the cached rows and the raw files overlapping the window are read: cached
+    days are sliced on their (memory mapped) index, raw files behind a cache are
+    selected on the spans recorded in its manifest, and other raw files on the time
+    of their first and last lines (see lib.time_index). Caches are not written,
+    days are cached by i_read.
 
-        # Add data to global dataset
-        gdata = pd.concat([gdata, data]) #, ignore_index=True)
+    Args:
+        window (list): Start and end datetime of the data to read (both included).
+        margin (timedelta): Extra time read on both sides of the window.
+        Other arguments: see i_read.
 
-        # Increment date
-        current_dt += timedelta(days=1)
+    Returns:
+        pd.DataFrame: Processed data within the window.
+    """
+    start, end = pd.Timestamp(window[0]), pd.Timestamp(window[1])
+    if margin:
+        start, end = start - pd.Timedelta(margin), end + pd.Timedelta(margin)
 
-    # # Handle read margins if specified
-    # if read_margin:
-    #     margin_days = timedelta(days=1)
-    #     if verbose:
-    #         print("Reading margins...")
-    #     pre_data = iRead(fun, dirname_in, dirname_out, prefix, [start_dt - margin_days], software, 
-    #                      force, nowrite, verbose, False, postfix, parallel_flag, otherarg1, otherarg2)
-    #     post_data = iRead(fun, dirname_in, dirname_out, prefix, [end_dt + margin_days], software, 
-    #                       force, nowrite, verbose, False, postfix, parallel_flag, otherarg1, otherarg2)
-
-    #     if not pre_data.empty:
-    #         gdata = pd.concat([pre_data, gdata], ignore_index=True)
-    #     if not post_data.empty:
-    #         gdata = pd.concat([gdata, post_data], ignore_index=True)
+    parser = parser_signature(fun, otherarg1, otherarg2)
+    pieces, raw_files = [], []
+    for plan in list_days(dirname_in, dirname_out, prefix, [start, end], software, force, postfix, cache,
+                          parser, checksum):
+        fn = plan.fn_base + plan.source.extension if plan.source is not None else None
+        index = plan.source.read_index(fn) if plan.source is not None else None
+        if plan.source is not None and not plan.rebuild:
+            pieces.append(plan.source.read(fn, rows=rows_in_window(index, start, end)))
+            continue
 
-    return gdata
+        # Cached rows of the unchanged raw files, if the cache matches its manifest
+        rows = cached_rows(plan.manifest) if plan.manifest else {}
+        if index is not None and sum(stop - first for first, stop in rows.values()) != len(index):
+            rows = {}
+        spans = manifest_spans(plan.manifest)
+        for f in plan.files:
+            name = os.path.basename(f)
+            if f not in plan.to_import and name in rows:
+                if overlaps(spans.get(name), start, end):
+                    first, stop = rows[name]
+                    sub = rows_in_window(index[first:stop], start, end)
+                    pieces.append(plan.source.read(fn, rows=slice(first + sub.start, first + sub.stop))
+                                  if isinstance(sub, slice) else plan.source.read(fn, rows=first + sub))
+            elif overlaps(raw_file_span(f), start, end):
+                pieces.append(f)
+                raw_files.append(f)
+
+    if verbose:
+        print(f"Window {start} - {end}: {len(raw_files)} raw files to import")
+    imported = dict(zip(raw_files, import_files(fun, raw_files, parallel_flag, verbose, otherarg1, otherarg2)
+                        if raw_files else []))
+    pieces = [imported[p] if isinstance(p, str) else p for p in pieces]
+    pieces = [p.iloc[rows_in_window(p.index, start, end)] for p in pieces]
+    pieces = [p for p in pieces if not p.empty]
+    return pd.concat(pieces) if pieces else pd.DataFrame()
+
+
+def time_index(dirname_in, dirname_out, prefix, dt, software, postfix='', cache='npy'):
+    """
+    Time index of the cached days and raw files of an instrument.
+
+    Spans of cached days are read from their index, spans of the raw files behind
+    a cache from its manifest, and spans of other raw files from their first and
+    last lines. No data file is parsed.
+
+    Args:
+        dt (list): Start and end datetime of the days to index.
+        Other arguments: see i_read.
+
+    Returns:
+        pd.DataFrame: One row per cached day ('cache') and raw file ('raw') with
+        its path, first and last time and number of rows (if known).
+    """
+    backend = get_backend(cache)
+    others = [b for b in CACHE_BACKENDS.values() if b is not backend]
+    entries = []
+    current_dt = datetime(dt[0].year, dt[0].month, dt[0].day)
+    while current_dt <= dt[1]:
+        fn_base = os.path.join(dirname_out, f"{prefix}{current_dt.strftime('%Y%m%d')}{postfix}")
+        source = next((b for b in [backend] + others if b.exists(fn_base + b.extension)), None)
+        manifest = None
+        if source is not None:
+            index = source.read_index(fn_base + source.extension)
+            if len(index):
+                entries.append(('cache', fn_base + source.extension, index[0], index[-1], len(index)))
+            manifest = read_manifest(fn_base)
+        recorded = {f['name']: f for f in manifest['files']} if manifest else {}
+        spans = manifest_spans(manifest)
+        rows = cached_rows(manifest) if manifest else {}
+        for f in list_files_from_software(software, dirname_in, prefix, current_dt, postfix):
+            name = os.path.basename(f)
+            sig = file_signature(f)
+            # Spans recorded in the manifest hold as long as the file did not change
+            if name in spans and all(recorded[name][k] == sig[k] for k in ('size', 'mtime_ns')):
+                span, n = spans[name], rows[name][1] - rows[name][0]
+            else:
+                span, n = raw_file_span(f), None
+            entries.append(('raw', f) + (tuple(span) if span is not None else (None, None)) + (n,))
+        current_dt += timedelta(days=1)
+    return pd.DataFrame(entries, columns=['kind', 'path', 'first', 'last', 'rows'])
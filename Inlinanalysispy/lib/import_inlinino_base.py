@@ -5,13 +5,31 @@ Created on Thu Jan 23 11:10:55 2025
 
 @author: clemence
 """
+import io
 import numpy as np
 import re
 import pandas as pd
 
+# Bump when the output of the import functions changes, to invalidate the day
+# caches built with a previous version (see lib.cache_manifest)
+PARSER_VERSION = 1
+# Rows decoded at once by the spectra tokenizer
+SPECTRA_CHUNKSIZE = 16384
+# Brackets and commas are blanked out before tokenizing the spectra
+_BLANKS = bytes.maketrans(b'[],\t\r', b'     ')
+# ACS values above (1/m) are saturated
+SATURATION_THRESHOLD = 34
+
+
+def _open(f):
+    """Path of an Inlinino file, or buffer over its content if f holds bytes
+    (e.g. the lines appended to a growing file, see lib.tail_read)."""
+    return io.BytesIO(f) if isinstance(f, (bytes, bytearray)) else f
+
+
 def import_inlinino_flow(f):
 
-    df=pd.read_csv(f, header=0, skiprows=1)
+    df=pd.read_csv(_open(f), header=0, skiprows=1)
     df.columns=["time", "swt", "flow"]
     df["flow"]=df["flow"].astype(float)
     df["swt"]=df["swt"].replace({"True": 1, "False": 0})
@@ -22,25 +40,120 @@ def import_inlinino_flow(f):
     df['dt']=df.index
     return(df)                
 
-def import_inlinino_acs(f,saturationthreshold=34, fillsatvalues=False):
-    # % Example: [ data, lambda_a, lambda_c ] = importInlininoACScsv( filename, verbose )
 
-    df=pd.read_csv(f, header=0)
-    c_wv=np.array(df.c[0].split("=")[1].split(" ")).astype(float)
-    a_wv=np.array(df.a[0].split("=")[1].split(" ")).astype(float)
+def parse_inlinino_spectra(raw, n_wv, chunksize=SPECTRA_CHUNKSIZE):
+    """
+    Decode the bracketed spectra of Inlinino data lines into 2-D float arrays.
+
+    Brackets and commas are blanked out in the raw bytes so that the C
+    tokenizer of pandas reads each line as a flat row of values, which are
+    converted chunk by chunk into preallocated arrays. 'inf' is replaced by
+    99999 and values are converted with the round-trip parser, as float()
+    does, so the output is identical to the row by row decoding.
+
+    Args:
+        raw (bytes): Data lines of the file (header and unit rows excluded).
+        n_wv (list): Number of values of each bracketed column, in file order.
+        chunksize (int): Number of rows decoded at once.
+
+    Returns:
+        list: One (n_rows x n) array per bracketed column, or None if the
+        lines do not all have the layout of the first one.
+    """
+    first = raw[:raw.find(b'\n')]
+    if b'[' not in first:
+        return None
+    n_lead = len(first[:first.index(b'[')].translate(_BLANKS).split())
+    n_tokens = len(first.translate(_BLANKS).split())
+    n_rows, rem = divmod(raw.count(b'['), len(n_wv))
+    if rem or n_tokens < n_lead + sum(n_wv):
+        return None
+
+    # A line with too many values makes pandas raise, a line with too few
+    # leaves its last column empty
+    last = n_tokens - 1
+    out = np.empty((n_rows, sum(n_wv)))
+    reader = pd.read_csv(io.BytesIO(raw.replace(b'inf', b'99999').translate(_BLANKS)), sep=' ',
+                         header=None, names=range(n_tokens), skipinitialspace=True,
+                         usecols=[*range(n_lead, n_lead + sum(n_wv)), last],
+                         dtype={i: float for i in range(n_lead, n_lead + sum(n_wv))},
+                         float_precision='round_trip', chunksize=chunksize)
+    row = 0
+    try:
+        for chunk in reader:
+            if chunk[last].isna().any():
+                return None
+            out[row:row + len(chunk)] = chunk.iloc[:, :sum(n_wv)].to_numpy()
+            row += len(chunk)
+    except ValueError:
+        return None
+    if row != n_rows:
+        return None
+
+    return np.split(out, np.cumsum(n_wv)[:-1], axis=1)
+
+
+def _read_spectra_bulk(f, columns, n_wv):
+    """Read the data lines of f (path or bytes) and decode its bracketed columns."""
+    if isinstance(f, (bytes, bytearray)):
+        raw = bytes(f)
+    else:
+        with open(f, 'rb') as fid:
+            raw = fid.read()
+    # Skip the header and the unit rows
+    start = raw.index(b'\n', raw.index(b'\n') + 1) + 1
+    order = [c for c in columns if c in n_wv]
+    arrays = parse_inlinino_spectra(raw[start:], [n_wv[c] for c in order])
+    if arrays is None:
+        return None
+    return dict(zip(order, arrays))
+
 
-    time_acs=pd.to_datetime(df.time[1:])
+def _read_spectra_rows(values):
+    """Decode Inlinino spectra one row at a time."""
+    return pd.DataFrame([np.array(re.sub(r"\[|\]","",re.sub("inf", "99999", v)).split(), dtype=float) for v in values])
 
-    cvals=pd.DataFrame([np.array(re.sub(r"\[|\]","",re.sub("inf", "99999", df.c[i])).split(), dtype=float) for i in range(1, len(df.c))])
-    avals=pd.DataFrame([np.array(re.sub(r"\[|\]","",re.sub("inf", "99999", df.a[i])).split(), dtype=float) for i in range(1, len(df.a))])
 
+def saturation_mask(values, saturationthreshold=SATURATION_THRESHOLD, negative=True):
+    """Mask of saturated values: above saturationthreshold, or with negative
+    also below 0 or NaN (values not within [0, saturationthreshold])."""
+    values = np.asarray(values)
+    if negative:
+        return ~((0 <= values) & (values <= saturationthreshold))
+    return values > saturationthreshold
 
 
+def import_inlinino_acs(f,saturationthreshold=SATURATION_THRESHOLD, fillsatvalues=False, bulk=True):
+    # % Example: [ data, lambda_a, lambda_c ] = importInlininoACScsv( filename, verbose )
+    # bulk=True decodes the spectra straight from the file bytes, falling
+    # back on the row by row decoding if the file is not regular.
+
+    if bulk:
+        columns=pd.read_csv(_open(f), nrows=0).columns
+        df=pd.read_csv(_open(f), header=0, usecols=[col for col in columns if col not in ('a', 'c')])
+        head=pd.read_csv(_open(f), header=0, nrows=1, usecols=['c', 'a'])
+    else:
+        df=pd.read_csv(_open(f), header=0)
+        head=df
+    c_wv=np.array(head.c[0].split("=")[1].split(" ")).astype(float)
+    a_wv=np.array(head.a[0].split("=")[1].split(" ")).astype(float)
+
+    time_acs=pd.to_datetime(df.time[1:])
+
+    spectra=_read_spectra_bulk(f, columns, {'c': len(c_wv), 'a': len(a_wv)}) if bulk else None
+    if spectra is not None and len(spectra['a']) == len(time_acs):
+        cvals=pd.DataFrame(spectra['c'])
+        avals=pd.DataFrame(spectra['a'])
+    else:
+        rows=pd.read_csv(_open(f), header=0, usecols=['c', 'a']) if bulk else df
+        cvals=_read_spectra_rows(rows.c[1:])
+        avals=_read_spectra_rows(rows.a[1:])
+
     if fillsatvalues is True:
         print("WARNING: values above {} will be filled with interpolated data!!".format(saturationthreshold))
 
         # Step 1: Identify values above the threshold
-        above_threshold = cvals > saturationthreshold
+        above_threshold = saturation_mask(cvals, saturationthreshold, negative=False)
 
         # Step 2: Replace values above the threshold with NaN
         df_with_nans = cvals.mask(above_threshold)
@@ -52,7 +165,7 @@ def import_inlinino_acs(f,saturationthreshold=34, fillsatvalues=False):
         # ABSORPTION#
         
         # Step 1: Identify values above the threshold
-        above_threshold = avals > saturationthreshold
+        above_threshold = saturation_mask(avals, saturationthreshold, negative=False)
     
         # Step 2: Replace values above the threshold with NaN
         df_with_nans = avals.mask(above_threshold)
@@ -62,8 +175,8 @@ def import_inlinino_acs(f,saturationthreshold=34, fillsatvalues=False):
         avals = df_with_nans.interpolate(method='linear', axis=1, limit_direction='both')
 
     else:
-        cvals = pd.DataFrame(np.where((0 <= cvals) & (cvals <= saturationthreshold), cvals, np.nan))
-        avals = pd.DataFrame(np.where((0 <= avals) & (avals <= saturationthreshold), avals, np.nan))
+        cvals = pd.DataFrame(np.where(saturation_mask(cvals, saturationthreshold), np.nan, cvals))
+        avals = pd.DataFrame(np.where(saturation_mask(avals, saturationthreshold), np.nan, avals))
 
     avals.index=time_acs
     avals.columns=a_wv
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Summaries of the levels of the instruments (data, raw, qc, bin, prod...).
+
+A summary holds the number of rows, the time span, the bytes of the arrays
+(index included), the number of columns of each dtype and the stage that
+wrote the level. It is computed from the metadata of the DataFrames only
+(shape, first and last time of sorted indexes, nbytes of the blocks), when a
+stage writes a level, so that the status of a session is printed, and its
+memory accounted, without touching the data.
+
+Bytes are those of the arrays (DataFrame.memory_usage without deep): exact
+for the numeric columns, without the strings of object columns. Arrays shared
+between levels (e.g. raw['tsw'] = data of the instruments not split) or memory
+mapped from the day caches are counted in each level using them.
+"""
+from collections import namedtuple
+
+import pandas as pd
+
+LevelSummary = namedtuple('LevelSummary', ['rows', 'start', 'end', 'nbytes', 'dtypes', 'stage'])
+# Summary of an empty or missing level
+EMPTY = LevelSummary(0, None, None, 0, {}, None)
+
+
+def summarize(value, stage=None):
+    """
+    Summary of a level.
+
+    Args:
+        value: DataFrame or Series, or dict of them (e.g. {'tsw': ..., 'fsw': ...}),
+            summed over its tables.
+        stage (str): Stage that wrote the level.
+
+    Returns:
+        LevelSummary
+    """
+    if isinstance(value, dict):
+        parts = [summarize(v) for v in value.values()]
+        parts = [p for p in parts if p.rows or p.nbytes]
+        if not parts:
+            return EMPTY._replace(stage=stage)
+        starts = [p.start for p in parts if p.start is not None]
+        ends = [p.end for p in parts if p.end is not None]
+        dtypes = {}
+        for p in parts:
+            for dtype, n in p.dtypes.items():
+                dtypes[dtype] = dtypes.get(dtype, 0) + n
+        return LevelSummary(sum(p.rows for p in parts), min(starts) if starts else None,
+                            max(ends) if ends else None, sum(p.nbytes for p in parts), dtypes, stage)
+    if not isinstance(value, (pd.DataFrame, pd.Series)):
+        return EMPTY._replace(stage=stage)
+    index = value.index
+    start = end = None
+    if isinstance(index, pd.DatetimeIndex) and len(index):
+        # Sorted indexes (all levels written by the stages) keep their flag, no scan
+        if index.is_monotonic_increasing:
+            start, end = index[0], index[-1]
+        else:
+            start, end = index.min(), index.max()
+    if isinstance(value, pd.DataFrame):
+        nbytes = int(value.memory_usage(index=True, deep=False).sum())
+        dtypes = value.dtypes.astype(str).value_counts().to_dict()
+    else:
+        nbytes = int(value.memory_usage(index=True, deep=False))
+        dtypes = {str(value.dtype): 1}
+    return LevelSummary(len(value), start, end, nbytes, dtypes, stage)
+
+
+def format_bytes(nbytes):
+    """Bytes in B, kB, MB or GB."""
+    for unit in ('B', 'kB', 'MB'):
+        if nbytes < 1000:
+            return f'{nbytes:.0f} {unit}' if unit == 'B' else f'{nbytes:.1f} {unit}'
+        nbytes /= 1000
+    return f'{nbytes:.1f} GB'
+
+
+def memory_by_level(summaries):
+    """
+    Bytes and dtypes of each level summed over instruments.
+
+    Args:
+        summaries (dict): Summaries of the levels of each instrument,
+            {instrument: {level: LevelSummary}}.
+
+    Returns:
+        dict: {level: (bytes, {dtype: columns})}, largest first.
+    """
+    totals = {}
+    for levels in summaries.values():
+        for level, summary in levels.items():
+            nbytes, dtypes = totals.get(level, (0, {}))
+            for dtype, n in summary.dtypes.items():
+                dtypes[dtype] = dtypes.get(dtype, 0) + n
+            totals[level] = (nbytes + summary.nbytes, dtypes)
+    return dict(sorted(totals.items(), key=lambda item: -item[1][0]))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Level of detail plotting of long time series for the interactive QC views.
+
+A line never needs more points than the axes has pixel columns: for each
+column, the first, minimum, maximum and last points draw the same picture as
+all the points of the column. LODLine keeps the full resolution arrays and
+plots only these points for the visible time range, computed again from the
+full arrays when the view is zoomed or panned (xlim_changed). SpanPicker
+selects time spans with a blitted SpanSelector, so that dragging a span does
+not redraw the lines.
+
+matplotlib is imported when plotting only, the decimation works without it.
+"""
+import numpy as np
+
+# Points kept per pixel column: first, minimum, maximum and last
+POINTS_PER_PIXEL = 4
+
+
+def minmax_indices(x, y, start, stop, n_bins):
+    """
+    Points of start:stop drawing the same line as all of them on n_bins pixel columns.
+
+    Args:
+        x (array): Sorted x of the points, float.
+        y (array): y of the points, float (NaN are gaps).
+        start, stop (int): Range of the points to decimate.
+        n_bins (int): Number of pixel columns over x[start] to x[stop - 1].
+
+    Returns:
+        array: Sorted indices of the first, minimum, maximum and last point
+        of each column holding points.
+    """
+    n_bins = max(int(n_bins), 1)
+    if stop - start <= POINTS_PER_PIXEL * n_bins:
+        return np.arange(start, stop)
+    xs, ys = x[start:stop], y[start:stop]
+    edges = np.linspace(xs[0], xs[-1], n_bins + 1)
+    first = np.unique(np.searchsorted(xs, edges[:-1], side='left'))
+    first = first[first < len(xs)]
+    sizes = np.diff(np.r_[first, len(xs)])
+    column = np.repeat(np.arange(len(first)), sizes)
+    keep = [first, first + sizes - 1]
+    # First minimum and maximum of each column, NaN ignored
+    for extremum in (np.fmin, np.fmax):
+        value = extremum.reduceat(ys, first)
+        hits = np.flatnonzero(ys == value[column])
+        keep.append(hits[np.unique(column[hits], return_index=True)[1]])
+    return start + np.unique(np.concatenate(keep))
+
+
+def to_num(x):
+    """x as floats: matplotlib date numbers for times, else unchanged."""
+    x = np.asarray(x)
+    if x.dtype.kind == 'M':
+        import matplotlib.dates as mdates
+        return mdates.date2num(x.astype('datetime64[ns]'))
+    return x.astype(float)
+
+
+class LODLine:
+    """
+    Line of a long time series, decimated to the pixel width of the axes.
+
+    Args:
+        ax: Matplotlib axes.
+        x (array): Time (datetime64) or x of the points.
+        y (array): y of the points.
+        *args, **kwargs: Passed to ax.plot (format, color, marker...).
+    """
+
+    def __init__(self, ax, x, y, *args, **kwargs):
+        is_time = np.asarray(x).dtype.kind == 'M'
+        x, y = to_num(x), np.asarray(y, dtype=float)
+        if len(x) > 1 and np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='stable')
+            x, y = x[order], y[order]
+        self.ax, self.x, self.y = ax, x, y
+        idx = self._indices(*(x[[0, -1]] if len(x) else (0, 1)))
+        self.line, = ax.plot(x[idx], y[idx], *args, **kwargs)
+        if is_time:
+            ax.xaxis_date()
+        self.cid = ax.callbacks.connect('xlim_changed', self._on_xlim)
+
+    def _indices(self, lo, hi):
+        # One point beyond each side of the view keeps the line to the edges
+        start = max(int(np.searchsorted(self.x, lo, side='left')) - 1, 0)
+        stop = min(int(np.searchsorted(self.x, hi, side='right')) + 1, len(self.x))
+        width = self.ax.bbox.width if self.ax.bbox.width > 1 else 1000
+        return minmax_indices(self.x, self.y, start, stop, width)
+
+    def _on_xlim(self, ax):
+        idx = self._indices(*ax.get_xlim())
+        self.line.set_data(self.x[idx], self.y[idx])
+        ax.figure.canvas.draw_idle()
+
+    def remove(self):
+        self.ax.callbacks.disconnect(self.cid)
+        self.line.remove()
+
+
+class SpanPicker:
+    """
+    Selection of time spans by mode on an axes.
+
+    A span is dragged with the mouse (blitted, the lines are not redrawn),
+    then assigned to a mode with its key; q closes the figure.
+
+    Args:
+        ax: Matplotlib axes of times (date numbers).
+        modes (dict): Key pressed for each mode, e.g. {'t': 'total', 'f': 'filtered'}.
+        colors (dict): Color of the spans of each mode.
+
+    Attributes:
+        selections (dict): (start, end) POSIX seconds of the spans of each mode.
+        saved (bool): Whether the figure was closed with q.
+    """
+
+    def __init__(self, ax, modes, colors=None):
+        from matplotlib.widgets import SpanSelector
+        self.ax, self.modes, self.colors = ax, modes, colors or {}
+        self.selections = {mode: [] for mode in modes.values()}
+        self.saved = False
+        self.span = None
+        self.selector = SpanSelector(ax, self._on_select, 'horizontal', useblit=True,
+                                     props=dict(alpha=0.3, facecolor='tab:blue'))
+        self.cid = ax.figure.canvas.mpl_connect('key_press_event', self._on_key)
+
+    def _on_select(self, xmin, xmax):
+        if xmax > xmin:
+            self.span = (xmin, xmax)
+
+    def _on_key(self, event):
+        import matplotlib.dates as mdates
+        import matplotlib.pyplot as plt
+        if event.key == 'q':
+            self.saved = True
+            plt.close(self.ax.figure)
+        elif event.key in self.modes and self.span is not None:
+            mode = self.modes[event.key]
+            self.selections[mode].append(tuple(mdates.num2date(v).timestamp() for v in self.span))
+            self.ax.axvspan(*self.span, alpha=0.3, color=self.colors.get(mode))
+            self.span = None
+            self.ax.figure.canvas.draw_idle()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent execution of the processing stages of several instruments.
+
+The work is a graph of (stage, instrument) nodes. Each node waits for the
+previous stage of its instrument, and for the same stage of the instruments
+it references (e.g. Split waits for the Split of the FLOW, calibrate for the
+calibrate of the CDOM_source and TSG_source instruments). Nodes whose
+prerequisites are done run concurrently on a thread pool (the stages spend
+their time in numpy, pandas and file reading, which release the GIL), so
+that independent instruments do not wait for each other: a day is processed
+in the time of the slowest chain of dependencies rather than the sum of all
+instruments.
+
+Each node also declares the levels it reads (data, raw, qc, bin...) of its
+instrument and of the instruments it references. Once every node reading a
+level is done, the level is released (see run_graph), unless it is kept.
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def n_workers(parallel, n_nodes):
+    """Threads for parallel (-1 or inf: one per core, as the parallel setting of [process])."""
+    if parallel is None or parallel < 0 or parallel == float('inf'):
+        parallel = os.cpu_count() or 1
+    return max(1, min(int(parallel), n_nodes))
+
+
+def build_graph(instruments, stages, references=None):
+    """
+    Dependency graph of the stages of instruments.
+
+    Args:
+        instruments (list): Instrument names.
+        stages (list): Stage names, in order.
+        references (callable): references(stage, instrument) returns the
+            instruments whose same stage must be done first, or None if the
+            stage does not apply to the instrument (no node).
+
+    Returns:
+        dict: Prerequisite nodes of each (stage, instrument) node, in stage order.
+    """
+    graph = {}
+    last = {}
+    for stage in stages:
+        nodes = {}
+        for name in instruments:
+            refs = references(stage, name) if references else []
+            if refs is None:
+                continue
+            nodes[name] = {(stage, ref) for ref in refs if ref != name and ref in instruments}
+            if name in last:
+                nodes[name].add(last[name])
+        for name, before in nodes.items():
+            # References without this stage wait for their previous stage instead
+            graph[(stage, name)] = {node if node[1] in nodes else last[node[1]]
+                                    for node in before if node[1] in nodes or node[1] in last}
+        last.update({name: (stage, name) for name in nodes})
+    return graph
+
+
+def _check_acyclic(graph):
+    order, state = [], {}
+    for start in graph:
+        stack = [(start, iter(graph[start]))]
+        state[start] = state.get(start, 0) or 1
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                state[node] = 2
+                order.append(node)
+                stack.pop()
+            elif state.get(child) == 1:
+                raise ValueError(f'Scheduler: dependency cycle through {child}')
+            elif not state.get(child):
+                state[child] = 1
+                stack.append((child, iter(graph[child])))
+    return order
+
+
+def run_graph(graph, run, workers=1, reads=None, release=None):
+    """
+    Run every node of graph once its prerequisites are done.
+
+    Args:
+        graph (dict): Prerequisites of each node (see build_graph).
+        run (callable): run(node) processes a node.
+        workers (int): Nodes run at once (1: in order, in the calling thread).
+        reads (callable): reads(node) returns the (instrument, level) pairs
+            read by the node.
+        release (callable): release(instrument, level) once every node
+            reading the level is done.
+
+    Returns:
+        list: Nodes in the order they were completed.
+
+    Raises:
+        The first exception raised by a node, once the nodes running are done.
+    """
+    order = _check_acyclic(graph)
+    readers = defaultdict(int)
+    for node in graph:
+        for key in (reads(node) if reads else ()):
+            readers[key] += 1
+    waiting = {node: len(before) for node, before in graph.items()}
+    dependents = defaultdict(list)
+    for node, before in graph.items():
+        for b in before:
+            dependents[b].append(node)
+
+    done = []
+
+    def complete(node):
+        done.append(node)
+        for key in (reads(node) if reads else ()):
+            readers[key] -= 1
+            if not readers[key] and release:
+                release(*key)
+        for child in dependents[node]:
+            waiting[child] -= 1
+
+    if workers <= 1:
+        for node in order:
+            run(node)
+            complete(node)
+        return done
+
+    ready = [node for node in order if not waiting[node]]
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while ready or running:
+            while ready and error is None:
+                node = ready.pop(0)
+                running[pool.submit(run, node)] = node
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                complete(node)
+                ready.extend(child for child in dependents[node] if not waiting[child])
+    if error is not None:
+        raise error
+    return done
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded processing of long cruises.
+
+days2run is cut in chunks of days (shard_days) processed independently, each
+in a worker process of its own: its memory is bounded by the chunk and not by
+the cruise. Each chunk is read with a margin of data before and after its days
+(the read_margin of lib.i_read), so that the split buffers, the filtered water
+events and the bins crossing midnight at the ends of the chunk see the same
+data as in a single run. The results are then trimmed to the days of their
+chunk (trim) and concatenated in the order of the chunks (merge), whatever the
+order in which the workers finished, so that the merged bin, flag and prod
+do not depend on the number of workers.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import pandas as pd
+
+# Days per chunk of the named shard sizes
+CHUNK_DAYS = {'day': 1, 'week': 7}
+
+
+def parse_days(days2run):
+    """
+    First and last day (datetime at midnight) of days2run.
+
+    Args:
+        days2run: [first, last] days, or a string 'first, last' of dates
+            (ISO format, e.g. '2024-11-01, 2024-12-15').
+    """
+    if isinstance(days2run, str):
+        days2run = [d for d in days2run.replace(';', ',').split(',') if d.strip()]
+    if not len(days2run):
+        raise ValueError('days2run: no days.')
+    days = [pd.Timestamp(d).normalize().to_pydatetime() for d in (days2run[0], days2run[-1])]
+    if days[1] < days[0]:
+        raise ValueError(f'days2run: last day {days[1]:%Y-%m-%d} before first day {days[0]:%Y-%m-%d}.')
+    return days
+
+
+def shard_days(days2run, chunk='week'):
+    """
+    Chunks of days2run.
+
+    Args:
+        days2run: Days to run (see parse_days).
+        chunk: 'day', 'week' or number of days per chunk.
+
+    Returns:
+        list: [first, last] days (datetime) of each chunk, in order.
+    """
+    size = CHUNK_DAYS.get(chunk, chunk) if isinstance(chunk, str) else chunk
+    try:
+        size = int(size)
+    except ValueError:
+        raise ValueError(f'Unknown shard size: {chunk} (day, week or number of days).')
+    if size < 1:
+        raise ValueError(f'Shard size must be at least one day: {chunk}')
+    first, last = parse_days(days2run)
+    n_days = (last - first).days + 1
+    return [[first + timedelta(days=k), first + timedelta(days=min(k + size, n_days) - 1)]
+            for k in range(0, n_days, size)]
+
+
+def trim(value, days):
+    """
+    value restricted to the days [first, last] of its chunk: DataFrames and
+    Series indexed by time are sliced, dicts trimmed recursively, anything else
+    returned unchanged.
+    """
+    if isinstance(value, dict):
+        return {k: trim(v, days) for k, v in value.items()}
+    if isinstance(value, (pd.DataFrame, pd.Series)) and isinstance(value.index, pd.DatetimeIndex):
+        start, end = pd.Timestamp(days[0]), pd.Timestamp(days[1]) + pd.Timedelta(days=1)
+        return value[(value.index >= start) & (value.index < end)]
+    return value
+
+
+def merge(parts):
+    """
+    Chunk results concatenated in the order of parts.
+
+    Frames indexed by time are concatenated and sorted (stable, a time present
+    in two chunks keeps the first), dicts merged key by key, other values taken
+    from the first chunk having one.
+    """
+    parts = [p for p in parts if p is not None]
+    if not parts:
+        return None
+    if all(isinstance(p, dict) for p in parts):
+        keys = list(dict.fromkeys(k for p in parts for k in p))
+        return {k: merge([p.get(k) for p in parts]) for k in keys}
+    frames = [p for p in parts if isinstance(p, (pd.DataFrame, pd.Series)) and isinstance(p.index, pd.DatetimeIndex)]
+    if len(frames) != len(parts):
+        return parts[0]
+    merged = pd.concat([f for f in frames if len(f)] or frames[:1])
+    if not merged.index.is_monotonic_increasing:
+        merged = merged.iloc[merged.index.argsort(kind='stable')]
+    return merged[~merged.index.duplicated(keep='first')]
+
+
+def run_shards(worker, shards, workers=-1, *args):
+    """
+    worker(days, *args) of each chunk in its own process.
+
+    Args:
+        worker (callable): Function of the module level (pickled to the processes).
+        shards (list): [first, last] days of each chunk (see shard_days).
+        workers (int): Processes (-1 or inf: one per core, 1: in this process).
+
+    Returns:
+        list: Output of worker for each chunk, in the order of shards.
+    """
+    if workers is None or workers < 0 or workers == float('inf'):
+        workers = os.cpu_count() or 1
+    workers = max(1, min(int(workers), len(shards)))
+    if workers == 1:
+        return [worker(days, *args) for days in shards]
+    # One chunk per process: the memory of a chunk is returned with its process
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        return list(pool.map(worker, shards, *([a] * len(shards) for a in args)))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array container for ACS spectra.
+
+import_inlinino_acs returns a wide DataFrame: float64 a and c columns
+labelled by wavelength, a text flag column and the time both as index and as
+a dt column. Spectra holds the same data as contiguous arrays:
+
+    dt        (n,) int64, ns since epoch, sorted
+    a         (n, len(lambda_a)) float32
+    c         (n, len(lambda_c)) float32
+    lambda_a  (len(lambda_a),) float64
+    lambda_c  (len(lambda_c),) float64
+    flag      bits of the flag_outside_calibration_range column, packed 8 per byte
+
+which takes less than half the memory of the DataFrame. Time slicing and row
+selection with slices return views, and to_dataframe converts back to the
+layout of import_inlinino_acs when pandas is needed.
+"""
+import numpy as np
+import pandas as pd
+
+
+def split_wavelengths(labels):
+    """Number of a wavelengths in a then c wavelength labels, a ending at the
+    first decrease of wavelength (layout of import_inlinino_acs)."""
+    labels = np.asarray(labels, dtype=float)
+    decrease = np.diff(labels) < 0
+    return int(np.argmax(decrease)) + 1 if decrease.any() else len(labels)
+
+
+class Spectra:
+    """
+    ACS a and c spectra on a common time vector.
+
+    Args:
+        dt (array): Time of each spectrum, datetime64 or int64 ns since epoch.
+        a, c (array): Absorption and attenuation, one row per spectrum.
+        lambda_a, lambda_c (array): Wavelengths of the a and c columns.
+        flag (array): Boolean flag of each spectrum (outside calibration range),
+            or the packed bits of the flags (uint8, see np.packbits).
+        dtype: Floating point type of a and c.
+    """
+
+    def __init__(self, dt, a, c, lambda_a, lambda_c, flag=None, dtype=np.float32):
+        self.dt = np.asarray(dt).astype('datetime64[ns]').view(np.int64) if np.asarray(dt).dtype.kind == 'M' \
+            else np.asarray(dt, dtype=np.int64)
+        self.a = np.asarray(a, dtype=dtype)
+        self.c = np.asarray(c, dtype=dtype)
+        self.lambda_a = np.asarray(lambda_a, dtype=float)
+        self.lambda_c = np.asarray(lambda_c, dtype=float)
+        if self.a.shape != (len(self.dt), len(self.lambda_a)) or self.c.shape != (len(self.dt), len(self.lambda_c)):
+            raise ValueError(f'Spectra: a {self.a.shape} and c {self.c.shape} do not match '
+                             f'{len(self.dt)} times and {len(self.lambda_a)}/{len(self.lambda_c)} wavelengths.')
+        if flag is None:
+            flag = np.zeros(len(self.dt), dtype=bool)
+        flag = np.asarray(flag)
+        self._flag = flag if flag.dtype == np.uint8 else np.packbits(flag.astype(bool))
+        self._flag_offset = 0
+
+    @classmethod
+    def from_dataframe(cls, df, lambda_a=None, lambda_c=None, dtype=np.float32):
+        """
+        Convert the output of import_inlinino_acs (or its day caches).
+
+        Without lambda_a and lambda_c, a columns are the first wavelength
+        columns, up to the first decrease of wavelength where c columns start.
+        """
+        wv = [i for i, col in enumerate(df.columns) if isinstance(col, (float, np.floating))]
+        if lambda_a is None or lambda_c is None:
+            labels = np.array([df.columns[i] for i in wv], dtype=float)
+            n_a = split_wavelengths(labels)
+            lambda_a, lambda_c = labels[:n_a], labels[n_a:]
+        n_a = len(lambda_a)
+        if len(wv) != n_a + len(lambda_c):
+            raise ValueError(f'Spectra: {len(wv)} wavelength columns, expected {n_a} a and {len(lambda_c)} c.')
+        values = df.iloc[:, wv[0]:wv[-1] + 1].to_numpy(dtype=dtype)
+        flag = None
+        if 'flag_outside_calibration_range' in df.columns:
+            flag = df['flag_outside_calibration_range'].astype(str).to_numpy() == 'True'
+        return cls(pd.DatetimeIndex(df.index).as_unit('ns').asi8, values[:, :n_a], values[:, n_a:],
+                   lambda_a, lambda_c, flag, dtype)
+
+    @classmethod
+    def concat(cls, spectra):
+        """Concatenate Spectra sharing the same wavelengths, in the given order."""
+        spectra = [s for s in spectra if len(s)]
+        if not spectra:
+            raise ValueError('Spectra: nothing to concatenate.')
+        first = spectra[0]
+        for s in spectra[1:]:
+            if not (np.array_equal(s.lambda_a, first.lambda_a) and np.array_equal(s.lambda_c, first.lambda_c)):
+                raise ValueError('Spectra: cannot concatenate spectra of different wavelengths.')
+        return cls(np.concatenate([s.dt for s in spectra]), np.concatenate([s.a for s in spectra]),
+                   np.concatenate([s.c for s in spectra]), first.lambda_a, first.lambda_c,
+                   np.concatenate([s.flag for s in spectra]), first.a.dtype)
+
+    def __len__(self):
+        return len(self.dt)
+
+    def __repr__(self):
+        if not len(self):
+            return f'Spectra(0 x {len(self.lambda_a)} a / {len(self.lambda_c)} c)'
+        return (f'Spectra({len(self)} x {len(self.lambda_a)} a / {len(self.lambda_c)} c, '
+                f'{self.time[0]} - {self.time[-1]}, {self.nbytes / 1e6:.1f} MB)')
+
+    @property
+    def flag(self):
+        """Boolean flag of each spectrum."""
+        return np.unpackbits(self._flag, count=self._flag_offset + len(self))[self._flag_offset:].astype(bool)
+
+    @property
+    def time(self):
+        """Time of each spectrum as a DatetimeIndex (view of dt)."""
+        return pd.DatetimeIndex(self.dt.view('datetime64[ns]'), name='time')
+
+    @property
+    def nbytes(self):
+        return self.dt.nbytes + self.a.nbytes + self.c.nbytes + self._flag.nbytes
+
+    def __getitem__(self, rows):
+        """Spectra of rows (slice, boolean mask or positions); slices are views."""
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            start, stop, _ = rows.indices(len(self))
+            stop = max(start, stop)
+            out = self._view(self.dt[start:stop], self.a[start:stop], self.c[start:stop])
+            # Packed flags are sliced on whole bytes, the offset skips the first bits
+            out._flag = self._flag[(self._flag_offset + start) // 8:(self._flag_offset + stop + 7) // 8]
+            out._flag_offset = (self._flag_offset + start) % 8
+            return out
+        rows = np.arange(len(self))[rows]
+        return Spectra(self.dt[rows], self.a[rows], self.c[rows], self.lambda_a, self.lambda_c,
+                       self.flag[rows], self.a.dtype)
+
+    def slice_time(self, start, end):
+        """Spectra within [start, end] (both included), as views."""
+        start = pd.Timestamp(start).as_unit('ns').value
+        end = pd.Timestamp(end).as_unit('ns').value
+        return self[np.searchsorted(self.dt, start, 'left'):np.searchsorted(self.dt, end, 'right')]
+
+    def to_dataframe(self, dtype=float):
+        """DataFrame in the layout of import_inlinino_acs (a, c, flag and dt columns)."""
+        time = self.time
+        df = pd.concat([pd.DataFrame(self.a.astype(dtype, copy=False), index=time, columns=self.lambda_a),
+                        pd.DataFrame(self.c.astype(dtype, copy=False), index=time, columns=self.lambda_c)], axis=1)
+        df['flag_outside_calibration_range'] = self.flag
+        df['dt'] = time
+        return df
+
+    def _view(self, dt, a, c):
+        out = Spectra.__new__(Spectra)
+        out.dt, out.a, out.c = dt, a, c
+        out.lambda_a, out.lambda_c = self.lambda_a, self.lambda_c
+        return out
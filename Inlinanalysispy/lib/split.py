@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Split of instrument data in total and filtered water periods.
+
+The switch position of the reference (FLOW swt) is turned once into sorted
+arrays of start and end times of total and filtered periods. Each
+instrument's buffers (seconds removed at the start of each filtered and
+total period, buffer_<instrument> in [split]) are applied to these intervals,
+and samples are assigned to them with np.searchsorted, in O(n log k) for n
+samples and k periods.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Sorted start and end times (int64 ns, end excluded) of the periods of each
+# switch position
+SwitchPeriods = namedtuple('SwitchPeriods', ['total', 'filtered'])
+
+
+def switch_periods(dt, swt, switch_filtered=1, switch_total=0):
+    """
+    Periods of constant switch position.
+
+    Args:
+        dt (array): Sorted time of the switch samples, int64 ns.
+        swt (array): Switch position; averaged values (e.g. 1 min means) are
+            rounded, NaN are gaps ending the current period.
+        switch_filtered, switch_total: Positions of filtered and total water.
+
+    Returns:
+        SwitchPeriods: (starts, ends) arrays of the total and filtered periods.
+        A period ends at the first sample of the next one, or one sampling
+        interval after its last sample before a gap or at the end.
+    """
+    dt = np.asarray(dt, dtype=np.int64)
+    state = np.round(np.asarray(swt, dtype=float))
+    state = np.where((state == switch_filtered) | (state == switch_total), state, np.nan)
+    if not len(dt):
+        empty = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        return SwitchPeriods(empty, empty)
+
+    period = np.int64(np.median(np.diff(dt))) if len(dt) > 1 else np.int64(0)
+    # Runs of equal state (gaps are runs of their own)
+    change = np.r_[True, ~((state[1:] == state[:-1]) | (np.isnan(state[1:]) & np.isnan(state[:-1])))]
+    first = np.flatnonzero(change)
+    last = np.r_[first[1:] - 1, len(dt) - 1]
+    run_state = state[first]
+    # A run ends where the next one starts, unless it is followed by a gap or by nothing
+    ends = np.r_[dt[first[1:]], dt[-1] + period]
+    next_is_gap = np.r_[np.isnan(run_state[1:]), True]
+    ends = np.where(next_is_gap, dt[last] + period, ends)
+
+    def select(position):
+        keep = run_state == position
+        return dt[first[keep]], ends[keep]
+
+    return SwitchPeriods(select(switch_total), select(switch_filtered))
+
+
+def apply_buffer(periods, buffer):
+    """
+    Remove the first buffer seconds of each period.
+
+    Args:
+        periods (SwitchPeriods): Periods of the reference.
+        buffer (tuple): Seconds removed at the start of filtered and total periods.
+
+    Returns:
+        SwitchPeriods: Buffered periods, without the ones shorter than their buffer.
+    """
+    out = []
+    for (starts, ends), seconds in zip((periods.total, periods.filtered), (buffer[1], buffer[0])):
+        starts = starts + np.int64(round(seconds * 1e9))
+        keep = starts < ends
+        out.append((starts[keep], ends[keep]))
+    return SwitchPeriods(*out)
+
+
+def in_periods(dt, starts, ends):
+    """Mask of the times dt within the sorted, non overlapping periods."""
+    k = np.searchsorted(starts, dt, side='right') - 1
+    return (k >= 0) & (dt < ends[np.maximum(k, 0)]) if len(starts) else np.zeros(len(dt), dtype=bool)
+
+
+def merge_intervals(starts, ends):
+    """
+    Union of intervals.
+
+    Args:
+        starts, ends (array): Start and end of each interval, in any order.
+
+    Returns:
+        tuple: Sorted starts and ends of the disjoint intervals covering the
+        same times (touching intervals are merged).
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    # A new interval starts where no previous one reaches
+    new = np.r_[True, starts[1:] > ends[:-1]]
+    last = np.r_[np.flatnonzero(new)[1:] - 1, len(starts) - 1]
+    return starts[new], ends[last]
+
+
+def split_data(data, periods, buffer):
+    """
+    Split data in total and filtered water.
+
+    Args:
+        data (pd.DataFrame or Spectra): Samples indexed by time.
+        periods (SwitchPeriods): Periods of the reference (see switch_periods).
+        buffer (tuple): Seconds removed at the start of filtered and total periods.
+
+    Returns:
+        tuple: Samples of the total (tsw) and filtered (fsw) periods.
+    """
+    periods = apply_buffer(periods, buffer)
+    dt = data.dt if hasattr(data, 'lambda_a') else pd.DatetimeIndex(data.index).as_unit('ns').asi8
+    total = in_periods(dt, *periods.total)
+    filtered = in_periods(dt, *periods.filtered)
+    return data[total], data[filtered]
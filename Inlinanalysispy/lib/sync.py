@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Automatic time synchronisation of instruments.
+
+The lag of an instrument relative to a reference (the FLOW switch position by
+default) is found from the cross-correlation of their signals: every switch
+between total and filtered water shows as a step in both. Both signals are
+averaged on a common regular time grid, cut in overlapping windows, and the
+cross-correlation of all windows is computed at once with FFTs, in
+O(n log n) instead of O(n x lags) for a lag scan. Each window gives the lag of
+its highest correlation (positive or negative, the instrument may drop or
+rise in filtered water), the delay is their median weighted by the
+correlation, and the confidence tells how much the windows agree.
+
+Delays follow the convention of the delay_<instrument> settings of [sync]:
+the delay (seconds) is added to the time of the instrument.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# delay (s) to add to the instrument time, confidence (0 to 1), and per window:
+# start time (datetime64), delay (s) and absolute correlation peak
+SyncResult = namedtuple('SyncResult', ['delay', 'confidence', 'window_start', 'window_delay', 'window_peak'])
+
+
+def resample(dt, values, t0, step, n):
+    """
+    Mean of values (NaN excluded) in n bins of step ns from t0.
+
+    Signals sampled more coarsely than step (e.g. FLOW at 1 min) hold each
+    value until the next sample, up to their sampling interval; other empty
+    bins are NaN.
+    """
+    dt = np.asarray(dt, dtype=np.int64)
+    k = (dt - t0) // step
+    values = np.asarray(values, dtype=float)
+    keep = (k >= 0) & (k < n) & np.isfinite(values)
+    total = np.bincount(k[keep], weights=values[keep], minlength=n)
+    count = np.bincount(k[keep], minlength=n)
+    with np.errstate(invalid='ignore'):
+        out = total / count
+    period = int(np.median(np.diff(dt))) if len(dt) > 1 else 0
+    if period > step:
+        i = np.arange(n)
+        last = np.maximum.accumulate(np.where(count > 0, i, -1))
+        fill = (count == 0) & (last >= 0) & ((i - last) * step < period)
+        out[fill] = out[last[fill]]
+    return out
+
+
+def xcorr(ref, sig, max_lag):
+    """
+    Cross-correlation of the rows of ref and sig (windows x samples, zero
+    mean, NaN as 0) for lags -max_lag to max_lag, with FFTs.
+
+    Returns:
+        tuple: Lags (samples) and windows x lags array of sum(ref[t] * sig[t + lag]).
+    """
+    n = ref.shape[-1]
+    nfft = 1 << int(np.ceil(np.log2(n + max_lag)))
+    cc = np.fft.irfft(np.conj(np.fft.rfft(ref, nfft)) * np.fft.rfft(sig, nfft), nfft)
+    lags = np.arange(-max_lag, max_lag + 1)
+    return lags, cc[..., lags % nfft]
+
+
+def _standardize(windows):
+    """Windows with zero mean and unit variance (NaN set to 0), and their valid fraction."""
+    valid = np.isfinite(windows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nanmean(np.where(valid, windows, np.nan), axis=-1, keepdims=True)
+        std = np.nanstd(np.where(valid, windows, np.nan), axis=-1, keepdims=True)
+        out = np.where(valid, (windows - mean) / std, 0)
+    return np.nan_to_num(out, nan=0, posinf=0, neginf=0), valid.mean(axis=-1), std[..., 0]
+
+
+def estimate_delay(ref_dt, ref, dt, sig, step=1.0, max_lag=600.0, window=6 * 3600.0, min_valid=0.5):
+    """
+    Delay of a signal relative to a reference signal.
+
+    Args:
+        ref_dt, dt (array): Sorted time of the reference and of the signal, int64 ns.
+        ref, sig (array): Reference signal (e.g. FLOW swt) and signal of the instrument.
+        step (float): Resolution of the common time grid, seconds.
+        max_lag (float): Largest delay searched, seconds.
+        window (float): Length of the correlation windows, seconds (half overlapping).
+        min_valid (float): Smallest fraction of both signals with data in a window.
+
+    Returns:
+        SyncResult: Delay to add to the time of the signal (NaN if no window
+        could be correlated) and confidence: weighted fraction of the windows
+        within one step of the delay times their median correlation.
+    """
+    step_ns = int(round(step * 1e9))
+    ref_dt, dt = np.asarray(ref_dt, dtype=np.int64), np.asarray(dt, dtype=np.int64)
+    empty = SyncResult(np.nan, 0.0, np.array([], dtype='datetime64[ns]'), np.array([]), np.array([]))
+    if not len(ref_dt) or not len(dt):
+        return empty
+    t0, t1 = max(ref_dt[0], dt[0]), min(ref_dt[-1], dt[-1])
+    n = int((t1 - t0) // step_ns) + 1
+    max_lag = int(round(max_lag / step))
+    win = min(int(round(window / step)), n)
+    if t1 <= t0 or win <= 2 * max_lag:
+        return empty
+
+    grid_ref = resample(ref_dt, ref, t0, step_ns, n)
+    grid_sig = resample(dt, sig, t0, step_ns, n)
+    hop = max(win // 2, 1)
+    starts = np.arange(0, n - win + 1, hop)
+    a, valid_a, std_a = _standardize(np.lib.stride_tricks.sliding_window_view(grid_ref, win)[starts])
+    b, valid_b, std_b = _standardize(np.lib.stride_tricks.sliding_window_view(grid_sig, win)[starts])
+    # Windows without switch (constant reference) or without data carry no delay
+    keep = (valid_a >= min_valid) & (valid_b >= min_valid) & (std_a > 0) & (std_b > 0)
+    if not keep.any():
+        return empty
+    starts, a, b = starts[keep], a[keep], b[keep]
+
+    lags, cc = xcorr(a, b, max_lag)
+    cc = np.abs(cc) / win
+    best = np.argmax(cc, axis=-1)
+    peak = cc[np.arange(len(best)), best]
+    # Parabolic interpolation of the peak, below the grid resolution
+    inner = (best > 0) & (best < len(lags) - 1)
+    rows = np.flatnonzero(inner)
+    y0, y1, y2 = (cc[rows, best[rows] + d] for d in (-1, 0, 1))
+    denominator = y0 - 2 * y1 + y2
+    shift = np.zeros(len(best))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift[rows] = np.where(denominator < 0, 0.5 * (y0 - y2) / denominator, 0)
+    # The signal lags the reference by lag: its time is to be decreased
+    window_delay = -(lags[best] + shift) * step
+
+    order = np.argsort(window_delay)
+    cumulative = np.cumsum(peak[order])
+    delay = float(window_delay[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+    agree = np.abs(window_delay - delay) <= step
+    confidence = float(peak[agree].sum() / peak.sum() * np.median(peak[agree]))
+    window_start = (t0 + starts * step_ns).view('datetime64[ns]')
+    return SyncResult(delay, confidence, window_start, window_delay, peak)
+
+
+def view_signal(data, varname=None, varcol=None):
+    """
+    Time (int64 ns) and values of the variable of data used to synchronise,
+    selected as in the QC views: column varcol if given, else column varname.
+    """
+    if hasattr(data, 'lambda_a'):
+        # Spectra: a then c columns, as in the DataFrame of import_inlinino_acs
+        col = int(varcol) if varcol is not None else 0
+        n_a = len(data.lambda_a)
+        return data.dt, data.a[:, col] if col < n_a else data.c[:, col - n_a]
+    dt = pd.DatetimeIndex(data.index).as_unit('ns').asi8
+    if varcol is not None:
+        return dt, data.iloc[:, int(varcol)].to_numpy(dtype=float)
+    return dt, data[varname].to_numpy(dtype=float)
+
+
+def shift_time(data, delay):
+    """
+    data with delay seconds added to its time.
+
+    Only the time is replaced: the DataFrame returned shares the columns of
+    data (copy on write), and Spectra are views of the same arrays.
+    """
+    offset = int(round(delay * 1e9))
+    if hasattr(data, 'lambda_a'):
+        out = data[:]
+        out.dt = data.dt + offset
+        return out
+    out = data.set_axis(data.index + pd.Timedelta(offset, unit='ns'), axis=0)
+    if 'dt' in out.columns:
+        out['dt'] = out.index
+    return out
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tail-follow reading of raw files that are still being written.
+
+Inlinino keeps appending to the file of the current day. A TailReader keeps,
+for each raw file, the byte offset up to which it was parsed and its header
+lines (column names and units row, which holds the ACS wavelengths). Each
+call parses only the complete lines appended since the previous call, with
+the stored header put back in front, and merges the rows into the data
+already loaded.
+
+Import functions averaging data in time bins (import_inlinino_flow resamples
+to 1 min) get a partial last bin while the file grows: with rewind_last_bin
+the offset is kept at the first line of the last bin, which is parsed again
+at the next call and replaces the previous rows from that time on.
+
+Files imported whole by read_raw are recorded with mark_read, from the last
+row imported, so that the first refresh after read_raw only parses what was
+appended since.
+"""
+import os
+import warnings
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from lib.i_read import import_file, list_files_from_software, FileImportError
+from lib.time_index import line_time
+
+
+class TailReader:
+    """
+    Incremental reader of growing raw files.
+
+    Args:
+        fun (function): Import function, fun(file[, otherarg1[, otherarg2]]),
+            accepting the bytes of a file instead of its path.
+        header_lines (int): Number of header lines of the raw files.
+        rewind_last_bin (bool): Parse the lines of the last output row again
+            at the next call (for import functions binning data in time).
+        otherarg1, otherarg2: Additional arguments for the import function.
+    """
+
+    def __init__(self, fun, header_lines=2, rewind_last_bin=False, otherarg1=None, otherarg2=None):
+        self.fun = fun
+        self.header_lines = header_lines
+        self.rewind_last_bin = rewind_last_bin
+        self.otherarg1 = otherarg1
+        self.otherarg2 = otherarg2
+        # Per file: byte offset of the first line not parsed yet and header lines
+        self.files = {}
+
+    def reset(self, path=None):
+        """Forget the offsets of path, or of all files."""
+        if path is None:
+            self.files.clear()
+        else:
+            self.files.pop(path, None)
+
+    def read_new(self, path):
+        """
+        Parse the complete lines appended to path since the last call.
+
+        Returns:
+            pd.DataFrame: Output of the import function for the new lines, or
+            None if no complete line was appended.
+        """
+        state = self.files.get(path)
+        with open(path, 'rb') as fid:
+            if state is not None and os.fstat(fid.fileno()).st_size < state['offset']:
+                warnings.warn(f"{path} is shorter than when last read, reading it again")
+                state = None
+            if state is None:
+                header = b''.join(fid.readline() for _ in range(self.header_lines))
+                if header.count(b'\n') < self.header_lines:
+                    return None
+                state = {'offset': len(header), 'header': header}
+                self.files[path] = state
+            fid.seek(state['offset'])
+            raw = fid.read()
+
+        # Leave a line being written for the next call
+        raw = raw[:raw.rfind(b'\n') + 1]
+        if not raw:
+            return None
+        try:
+            data = import_file(self.fun, state['header'] + raw, self.otherarg1, self.otherarg2)
+        except Exception as e:
+            raise FileImportError(path, e) from e
+
+        if self.rewind_last_bin and len(data):
+            state['offset'] += _first_line_from(raw, data.index[-1])
+        else:
+            state['offset'] += len(raw)
+        return data
+
+    def mark_read(self, files, index, blocksize=1 << 16):
+        """
+        Record files as parsed up to the last row of index, as after read_raw
+        imported them whole, so that the next call only parses the lines
+        appended afterwards (or the lines of the last row with rewind_last_bin).
+
+        Args:
+            files (list): Raw files imported.
+            index: Times of the rows imported (DatetimeIndex, sorted).
+            blocksize (int): Bytes read at the end of the files to find the
+                offset, doubled until enough.
+        """
+        index = pd.DatetimeIndex(index) if len(index) else pd.DatetimeIndex([])
+        for path in files:
+            with open(path, 'rb') as fid:
+                header = b''.join(fid.readline() for _ in range(self.header_lines))
+                if header.count(b'\n') < self.header_lines:
+                    continue
+                size = os.fstat(fid.fileno()).st_size
+                block = blocksize
+                while True:
+                    start = max(len(header), size - block)
+                    fid.seek(start)
+                    raw = fid.read(size - start)
+                    # Complete lines only, the first one may be cut by the block
+                    raw = raw[:raw.rfind(b'\n') + 1]
+                    cut = raw.find(b'\n') + 1 if start > len(header) else 0
+                    start, raw = start + cut, raw[cut:]
+                    offset = self._offset(raw, index)
+                    if offset or start == len(header):
+                        break
+                    block *= 2
+            self.files[path] = {'offset': start + offset, 'header': header}
+
+    def _offset(self, raw, index):
+        """Offset in raw (complete lines) of the first line not held by the rows of index."""
+        if not raw:
+            return 0
+        last = line_time(raw[raw.rfind(b'\n', 0, len(raw) - 1) + 1:-1])
+        k = index.searchsorted(last, side='right') - 1
+        if k < 0:
+            # No row of the file was imported
+            return 0
+        if self.rewind_last_bin:
+            return _first_line_from(raw, index[k])
+        return _first_line_from(raw, index[k] + pd.Timedelta(1, 'ns'))
+
+    def update(self, data, files, verbose=False):
+        """
+        Merge the lines appended to files into data.
+
+        Args:
+            data (pd.DataFrame): Data already loaded, sorted in time (or None).
+            files (list): Raw files to follow, in time order.
+            verbose (bool): Print the number of new rows of each file.
+
+        Returns:
+            pd.DataFrame: data with the new rows, replacing the rows it held
+            over the time range of the new ones.
+        """
+        for path in files:
+            new = self.read_new(path)
+            if new is None or new.empty:
+                continue
+            if verbose:
+                print(f"{path}: {len(new)} new rows")
+            data = merge_rows(data, new)
+        return data
+
+
+def merge_rows(data, new):
+    """Insert new rows (sorted in time) in data, replacing the rows of data
+    over their time range."""
+    if data is None or data.empty:
+        return new
+    start = data.index.searchsorted(new.index[0], side='left')
+    stop = data.index.searchsorted(new.index[-1], side='right')
+    return pd.concat([data.iloc[:start], new, data.iloc[stop:]])
+
+
+def list_raw_files(dirname_in, prefix, dt, software, postfix=''):
+    """Raw files of the days from dt[0] to dt[1], in time order."""
+    current_dt = datetime(dt[0].year, dt[0].month, dt[0].day)
+    files = []
+    while current_dt <= dt[-1]:
+        files.extend(list_files_from_software(software, dirname_in, prefix, current_dt, postfix))
+        current_dt += timedelta(days=1)
+    return files
+
+
+def _first_line_from(raw, timestamp):
+    """
+    Byte offset in raw of the first line of the trailing lines whose time
+    (first field) is at or after timestamp.
+    """
+    end = len(raw) - 1
+    while end > 0:
+        start = raw.rfind(b'\n', 0, end) + 1
+        line = raw[start:end]
+        if line_time(line) < timestamp:
+            return end + 1
+        if start == 0:
+            break
+        end = start - 1
+    return 0
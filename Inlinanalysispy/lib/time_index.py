@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time spans of raw files and day caches.
+
+Reading a time window only needs the raw files and the cached rows that
+overlap it. The span of a cached day comes from its index (memory mapped for
+the npy caches), the span of each raw file behind a cache is recorded in the
+cache manifest (see lib.cache_manifest), and the span of other raw files is
+read from their first and last data lines.
+"""
+import numpy as np
+import pandas as pd
+
+
+def line_time(line):
+    """Time of an Inlinino data line (first field)."""
+    return pd.Timestamp(line[:line.find(b',')].decode() if b',' in line else line.decode())
+
+
+def raw_file_span(path, header_lines=2, blocksize=4096):
+    """
+    First and last time of an Inlinino raw file, read from its first and last
+    data lines only.
+
+    Returns:
+        tuple: (first, last) Timestamps, or None if unknown (no data line,
+        unexpected format), in which case the file is to be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            for _ in range(header_lines):
+                f.readline()
+            first = f.readline().strip()
+            f.seek(0, 2)
+            f.seek(max(f.tell() - blocksize, 0))
+            last = f.read().strip().rsplit(b'\n', 1)[-1]
+        if not first:
+            return None
+        return line_time(first), line_time(last)
+    except (OSError, ValueError):
+        return None
+
+
+def span_entry(index, start, stop):
+    """Manifest entries of the span of the rows start:stop of a day cache."""
+    if not isinstance(index, pd.DatetimeIndex) or stop <= start:
+        return {}
+    return {'first': index[start].isoformat(), 'last': index[stop - 1].isoformat()}
+
+
+def manifest_spans(manifest):
+    """Span (first, last) of each raw file recorded in a manifest, if known."""
+    if not manifest:
+        return {}
+    return {f['name']: (pd.Timestamp(f['first']), pd.Timestamp(f['last']))
+            for f in manifest['files'] if 'first' in f}
+
+
+def overlaps(span, start, end):
+    """Whether a span overlaps [start, end], unknown spans (None) always do."""
+    return span is None or (span[0] <= end and span[1] >= start)
+
+
+def rows_in_window(index, start, end):
+    """Rows of index within [start, end], as a slice if index is sorted."""
+    if isinstance(index, pd.DatetimeIndex):
+        # Bounds at the resolution of the index (e.g. ms for parsed times)
+        start, end = pd.Timestamp(start).ceil(index.unit), pd.Timestamp(end).floor(index.unit)
+    if index.is_monotonic_increasing:
+        return slice(index.searchsorted(start, side='left'), index.searchsorted(end, side='right'))
+    return np.flatnonzero((index >= start) & (index <= end))
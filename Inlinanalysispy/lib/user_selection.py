@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Storage of the QCRef user selections.
+
+Selections are (start, end, mode) intervals kept in a structured array
+sorted by start, saved with np.save without pickle:
+
+    start    int64, ns since epoch
+    end      int64, ns since epoch
+    mode     uint8, index in MODES
+    reach    int64, running maximum of end (end of the latest interval so far)
+    session  int64, QCRef session that made the selection (0, 1, ...)
+
+Being sorted, the intervals overlapping a time window are found with two
+binary searches, on start for the last one and on reach for the first one,
+and the file is memory mapped, so that loading costs O(log n + k) for k
+intervals in the window however long the file gets. Each QCRef session is
+appended to the file under the next session number, and the selections are
+applied session by session: a later session re-marking a span in another
+mode overrides the earlier one.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+MODES = ('total', 'filtered')
+SELECTION_DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('mode', 'u1'), ('reach', '<i8'),
+                            ('session', '<i8')])
+
+
+def _to_ns(values):
+    """POSIX seconds (UTC) or datetime64 as int64 ns."""
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]').view(np.int64)
+    return np.round(values.astype(float) * 1e9).astype(np.int64)
+
+
+def to_array(selections, session=0):
+    """
+    Sorted structured array of selections.
+
+    Args:
+        selections (dict): (start, end) pairs of each mode of MODES, as POSIX
+            seconds (UTC) or datetime64.
+        session (int): Session number of the selections.
+    """
+    parts = []
+    for mode, pairs in selections.items():
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode: {mode}')
+        pairs = np.asarray(pairs)
+        if not pairs.size:
+            continue
+        bounds = _to_ns(pairs.reshape(-1, 2))
+        part = np.zeros(len(bounds), dtype=SELECTION_DTYPE)
+        part['start'], part['end'] = bounds[:, 0], bounds[:, 1]
+        part['mode'] = MODES.index(mode)
+        part['session'] = session
+        parts.append(part)
+    return _sorted(np.concatenate(parts) if parts else np.zeros(0, dtype=SELECTION_DTYPE))
+
+
+def _sorted(array):
+    array = array[np.argsort(array['start'], kind='stable')]
+    array['reach'] = np.maximum.accumulate(array['end']) if len(array) else array['end']
+    return array
+
+
+def from_legacy(legacy):
+    """
+    Selections of the previous format: a dict of the FLOW data selected in
+    each mode ({'total': data[swt == 0], 'filtered': data[swt == 1]}), one
+    interval per run of consecutive samples of a mode.
+
+    Samples of both modes are put on one timeline, a gap longer than twice
+    the sampling interval ending the current run, and the runs are turned into
+    intervals with lib.split.switch_periods.
+    """
+    from lib.split import switch_periods
+
+    dt, state = [], []
+    for k, mode in enumerate(MODES):
+        data = legacy.get(mode)
+        if data is None or not len(data):
+            continue
+        if not isinstance(getattr(data, 'index', None), pd.DatetimeIndex):
+            raise ValueError(f'{mode} is a {type(data).__name__}, expected data indexed by time')
+        dt.append(data.index.as_unit('ns').asi8)
+        state.append(np.full(len(data), k, dtype=float))
+    if not dt:
+        return to_array({})
+    dt, state = np.concatenate(dt), np.concatenate(state)
+    order = np.argsort(dt, kind='stable')
+    dt, state = dt[order], state[order]
+    if len(dt) > 1:
+        # A NaN sample one interval after the last sample before each gap
+        period = np.int64(np.median(np.diff(dt)))
+        gap = np.flatnonzero(np.diff(dt) > 2 * period)
+        dt = np.insert(dt, gap + 1, dt[gap] + period)
+        state = np.insert(state, gap + 1, np.nan)
+    periods = switch_periods(dt, state, switch_filtered=MODES.index('filtered'), switch_total=MODES.index('total'))
+    return to_array({mode: np.column_stack(getattr(periods, mode)).view('datetime64[ns]')
+                     for mode in MODES})
+
+
+def read_selections(path, mmap_mode='r'):
+    """
+    Selections saved in path (memory mapped by default).
+
+    Files of the previous formats (pickled dict of the FLOW data selected in
+    each mode, see from_legacy, or intervals without session) are converted,
+    as a single session.
+
+    Raises:
+        ValueError: File neither of SELECTION_DTYPE nor convertible.
+    """
+    try:
+        array = np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+    except ValueError:
+        pass
+    else:
+        if array.dtype == SELECTION_DTYPE:
+            return array
+        if array.dtype.names and set(array.dtype.names) == set(SELECTION_DTYPE.names) - {'session'}:
+            out = np.zeros(len(array), dtype=SELECTION_DTYPE)
+            for name in array.dtype.names:
+                out[name] = array[name]
+            return out
+        raise ValueError(f'{path}: QCRef selections of dtype {array.dtype}, expected {SELECTION_DTYPE}.')
+    try:
+        legacy = np.load(path, allow_pickle=True)
+        legacy = legacy.item() if legacy.dtype == object and legacy.shape == () else legacy
+        if not isinstance(legacy, dict):
+            raise ValueError(f'a {type(legacy).__name__}, expected a dict of {", ".join(MODES)} data')
+        return from_legacy(legacy)
+    except Exception as e:
+        raise ValueError(f'{path}: QCRef selections cannot be read or converted ({e}). '
+                         f'Remove the file and select the switch periods again.') from e
+
+
+def save_selections(path, selections, append=True):
+    """
+    Save selections to path, after the ones already saved if append, as a new
+    session (applied after them, see load_selections).
+
+    Args:
+        path (str): .npy file.
+        selections (dict or array): (start, end) pairs of each mode, or
+            structured array of SELECTION_DTYPE (its sessions are kept).
+        append (bool): Keep the selections already in path (False: replace them).
+
+    Returns:
+        np.ndarray: All the selections saved.
+    """
+    old = np.array(read_selections(path, mmap_mode=None)) if append and os.path.exists(path) \
+        else np.zeros(0, dtype=SELECTION_DTYPE)
+    new = np.array(selections) if isinstance(selections, np.ndarray) else to_array(selections)
+    if len(old):
+        new['session'] += old['session'].max() + 1
+    new = _sorted(np.concatenate([old, new]))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Written aside then renamed, the memory mapped file may still be open
+    tmp = path + '.tmp.npy'
+    np.save(tmp, new, allow_pickle=False)
+    os.replace(tmp, path)
+    return new
+
+
+def select_window(array, start=None, end=None):
+    """Selections overlapping [start, end] (None: unbounded), with two binary searches."""
+    first = 0 if start is None else int(np.searchsorted(array['reach'], pd.Timestamp(start).as_unit('ns').value, 'left'))
+    last = len(array) if end is None else int(np.searchsorted(array['start'], pd.Timestamp(end).as_unit('ns').value, 'right'))
+    out = np.array(array[first:last])
+    # Intervals within the range may end before start when a previous one reaches further
+    if start is not None and len(out):
+        out = out[out['end'] >= pd.Timestamp(start).as_unit('ns').value]
+    return out
+
+
+def load_selections(path, start=None, end=None):
+    """
+    Selections of path overlapping [start, end], in the order they are to be
+    applied: session by session, and in the order of MODES within a session.
+
+    Returns:
+        list: (mode, (n, 2) array of (start, end) datetime64[ns] sorted by
+        start) of each session and mode with selections (as taken by
+        FLOW.apply_user_inputs, the last one winning where they overlap).
+    """
+    out = select_window(read_selections(path), start, end)
+    bounds = np.column_stack([out['start'], out['end']]).view('datetime64[ns]') if len(out) \
+        else np.zeros((0, 2), dtype='datetime64[ns]')
+    groups = out['session'] * len(MODES) + out['mode']
+    return [(MODES[g % len(MODES)], bounds[groups == g]) for g in np.unique(groups)]
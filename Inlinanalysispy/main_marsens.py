@@ -23,8 +23,8 @@ ila.ReadRaw()
 ila.CheckDataStatus()
 
 # 2. Auto-synchronise
-# Placeholders for Sync operations
-print("Synchronizing instruments...")
+ila.cfg['sync']['mode'] = 'auto'
+ila.Sync()
 
 # 3. QC Reference
 ila.cfg['qcref']['mode'] = 'ui'
@@ -40,8 +40,8 @@ ila.AutoQC('raw')
 ila.CheckDataStatus()
 
 # 6. Bin data
-ila.cfg['bin'] = {"skip": []}
-print("Binning data...")
+ila.cfg['bin']['skip'] = []
+ila.Bin()
 ila.CheckDataStatus()
 
 # 7. Flagging
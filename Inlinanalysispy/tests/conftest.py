@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the numeric kernels of lib against naive implementations.
+
+Run from Inlinanalysispy (python -m pytest tests); the lib and instruments
+packages are imported from the parent folder of the tests.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
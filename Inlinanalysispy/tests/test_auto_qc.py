@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""rolling_median and spike_mask against np.nanmedian windows and known spikes."""
+import warnings
+
+import numpy as np
+import pytest
+
+from lib import auto_qc
+from lib.auto_qc import rolling_median, spike_mask
+
+NS = 10**9
+
+
+def naive_median(values, window):
+    # Edges repeated, NaN left out of the windows
+    h = window // 2
+    padded = np.concatenate([np.repeat(values[:1], h, axis=0), values, np.repeat(values[-1:], h, axis=0)])
+    with warnings.catch_warnings():
+        # All-NaN windows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.array([np.nanmedian(padded[i:i + window], axis=0) for i in range(len(values))])
+
+
+@pytest.mark.parametrize('window', [3, 5, 9])
+@pytest.mark.parametrize('chunk', [auto_qc.CHUNK_VALUES, 40])
+def test_rolling_median_matches_nanmedian(monkeypatch, window, chunk):
+    monkeypatch.setattr(auto_qc, 'CHUNK_VALUES', chunk)
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(500, 6))
+    values[rng.random(values.shape) < 0.15] = np.nan
+    values[100:120, 2] = np.nan
+    values[:, 5] = np.nan
+    values[7, 1] = np.inf
+    np.testing.assert_allclose(rolling_median(values, window), naive_median(values, window))
+
+
+def test_spike_next_to_nan_is_found():
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=(2000, 2))
+    values[500, 0] = np.nan
+    values[502, 0] = 40
+    values[1500, 1] = -40
+    mask = spike_mask(values, np.arange(2000, dtype=np.int64) * NS)
+    assert mask[502, 0] and mask[1500, 1]
+    assert mask.sum() == 2
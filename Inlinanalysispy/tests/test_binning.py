@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""bin_arrays against percentile-trimmed statistics computed bin by bin."""
+import numpy as np
+import pytest
+
+from lib import binning
+from lib.binning import bin_arrays
+
+
+def naive_bins(dt, values, bin_size, prctile_detection, prctile_average):
+    labels = dt // bin_size
+    bins = np.unique(labels)
+    out = {k: np.full((len(bins), values.shape[1]), np.nan) for k in ('avg', 'std', 'med')}
+    out['n'] = np.zeros((len(bins), values.shape[1]), dtype=np.int64)
+    for i, label in enumerate(bins):
+        for j in range(values.shape[1]):
+            v = values[labels == label, j]
+            v = v[np.isfinite(v)]
+            out['n'][i, j] = len(v)
+            if not len(v):
+                continue
+            out['med'][i, j] = np.median(v)
+            lo, hi = np.percentile(v, prctile_average)
+            out['avg'][i, j] = v[(v >= lo) & (v <= hi)].mean()
+            lo, hi = np.percentile(v, prctile_detection)
+            kept = v[(v >= lo) & (v <= hi)]
+            if len(kept) > 1:
+                out['std'][i, j] = kept.std(ddof=1)
+    return bins * bin_size, out
+
+
+@pytest.mark.parametrize('chunk', [binning.CHUNK_VALUES, 64])
+@pytest.mark.parametrize('prctiles', [((2.5, 97.5), (2.5, 97.5)), ((10, 90), (25, 75)), ((0, 100), (0, 100))])
+def test_bin_arrays_matches_naive(monkeypatch, chunk, prctiles):
+    monkeypatch.setattr(binning, 'CHUNK_VALUES', chunk)
+    rng = np.random.default_rng(0)
+    # Irregular sampling: bins of different sizes, empty bins skipped
+    dt = np.sort(rng.choice(3600, 1500, replace=False)).astype(np.int64) * 10**9
+    values = rng.normal(10, 2, (len(dt), 4))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[::97, 1] = 1e3
+    values[5, 2] = np.inf
+    values[dt // (60 * 10**9) == 7, 3] = np.nan
+
+    bins, stats = bin_arrays(dt, values, 60 * 10**9, *prctiles)
+    ref_bins, ref = naive_bins(dt, np.where(np.isinf(values), np.nan, values), 60 * 10**9, *prctiles)
+    np.testing.assert_array_equal(bins, ref_bins)
+    np.testing.assert_array_equal(stats['n'], ref['n'])
+    for key in ('avg', 'std', 'med'):
+        np.testing.assert_allclose(stats[key], ref[key], rtol=1e-9, atol=1e-9, err_msg=key)
+
+
+def test_bin_arrays_regular_bins():
+    rng = np.random.default_rng(1)
+    # Every bin full, the padded array is filled by a reshape
+    dt = np.arange(600, dtype=np.int64) * 10**9
+    values = rng.normal(size=(600, 3))
+    bins, stats = bin_arrays(dt, values, 60 * 10**9)
+    ref_bins, ref = naive_bins(dt, values, 60 * 10**9, (2.5, 97.5), (2.5, 97.5))
+    np.testing.assert_array_equal(bins, ref_bins)
+    for key in ('avg', 'std', 'med', 'n'):
+        np.testing.assert_allclose(stats[key], ref[key], rtol=1e-9, atol=1e-12, err_msg=key)
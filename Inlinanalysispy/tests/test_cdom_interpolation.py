@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""filter_events, cluster_events and fit_clusters against loops over events and clusters."""
+import numpy as np
+import pytest
+
+from lib.cdom_interpolation import filter_events, cluster_events, fit_clusters, MAD_TO_STD
+
+NS = 10**9
+DAY = 86400 * NS
+
+
+def naive_clusters(t, cdom, min_size, time_weight):
+    finite = cdom[np.isfinite(cdom)]
+    scale = MAD_TO_STD * np.median(np.abs(finite - np.median(finite)))
+    distance = [np.hypot((t[i + 1] - t[i]) / DAY * time_weight,
+                         np.nan_to_num((cdom[i + 1] - cdom[i]) / scale)) for i in range(len(t) - 1)]
+    cuts = {i for i, d in enumerate(distance) if d > 1}
+    while cuts:
+        # Clusters as (first, last) events
+        bounds = sorted(cuts)
+        clusters = list(zip([0] + [c + 1 for c in bounds], bounds + [len(t) - 1]))
+        removed = set()
+        for k, (first, last) in enumerate(clusters):
+            if last - first + 1 >= min_size:
+                continue
+            before = distance[first - 1] if k > 0 else np.inf
+            after = distance[last] if k < len(clusters) - 1 else np.inf
+            removed.add(first - 1 if before <= after else last)
+        if not removed:
+            break
+        cuts -= removed
+    labels, label = [], 0
+    for i in range(len(t)):
+        labels.append(label)
+        label += i in cuts
+    return np.array(labels)
+
+
+def test_filter_events_matches_loop():
+    rng = np.random.default_rng(0)
+    t = np.sort(rng.choice(2000, 300, replace=False)).astype(np.int64) * 60 * NS
+    values = rng.normal(size=(300, 4))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    t_events, mean, first = filter_events(t, values, 5 * 60 * NS)
+    runs = np.split(np.arange(300), np.flatnonzero(np.diff(t) > 5 * 60 * NS) + 1)
+    np.testing.assert_array_equal(first, [r[0] for r in runs])
+    for k, run in enumerate(runs):
+        assert t_events[k] == t[run[0]] + np.sum(t[run] - t[run[0]]) // len(run)
+        for j in range(4):
+            v = values[run, j]
+            v = v[np.isfinite(v)]
+            if len(v):
+                assert mean[k, j] == pytest.approx(v.mean())
+            else:
+                assert np.isnan(mean[k, j])
+
+
+@pytest.mark.parametrize('min_size', [1, 3, 5])
+@pytest.mark.parametrize('time_weight', [0.5, 1, 4])
+def test_cluster_events_matches_naive(min_size, time_weight):
+    rng = np.random.default_rng(1)
+    # Events every 1 to 12 h over 30 days, CDOM drifting with water mass changes
+    t = np.cumsum(rng.integers(3600, 12 * 3600, 150)).astype(np.int64) * NS
+    cdom = np.cumsum(rng.normal(0, 1, 150)) + np.repeat(rng.normal(0, 5, 15), 10)
+    cdom[rng.random(150) < 0.05] = np.nan
+    labels = cluster_events(t, cdom, min_size, time_weight)
+    np.testing.assert_array_equal(labels, naive_clusters(t, cdom, min_size, time_weight))
+    sizes = np.bincount(labels)
+    assert len(sizes) == 1 or sizes.min() >= min_size
+
+
+def test_fit_clusters_matches_polyfit():
+    rng = np.random.default_rng(2)
+    labels = np.repeat(np.arange(4), [6, 1, 8, 5])
+    cdom = 50 + rng.normal(0, 3, len(labels))
+    values = 0.1 + 0.02 * cdom[:, None] * np.arange(1, 4) + rng.normal(0, 1e-3, (len(labels), 3))
+    values[3, 1] = np.nan
+    values[labels == 3, 2] = np.nan
+    intercept, slope = fit_clusters(labels, cdom, values)
+    for c in range(4):
+        rows = labels == c
+        for j in range(3):
+            x, y = cdom[rows], values[rows, j]
+            keep = np.isfinite(y)
+            if not keep.any():
+                assert np.isnan(intercept[c, j])
+            elif keep.sum() == 1:
+                # A single CDOM value: its mean and slope 0
+                assert (intercept[c, j], slope[c, j]) == pytest.approx((y[keep].mean(), 0))
+            else:
+                ref_slope, ref_intercept = np.polyfit(x[keep], y[keep], 1)
+                assert (intercept[c, j], slope[c, j]) == pytest.approx((ref_intercept, ref_slope), rel=1e-6)
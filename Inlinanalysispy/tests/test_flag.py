@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""window_bounds and rolling_mean_std against window by window statistics."""
+import numpy as np
+import pytest
+
+from lib.flag import window_bounds, rolling_mean_std
+
+NS = 10**9
+
+
+def naive_rolling(dt, values, window, exclude_self):
+    mean = np.full(values.shape, np.nan)
+    std = np.full(values.shape, np.nan)
+    for i in range(len(dt)):
+        rows = np.abs(dt - dt[i]) <= window // 2
+        if exclude_self:
+            rows[i] = False
+        for j in range(values.shape[1]):
+            v = values[rows, j]
+            v = v[np.isfinite(v)]
+            if len(v):
+                mean[i, j] = v.mean()
+            if len(v) > 1:
+                std[i, j] = v.std(ddof=1)
+    return mean, std
+
+
+def binned_times(rng, n=400):
+    # Minute bins with gaps of missing bins
+    return np.sort(rng.choice(3 * n, n, replace=False)).astype(np.int64) * 60 * NS
+
+
+def test_window_bounds_matches_loop():
+    rng = np.random.default_rng(0)
+    dt = binned_times(rng)
+    lo, hi = window_bounds(dt, 30 * 60 * NS)
+    for i in range(len(dt)):
+        rows = np.flatnonzero(np.abs(dt - dt[i]) <= 15 * 60 * NS)
+        assert (lo[i], hi[i]) == (rows[0], rows[-1] + 1)
+
+
+@pytest.mark.parametrize('exclude_self', [False, True])
+@pytest.mark.parametrize('missing', ['rows', 'values'])
+def test_rolling_mean_std_matches_naive(exclude_self, missing):
+    rng = np.random.default_rng(1)
+    dt = binned_times(rng)
+    # Large offset and small noise: the cumulative sums must keep their precision
+    values = 1e6 + rng.normal(0, 1e-3, (len(dt), 5))
+    if missing == 'rows':
+        values[rng.random(len(dt)) < 0.1] = np.nan
+    else:
+        values[rng.random(values.shape) < 0.1] = np.nan
+    values[:, 4] = np.nan
+    window = 30 * 60 * NS
+    mean, std = rolling_mean_std(values, window_bounds(dt, window), exclude_self)
+    ref_mean, ref_std = naive_rolling(dt, values, window, exclude_self)
+    np.testing.assert_allclose(mean, ref_mean, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(std, ref_std, rtol=1e-5, atol=1e-9)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""switch_periods, merge_intervals and split_data against sample by sample loops."""
+import numpy as np
+import pandas as pd
+
+from lib.split import switch_periods, merge_intervals, split_data
+
+NS = 10**9
+
+
+def naive_periods(dt, swt, switch_filtered=1, switch_total=0):
+    period = int(np.median(np.diff(dt)))
+    out = {switch_total: [], switch_filtered: []}
+    current, start = None, None
+    for i, (t, s) in enumerate(zip(dt, swt)):
+        s = round(s) if np.isfinite(s) and round(s) in out else None
+        if i and s == current:
+            continue
+        if current is not None:
+            # Closed at this sample, or one interval after the last one before a gap
+            out[current].append((start, int(t) if s is not None else int(dt[i - 1]) + period))
+        current, start = s, int(t)
+    if current is not None:
+        out[current].append((start, int(dt[-1]) + period))
+    return out[switch_total], out[switch_filtered]
+
+
+def switch_data(rng, n=3000):
+    dt = np.cumsum(rng.choice([1, 1, 1, 2], n)).astype(np.int64) * NS
+    swt = np.repeat(rng.integers(0, 2, n // 50), 50)[:n].astype(float)
+    swt[rng.random(n) < 0.01] = np.nan
+    swt[rng.random(n) < 0.005] = 0.4  # minute means rounded to a position
+    return dt, swt
+
+
+def test_switch_periods_matches_naive():
+    rng = np.random.default_rng(0)
+    dt, swt = switch_data(rng)
+    periods = switch_periods(dt, swt)
+    total, filtered = naive_periods(dt, swt)
+    assert list(zip(*periods.total)) == total
+    assert list(zip(*periods.filtered)) == filtered
+
+
+def test_merge_intervals_matches_timeline():
+    rng = np.random.default_rng(1)
+    starts = rng.integers(0, 1000, 200)
+    ends = starts + rng.integers(0, 30, 200)
+    merged = merge_intervals(starts, ends)
+    covered = np.zeros(1100, dtype=bool)
+    for s, e in zip(starts, ends):
+        covered[s:e + 1] = True
+    # Touching intervals are merged: boundaries are the edges of the covered runs
+    edges = np.flatnonzero(np.diff(np.r_[False, covered, False].astype(int)))
+    np.testing.assert_array_equal(merged[0], edges[::2])
+    np.testing.assert_array_equal(merged[1], edges[1::2] - 1)
+
+
+def test_split_data_matches_naive():
+    rng = np.random.default_rng(2)
+    dt, swt = switch_data(rng)
+    periods = switch_periods(dt, swt)
+    t = np.sort(rng.integers(dt[0] - 60 * NS, dt[-1] + 60 * NS, 5000))
+    data = pd.DataFrame({'v': np.arange(len(t))}, index=pd.DatetimeIndex(t))
+    buffer = (20, 7)
+    tsw, fsw = split_data(data, periods, buffer)
+
+    total, filtered = naive_periods(dt, swt)
+    expected = {}
+    for name, pairs, seconds in (('tsw', total, buffer[1]), ('fsw', filtered, buffer[0])):
+        expected[name] = [v for v, time in zip(data['v'], t)
+                          if any(s + seconds * NS <= time < e for s, e in pairs)]
+    assert tsw['v'].tolist() == expected['tsw']
+    assert fsw['v'].tolist() == expected['fsw']
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""xcorr, resample and estimate_delay against loops and known lags."""
+import numpy as np
+import pytest
+
+from lib.sync import xcorr, resample, estimate_delay
+
+NS = 10**9
+
+
+def test_xcorr_matches_loop():
+    rng = np.random.default_rng(0)
+    ref, sig = rng.normal(size=(3, 200)), rng.normal(size=(3, 200))
+    lags, cc = xcorr(ref, sig, 15)
+    np.testing.assert_array_equal(lags, np.arange(-15, 16))
+    for w in range(3):
+        for k, lag in enumerate(lags):
+            t = np.arange(max(0, -lag), min(200, 200 - lag))
+            assert cc[w, k] == pytest.approx(np.sum(ref[w, t] * sig[w, t + lag]), abs=1e-9)
+
+
+def test_resample_matches_bin_means():
+    rng = np.random.default_rng(1)
+    dt = np.sort(rng.integers(0, 100 * NS, 500))
+    values = rng.normal(size=500)
+    values[::17] = np.nan
+    out = resample(dt, values, 10 * NS, NS, 80)
+    for k in range(80):
+        v = values[(dt >= (10 + k) * NS) & (dt < (11 + k) * NS)]
+        v = v[np.isfinite(v)]
+        if len(v):
+            assert out[k] == pytest.approx(v.mean())
+        else:
+            assert np.isnan(out[k])
+
+
+def switch_signal(rng, seconds):
+    """Switch position at 1 Hz, alternating 10 min total and 5 to 15 min filtered."""
+    lengths = np.r_[[(600, rng.integers(300, 900)) for _ in range(seconds // 600)]].ravel()
+    swt = np.repeat(np.arange(len(lengths)) % 2, lengths)[:seconds].astype(float)
+    return np.arange(len(swt), dtype=np.int64) * NS, swt
+
+
+@pytest.mark.parametrize('lag', [37, -120, 12.5])
+def test_estimate_delay_finds_known_lag(lag):
+    rng = np.random.default_rng(2)
+    ref_dt, swt = switch_signal(rng, 2 * 86400)
+    # Instrument sampled at 4 Hz, dropping in filtered water lag seconds after the switch
+    dt = np.arange(int(ref_dt[-1] / NS * 4), dtype=np.int64) * NS // 4
+    sig = 1 - 0.8 * np.interp(dt - lag * NS, ref_dt, swt) + rng.normal(0, 0.05, len(dt))
+    result = estimate_delay(ref_dt, swt, dt, sig)
+    # The signal lags the reference: its time is to be decreased by lag
+    assert result.delay == pytest.approx(-lag, abs=0.5)
+    assert result.confidence > 0.5